@@ -0,0 +1,88 @@
+# Magic2 (https://github.com/jdranczewski/Magic2)
+# Copyright (C) 2018  Jakub Dranczewski, based on work by George Swadling
+
+# This work was carried out during a UROP with the MAGPIE Group,
+# Department of Physics, Imperial College London and was supported in part
+# by the Engineering and Physical Sciences Research Council (EPSRC) Grant
+# No. EP/N013379/1, by the U.S. Department of Energy (DOE) Awards
+# No. DE-F03-02NA00057 and No. DE-SC- 0001063
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# This benchmark measures how long it takes a fresh Python process to import
+# the headless parts of Magic2 (which is what every batch worker has to do),
+# and checks that none of the GUI libraries get imported along the way.
+# Run it from the main catalogue of the project:
+#   python benchmarks/import_time.py
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# The modules a headless worker needs
+MODULES = ('magic2.fringes', 'magic2.graphics', 'magic2.triangulate',
+           'magic2.pipeline', 'magic2.m2file', 'magic2.batch')
+# The modules that should not be imported by any of the above
+FORBIDDEN = ('tkinter', 'matplotlib', 'matplotlib.pyplot', 'magic2gui')
+
+# This is run in a fresh interpreter for every measurement
+SCRIPT = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, [name for name in {forbidden!r} if name in sys.modules]]))
+"""
+
+
+# Import the module in a new process, returning the time it took and
+# a list of the forbidden modules that got imported too
+def measure(module, root):
+    output = subprocess.run(
+        [sys.executable, "-c", SCRIPT.format(module=module, forbidden=FORBIDDEN)],
+        cwd=root, check=True, capture_output=True, text=True).stdout
+    return json.loads(output)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the cold import time of the magic2 package")
+    parser.add_argument("-n", "--repeat", type=int, default=5,
+                        help="number of fresh processes per module")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args(argv)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    results = {}
+    failed = False
+    for module in MODULES:
+        times = []
+        for i in range(args.repeat):
+            elapsed, loaded = measure(module, root)
+            times.append(elapsed)
+        results[module] = {'median': statistics.median(times), 'min': min(times),
+                           'forbidden': loaded}
+        print("{:<22} median {:6.1f} ms, min {:6.1f} ms{}".format(
+            module, 1000*results[module]['median'], 1000*results[module]['min'],
+            "  imports " + ", ".join(loaded) if len(loaded) else ""))
+        failed = failed or len(loaded) > 0
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,299 @@
+# Magic2 (https://github.com/jdranczewski/Magic2)
+# Copyright (C) 2018  Jakub Dranczewski, based on work by George Swadling
+
+# This work was carried out during a UROP with the MAGPIE Group,
+# Department of Physics, Imperial College London and was supported in part
+# by the Engineering and Physical Sciences Research Council (EPSRC) Grant
+# No. EP/N013379/1, by the U.S. Department of Energy (DOE) Awards
+# No. DE-F03-02NA00057 and No. DE-SC- 0001063
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# This benchmark times every stage of the processing, from reading the
+# fringes to calculating the plasma density, on the shots in sample_data and
+# on synthetic shots of different sizes and fringe densities. The results
+# can be written to a JSON file and compared against an earlier run:
+#   python benchmarks/pipeline.py --json baseline.json
+#   (change the code)
+#   python benchmarks/pipeline.py --compare baseline.json
+# Run it from the main catalogue of the project.
+import argparse
+import glob
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# Make the magic2 package importable when running from benchmarks/
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import magic2.fringes as m2fringes
+import magic2.graphics as m2graphics
+import magic2.labelling as m2labelling
+import magic2.triangulate as m2triangulate
+import magic2.pipeline as m2pipeline
+import magic2.progress as m2progress
+import magic2.m2file as m2file
+import magic2.synthetic as m2synthetic
+
+# All the stages, in the order they are run
+STAGES = ('read_fringes', 'render_fringes', 'triangulation', 'optimise',
+          'interpolate', 'fast_tri', 'subtract', 'plasma_density', 'save',
+          'open', 'label_fringes')
+# The stages of the exact interpolation, which are slow enough to be
+# skipped for large images
+EXACT = ('triangulation', 'optimise', 'interpolate')
+
+
+# The cases to run: every .m2 file in sample_data, and a synthetic shot
+# for every combination of size and fringe spacing
+def make_cases(sizes, spacings, sample=True):
+    cases = []
+    if sample:
+        for filename in sorted(glob.glob(os.path.join(ROOT, "sample_data", "*.m2"))):
+            shot = m2file.read(filename)
+            if shot['background'] is None or shot['plasma'] is None:
+                continue
+            cases.append({'name': os.path.splitext(os.path.basename(filename))[0],
+                          'source': 'sample', 'spacing': None,
+                          'background': shot['background'],
+                          'plasma': shot['plasma']})
+    for size in sizes:
+        for spacing in spacings:
+            background, plasma = m2synthetic.shot(size, spacing)
+            cases.append({'name': "synthetic_{}_{}".format(size, spacing),
+                          'source': 'synthetic', 'spacing': spacing,
+                          'background': background.m2_data(),
+                          'plasma': plasma.m2_data(),
+                          # The true plasma phase, to check the interpolation
+                          'truth': plasma.phase})
+    return cases
+
+
+# Call a function, returning its result and the time it took
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+# Prepare an interpolated map for an environment, without timing anything
+def interpolated_map(fringes_image, mask, phases):
+    canvas, fringes = m2file.load_canvas(fringes_image, mask, phases)
+    m2triangulate.fast_tri(canvas, None, m2progress.Progress())
+    return canvas, fringes
+
+
+# Run every stage once on a case, returning a dictionary of the times taken
+# and one of the interpolation errors (for synthetic shots). background is
+# the (Canvas, Fringes) tuple of the interpolated background
+def run_once(case, background, stages, exact, workdir):
+    times = {}
+    errors = {}
+    progress = m2progress.Progress()
+    fringes_image, mask, phases = case['plasma']
+    canvas = m2graphics.Canvas('dump', fi=fringes_image, m=mask)
+    fringes = m2fringes.Fringes()
+    labelled = [phase for phase in phases if phase != -2048.0]
+    if len(labelled):
+        fringes.min = np.amin(labelled)
+        fringes.max = np.amax(labelled)
+    # Fringe reading and rendering always run, as everything else needs them
+    x, times['read_fringes'] = timed(m2fringes.read_fringes, fringes, canvas,
+                                     phases=phases)
+    x, times['render_fringes'] = timed(m2graphics.render_fringes, fringes,
+                                       canvas, width=3)
+    if exact:
+        points = np.transpose(np.nonzero(canvas.fringes_image_clean))
+        tri, times['triangulation'] = timed(m2triangulate.Triangulation,
+                                            points, canvas, progress)
+        x, times['optimise'] = timed(tri.optimise, progress)
+        x, times['interpolate'] = timed(tri.interpolate, canvas, progress)
+        if 'truth' in case:
+            errors['exact'] = m2synthetic.interpolation_error(
+                canvas.interpolated, case['truth'], canvas.mask)
+    if 'fast_tri' in stages or 'subtract' in stages or 'plasma_density' in stages:
+        x, times['fast_tri'] = timed(m2triangulate.fast_tri, canvas, None, progress)
+        if 'truth' in case:
+            errors['fast'] = m2synthetic.interpolation_error(
+                canvas.interpolated, case['truth'], canvas.mask)
+        subtracted, times['subtract'] = timed(m2pipeline.subtract,
+                                              background[0].interpolated,
+                                              canvas.interpolated, canvas.mask)
+        x, times['plasma_density'] = timed(m2pipeline.plasma_density,
+                                           subtracted, 0, 10.0, 355, False)
+    if 'save' in stages or 'open' in stages:
+        filename = os.path.join(workdir, case['name'] + ".m2")
+        x, times['save'] = timed(m2file.write, filename,
+                                 background=background,
+                                 plasma=(canvas, fringes))
+        x, times['open'] = timed(m2file.read, filename)
+    if 'label_fringes' in stages:
+        # Relabel the fringes along a line going across the whole image, the
+        # way a user would. An off-screen figure stands in for the GUI
+        from matplotlib.figure import Figure
+        figure = Figure()
+        ax = figure.add_subplot(111)
+        canvas.imshow = ax.imshow(np.ma.masked_equal(canvas.fringe_phases_visual, -1024))
+        labeller = m2labelling.Labeller()
+        height, width = canvas.fringes_image.shape
+        labeller.points = [[0, 0], [height-1, width-1]]
+        x, times['label_fringes'] = timed(m2labelling.label_fringes, labeller,
+                                          fringes, canvas, figure, ax)
+    return {stage: value for stage, value in times.items() if stage in stages}, errors
+
+
+# Run a case several times, returning its description and the median
+# and minimum times of the stages
+def run_case(case, stages, repeat, exact_limit, workdir):
+    fringes_image = case['plasma'][0]
+    exact = (any(stage in stages for stage in EXACT)
+             and fringes_image.size <= exact_limit)
+    background = interpolated_map(*case['background'])
+    runs = []
+    for i in range(repeat):
+        times, errors = run_once(case, background, stages, exact, workdir)
+        runs.append(times)
+    result = {'name': case['name'], 'source': case['source'],
+              'shape': list(fringes_image.shape), 'pixels': int(fringes_image.size),
+              'spacing': case['spacing'],
+              'fringe_pixels': int(np.count_nonzero(fringes_image)),
+              'fringes': len(case['plasma'][2]), 'stages': {},
+              # The interpolation is deterministic, so the last run's
+              # errors (in fringes) are as good as any
+              'errors': errors}
+    for stage in stages:
+        values = [run[stage] for run in runs if stage in run]
+        if len(values):
+            result['stages'][stage] = {'median': statistics.median(values),
+                                       'min': min(values)}
+    return result
+
+
+# For every fringe spacing, fit the time of each stage against the number of
+# pixels on a log-log scale. An exponent of 1 means that the stage scales
+# linearly with the image size
+def scaling(results):
+    exponents = {}
+    spacings = sorted(set(result['spacing'] for result in results
+                          if result['source'] == 'synthetic'))
+    for spacing in spacings:
+        cases = [result for result in results if result['spacing'] == spacing]
+        exponents[str(spacing)] = {}
+        for stage in STAGES:
+            points = [(result['pixels'], result['stages'][stage]['median'])
+                      for result in cases if stage in result['stages']
+                      and result['stages'][stage]['median'] > 0]
+            if len(set(point[0] for point in points)) >= 2:
+                points = np.log(np.array(points))
+                exponents[str(spacing)][stage] = float(np.polyfit(points[:, 0], points[:, 1], 1)[0])
+    return exponents
+
+
+# Compare the results with a baseline, returning a list of the stages that
+# got slower by more than the threshold (a fraction). Differences smaller
+# than min_time (in seconds) are treated as noise
+def compare(results, baseline, threshold=0.2, min_time=0.005):
+    old_cases = {case['name']: case for case in baseline['cases']}
+    regressions = []
+    print("\n{:<40} {:<16} {:>10} {:>10} {:>8}".format(
+        "case", "stage", "baseline", "now", "change"))
+    for case in results['cases']:
+        if case['name'] not in old_cases:
+            continue
+        old_stages = old_cases[case['name']]['stages']
+        for stage, value in case['stages'].items():
+            if stage not in old_stages:
+                continue
+            old = old_stages[stage]['median']
+            new = value['median']
+            change = (new - old) / old if old > 0 else 0
+            flag = ""
+            if change > threshold and new - old > min_time:
+                flag = "  SLOWER"
+                regressions.append((case['name'], stage, old, new))
+            elif change < -threshold and old - new > min_time:
+                flag = "  faster"
+            print("{:<40} {:<16} {:>9.3f}s {:>9.3f}s {:>+7.0%}{}".format(
+                case['name'], stage, old, new, change, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the stages of the Magic2 processing")
+    parser.add_argument("--sizes", type=int, nargs="*", default=[256, 512, 1024],
+                        help="sizes (in pixels) of the synthetic shots")
+    parser.add_argument("--spacings", type=int, nargs="*", default=[10, 20, 40],
+                        help="fringe spacings (in pixels) of the synthetic shots")
+    parser.add_argument("--stages", nargs="*", default=STAGES, choices=STAGES,
+                        help="stages to time (default: all)")
+    parser.add_argument("--no-sample", action="store_true",
+                        help="skip the shots in sample_data")
+    parser.add_argument("--exact-limit", type=float, default=2**20,
+                        help="skip the exact interpolation for images with more pixels than this")
+    parser.add_argument("-n", "--repeat", type=int, default=3,
+                        help="number of runs per case")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="compare the results with this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="slowdown (as a fraction) reported as a regression")
+    args = parser.parse_args(argv)
+
+    print("Preparing the cases...")
+    cases = make_cases(args.sizes, args.spacings, not args.no_sample)
+    results = []
+    print("\n{:<40} {:>9} {:>8}  stages".format("case", "pixels", "fringes"))
+    with tempfile.TemporaryDirectory() as workdir:
+        for case in cases:
+            result = run_case(case, args.stages, args.repeat, args.exact_limit, workdir)
+            results.append(result)
+            print("{:<40} {:>9} {:>8}  {}".format(
+                result['name'], result['pixels'], result['fringes'],
+                ", ".join("{} {:.3f}s".format(stage, value['median'])
+                          for stage, value in result['stages'].items())))
+            if len(result['errors']):
+                print("{:<40} RMS interpolation error: {}".format("", ", ".join(
+                    "{} {:.3f} fringes".format(method, error['rms'])
+                    for method, error in result['errors'].items()
+                    if error['rms'] is not None)))
+    output = {'python': platform.python_version(), 'numpy': np.__version__,
+              'platform': platform.platform(), 'repeat': args.repeat,
+              'cases': results, 'scaling': scaling(results)}
+    for spacing, exponents in output['scaling'].items():
+        if not len(exponents):
+            continue
+        print("Scaling with the image size (spacing {} px): {}".format(
+            spacing, ", ".join("{} {:.2f}".format(stage, value)
+                               for stage, value in exponents.items())))
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(output, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(output, baseline, args.threshold)
+        if len(regressions):
+            print("\n{} stage(s) got slower".format(len(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
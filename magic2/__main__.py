@@ -0,0 +1,131 @@
+# Magic2 (https://github.com/jdranczewski/Magic2)
+# Copyright (C) 2018  Jakub Dranczewski, based on work by George Swadling
+
+# This work was carried out during a UROP with the MAGPIE Group,
+# Department of Physics, Imperial College London and was supported in part
+# by the Engineering and Physical Sciences Research Council (EPSRC) Grant
+# No. EP/N013379/1, by the U.S. Department of Energy (DOE) Awards
+# No. DE-F03-02NA00057 and No. DE-SC- 0001063
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# The command line interface of Magic2. Run it with
+#   python -m magic2 shot1.m2 shot2.m2 some_directory/ -o results
+# to process the shots without opening any windows.
+import argparse
+import os
+import sys
+import time
+from . import batch as m2batch
+
+
+def parse_offset(value):
+    if value == 'auto':
+        return value
+    return float(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m magic2",
+        description="Process .m2 files without the GUI: interpolate the "
+                    "labelled fringes, subtract the maps and calculate "
+                    "the plasma density.")
+    parser.add_argument("paths", nargs="+",
+                        help=".m2 files, or directories containing them")
+    parser.add_argument("-o", "--output", default="magic2_output",
+                        help="directory the results are written to")
+    parser.add_argument("-m", "--method", choices=("fast", "exact"),
+                        default="fast", help="interpolation method")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="number of worker processes (default: all processors)")
+    parser.add_argument("--no-images", dest="images", action="store_false",
+                        help="write only .npy arrays, no .png images")
+    parser.add_argument("--thumbnails", type=int, metavar="SIZE", default=None,
+                        help="also write NAME_STAGE_thumb.png images no larger than "
+                             "SIZE pixels (written in the out-of-core mode too)")
+    parser.add_argument("--float32", dest="nan_maps", action="store_true",
+                        help="keep the maps as float32 with NaNs where there is no data "
+                             "(half the memory, the .npy arrays are float32 too)")
+    parser.add_argument("--abel", choices=("three_point", "onion"), default=None,
+                        help="also Abel-invert the plasma density map about the vertical "
+                             "axis through its centre, with this method (NAME_abel.npy, in cm^-3)")
+    parser.add_argument("--register", choices=("translation", "subpixel", "rotation"),
+                        default=None,
+                        help="line up the background with the plasma image before the "
+                             "subtraction (a shift by whole pixels, a sub-pixel shift, or "
+                             "a sub-pixel shift and a small rotation), estimated from the "
+                             "traced fringes")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="print the progress of every stage")
+    parser.add_argument("--profile", action="store_true",
+                        help="write a trace of the time and memory used by every "
+                             "stage of every shot (NAME_profile.json)")
+    parser.add_argument("--progress-log",
+                        help="append the progress of every stage to this file as JSON lines")
+    parser.add_argument("--out-of-core", metavar="DIR",
+                        help="keep the large arrays in memory-mapped files in DIR and "
+                             "process them tile by tile (for images too big for the memory)")
+    parser.add_argument("--memory-budget", type=float, default=256,
+                        help="memory budget of the out-of-core mode in MB (default: 256)")
+    parser.add_argument("--tile-workers", type=int, default=None,
+                        help="number of processes interpolating the tiles of every shot "
+                             "in the out-of-core mode (default: 1)")
+    # Shot options, overriding the ones stored in the .m2 files
+    parser.add_argument("--wavelength", type=float, help="wavelength in nm")
+    parser.add_argument("--depth", type=float, help="depth of the object in mm")
+    parser.add_argument("--double", action=argparse.BooleanOptionalAction, default=None,
+                        help="one traced fringe is half a fringe shift (--no-double: "
+                             "a whole one)")
+    parser.add_argument("--offset", type=parse_offset,
+                        help="fringe shift set to zero, or 'auto'")
+    parser.add_argument("--resolution", type=float,
+                        help="resolution in pixels per mm (needed by --abel)")
+    parser.add_argument("--centre", type=float, nargs=2, metavar=("ROW", "COLUMN"),
+                        help="centre of the plasma density map in pixels, the column "
+                             "being the axis of symmetry for --abel")
+    args = parser.parse_args(argv)
+
+    filenames = m2batch.find_shots(args.paths)
+    if not len(filenames):
+        parser.error("no .m2 files found")
+    start = time.perf_counter()
+    settings = {'method': args.method, 'images': args.images,
+                'thumbnails': args.thumbnails, 'nan_maps': args.nan_maps,
+                'abel': args.abel, 'registration': args.register,
+                'wavelength': args.wavelength, 'depth': args.depth,
+                'double': args.double, 'offset': args.offset,
+                'resolution': args.resolution,
+                'centre': tuple(args.centre) if args.centre is not None else None,
+                'out_of_core': args.out_of_core,
+                'budget': int(args.memory_budget * 2**20) if args.out_of_core else None,
+                'tile_workers': args.tile_workers}
+    reports = m2batch.process_many(
+        filenames, args.output, workers=args.workers,
+        callback=lambda report: print(m2batch.format_report(report), flush=True),
+        verbose=args.verbose, progress_log=args.progress_log,
+        profile=args.profile, **settings)
+    settings['workers'] = args.workers
+    settings['total'] = time.perf_counter() - start
+    m2batch.write_summary(reports, os.path.join(args.output, "summary.json"),
+                          settings)
+    failed = len([report for report in reports if not report['ok']])
+    warned = len([report for report in reports if report.get('warnings')])
+    print("Processed {} shots in {:.2f} s, {} failed, {} with warnings".format(
+        len(reports), settings['total'], failed, warned))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
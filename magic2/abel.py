@@ -0,0 +1,201 @@
+# Magic2 (https://github.com/jdranczewski/Magic2)
+# Copyright (C) 2018  Jakub Dranczewski, based on work by George Swadling
+
+# This work was carried out during a UROP with the MAGPIE Group,
+# Department of Physics, Imperial College London and was supported in part
+# by the Engineering and Physical Sciences Research Council (EPSRC) Grant
+# No. EP/N013379/1, by the U.S. Department of Energy (DOE) Awards
+# No. DE-F03-02NA00057 and No. DE-SC- 0001063
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# This file inverts the Abel transform of a plasma density map, turning the
+# line-integrated electron density of an axisymmetric plasma (like a z-pinch
+# or a jet) into the electron density at every radius. The axis of symmetry
+# is the vertical line through the centre of the density map, and every row
+# is inverted on its own - the left and the right half independently.
+#
+# There are two methods, both described in C. J. Dasch, Applied Optics 31,
+# 1146 (1992):
+#   'onion'        onion peeling, the density is taken to be constant in
+#                  rings one pixel wide
+#   'three_point'  the derivative of the line-integrated density is taken
+#                  from a parabola through three neighbouring pixels, which
+#                  is less sensitive to noise
+# Both are linear, so each is a matrix that only depends on the number of
+# pixels between the axis and the edge of the map. The matrices are cached
+# and applied to a whole band of rows at once as a single matrix product,
+# with the bands shared out between several threads (numpy lets go of the
+# GIL while multiplying matrices).
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+import numpy as np
+from scipy.linalg import solve_triangular
+from . import progress as m2progress
+from . import profiling as m2profiling
+from . import tiling as m2tiling
+
+# The methods, in the order they are offered
+METHODS = ('three_point', 'onion')
+# The number of threads the rows are inverted with
+WORKERS = os.cpu_count() or 1
+# The number of rows multiplied in one go
+BAND = 256
+
+
+# For every radius i (rows) and every ring j (columns) the integrals of
+# 1/sqrt(x^2 - i^2) (a0) and x/sqrt(x^2 - i^2) (a1) over the part of the ring
+# [j - 1/2, j + 1/2] outside of the radius. Zero where j < i
+def _ring_integrals(n):
+    i = np.arange(n, dtype=np.float64)[:, np.newaxis]
+    j = np.arange(n, dtype=np.float64)[np.newaxis, :]
+    inside = j >= i
+    upper = j + 0.5
+    lower = np.maximum(j - 0.5, i)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        root_upper = np.sqrt(np.where(inside, upper**2 - i**2, 0))
+        root_lower = np.sqrt(np.where(inside, lower**2 - i**2, 0))
+        a0 = np.log((upper + root_upper) / (lower + root_lower))
+    a0[~inside] = 0
+    # The integral diverges at the axis, but it is multiplied by the slope
+    # there, which is zero by symmetry
+    a0[0, 0] = 0
+    a1 = np.where(inside, root_upper - root_lower, 0)
+    return a0, a1
+
+
+# The onion peeling matrix. The line-integrated density is W times the
+# densities of the rings, where W is made of the lengths of the rings'
+# chords, so the inverse of W gives the densities
+def _onion(n):
+    a0, a1 = _ring_integrals(n)
+    return solve_triangular(2*a1, np.eye(n))
+
+
+# The three-point matrix. Within ring j, the derivative of the line-integrated
+# density P is s + c*(x - j), with s = (P[j+1] - P[j-1])/2 and
+# c = P[j+1] - 2*P[j] + P[j-1]. The density at radius i is
+# -1/pi times the integral of the derivative over 1/sqrt(x^2 - i^2).
+# Beyond the edge P is taken to be zero, and P[-1] = P[1] by symmetry
+def _three_point(n):
+    a0, a1 = _ring_integrals(n)
+    j = np.arange(n)
+    curvature = a1 - j*a0
+    matrix = np.zeros((n, n+2))
+    # The columns are shifted by one, so that column 0 is P[-1]
+    matrix[:, 2:] += a0/2 + curvature
+    matrix[:, 1:-1] += -2*curvature
+    matrix[:, :-2] += -a0/2 + curvature
+    matrix[:, 2] += matrix[:, 0]
+    return matrix[:, 1:-1] / -np.pi
+
+
+# The matrix M for n pixels from the axis to the edge, such that the
+# densities are the line-integrated densities times M (both as rows).
+# The matrices are cached, as a map has many rows of the same length
+@lru_cache(maxsize=8)
+def operator(method, n, dtype='float64'):
+    if dtype != 'float64':
+        matrix = operator(method, n).astype(dtype)
+    elif method == 'onion':
+        matrix = np.ascontiguousarray(_onion(n).T)
+    elif method == 'three_point':
+        matrix = np.ascontiguousarray(_three_point(n).T)
+    else:
+        raise ValueError("Unknown Abel inversion method '{}'".format(method))
+    matrix.flags.writeable = False
+    return matrix
+
+
+# Invert one half of a band of rows, going outwards from the axis. The
+# profile is cut off where its data ends (at the first NaN from the axis),
+# and there is no result beyond that
+def _invert_half(half, matrix, scale):
+    valid = np.logical_and.accumulate(np.isfinite(half), axis=1)
+    result = np.where(valid, half, 0) @ matrix
+    result *= scale
+    result[~valid] = np.nan
+    return result
+
+
+# Invert a band of rows of the density map into out
+def _invert_band(density, out, rows, axis, method, scale):
+    band = density[rows]
+    dtype = out.dtype
+    if np.ma.isMaskedArray(band):
+        band = np.ma.filled(band.astype(dtype), fill_value=np.nan)
+    else:
+        band = np.asarray(band, dtype=dtype)
+    right = band[:, axis:]
+    out[rows, axis:] = _invert_half(right, operator(method, right.shape[1], dtype.name),
+                                    scale)
+    if axis > 0:
+        # The left half includes the axis too, but only the right half's
+        # value is kept there
+        left = band[:, axis::-1]
+        out[rows, :axis] = _invert_half(left, operator(method, left.shape[1], dtype.name),
+                                        scale)[:, :0:-1]
+    return rows.stop - rows.start
+
+
+# Abel-invert a line-integrated electron density map (in cm^-2, can be
+# masked, or have NaNs where there is no data), giving the electron density
+# (in cm^-3) as a float array with NaNs where there is no data. centre is
+# (row, column) in pixels, the column being the axis of symmetry, resolution
+# is in pixels per mm. The result is written into out if it fits (a new
+# array, or a memory-mapped file next to the map's, otherwise). Returns None
+# if the resolution isn't known
+@m2profiling.profiled("abel_invert", lambda result, density, *args, **kwargs: {
+    'pixels': density.size})
+def invert(density, centre, resolution, method='three_point', out=None,
+           workers=None, progress=None):
+    if density is None or resolution is None or method is None:
+        return None
+    progress = m2progress.wrap(progress)
+    if workers is None:
+        workers = WORKERS
+    height, width = density.shape
+    dtype = np.dtype(np.float32 if (np.ma.getdata(density).dtype == np.float32
+                                    and not isinstance(density, np.memmap))
+                     else np.float64)
+    if isinstance(density, np.memmap):
+        out = m2tiling.raster(density.shape, dtype, directory=os.path.dirname(density.filename),
+                              name="abel")
+    elif (not isinstance(out, np.ndarray) or np.ma.isMaskedArray(out)
+          or out.shape != density.shape or out.dtype != dtype):
+        out = np.empty(density.shape, dtype)
+    axis = min(max(int(round(centre[1])), 0), width-1)
+    # A pixel in cm
+    scale = 1 / (0.1 / resolution)
+    bands = [slice(start, min(start+BAND, height)) for start in range(0, height, BAND)]
+    progress.stage("Abel inversion", 0, 100, pixels=height*width)
+    done = 0
+    if workers > 1 and len(bands) > 1:
+        with ThreadPoolExecutor(workers) as executor:
+            futures = [executor.submit(_invert_band, density, out, rows, axis, method, scale)
+                       for rows in bands]
+            # The progress is reported from this thread, as the GUI's
+            # status bar can't be used from the others
+            for future in as_completed(futures):
+                done += future.result()
+                progress.update(done/height)
+    else:
+        for rows in bands:
+            done += _invert_band(density, out, rows, axis, method, scale)
+            progress.update(done/height)
+    if isinstance(out, np.memmap):
+        out.flush()
+    progress.done()
+    return out
@@ -0,0 +1,293 @@
+# Magic2 (https://github.com/jdranczewski/Magic2)
+# Copyright (C) 2018  Jakub Dranczewski, based on work by George Swadling
+
+# This work was carried out during a UROP with the MAGPIE Group,
+# Department of Physics, Imperial College London and was supported in part
+# by the Engineering and Physical Sciences Research Council (EPSRC) Grant
+# No. EP/N013379/1, by the U.S. Department of Energy (DOE) Awards
+# No. DE-F03-02NA00057 and No. DE-SC- 0001063
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# This file contains the headless (no GUI) processing of .m2 files, used by
+# the command line interface in __main__.py. Every shot goes through the same
+# processing graph as in the GUI: fringe reading, interpolation, subtraction
+# and plasma density calculation
+import os
+import glob
+import json
+import time
+import shutil
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from . import m2file
+from . import pipeline as m2pipeline
+from . import progress as m2progress
+from . import profiling as m2profiling
+from . import tiling as m2tiling
+
+# The maps that are written out, in the order they are calculated
+STAGES = ('background_map', 'plasma_map', 'subtracted', 'density', 'abel')
+
+
+# Turn a list of files and directories into a sorted list of .m2 files
+def find_shots(paths):
+    shots = []
+    for path in paths:
+        if os.path.isdir(path):
+            shots += sorted(glob.glob(os.path.join(path, "*.m2")))
+        else:
+            shots.append(path)
+    return shots
+
+
+# Convert a map into a float array with NaNs where there is no data,
+# which is what gets saved. NaN maps (see magic2/pipeline.py) are saved
+# as they are, as float32
+def to_nan_array(data, mask=None):
+    if m2pipeline.is_nan_array(data):
+        return data
+    if not np.ma.isMaskedArray(data):
+        # -1024 indicates an area where there is no data
+        data = np.ma.masked_equal(data, -1024.0)
+    if mask is not None:
+        data = np.ma.masked_where(mask == False, data)
+    return np.ma.filled(data.astype(float), fill_value=np.nan)
+
+
+# Save a map as a .npy array and (optionally) as a .png image with a pixel
+# for every pixel of the map. thumbnail is the size of an additional smaller
+# image (basename_thumb.png), None for none
+def save_map(data, basename, images=True, thumbnail=None):
+    np.save(basename + ".npy", data)
+    if images or thumbnail is not None:
+        # Imported here, so that a batch that doesn't write images doesn't
+        # need to load the image writing machinery
+        from . import graphics as m2graphics
+        from . import export as m2export
+        if images:
+            m2export.save_png(basename + ".png", data, m2graphics.cmap)
+        if thumbnail is not None:
+            m2export.save_png(basename + "_thumb.png", data, m2graphics.cmap,
+                              max_size=thumbnail)
+
+
+# Process a single .m2 file, writing the results into the output directory.
+# method is 'fast' or 'exact', the keyword arguments override the shot
+# options stored in the file (offset may also be 'auto'). Returns a report
+# dictionary with the timings of all the stages. If verbose is True the
+# progress is printed to the terminal, progress_log is an optional file
+# the progress events are written to as JSON. If profile is True, a trace
+# of the time and memory used by every stage is written next to the results.
+# out_of_core is an optional directory for the memory-mapped arrays of the
+# out-of-core mode (see magic2/tiling.py), budget its memory budget in bytes
+# and tile_workers the number of processes the tiles are interpolated with.
+# thumbnails is the largest size of the thumbnail images, None for none.
+# If nan_maps is True the maps are kept as float32 with NaNs where there
+# is no data (the out-of-core mode always uses its own float64 files).
+# abel is the Abel inversion method (see magic2/abel.py), None for none.
+# registration is the mode the background is lined up with the plasma image
+# in (see magic2/registration.py), None if they are lined up already
+def process_shot(filename, output, method='fast', images=True, thumbnails=None,
+                 verbose=False, progress_log=None, profile=False, out_of_core=None,
+                 budget=None, tile_workers=None, nan_maps=False, abel=None,
+                 registration=None, **overrides):
+    name = os.path.splitext(os.path.basename(filename))[0]
+    report = {'file': filename, 'name': name, 'ok': False, 'error': None,
+              'stages': {}, 'outputs': [], 'warnings': []}
+    storage = None
+    if out_of_core is not None:
+        storage = os.path.join(out_of_core, name)
+        # The maps are processed tile by tile, and the images (which would
+        # need the whole map in memory) are not written, only the thumbnails
+        method = 'tiled'
+        images = False
+        if budget is not None:
+            m2tiling.BUDGET = budget
+        if tile_workers is not None:
+            m2tiling.WORKERS = tile_workers
+    start = time.perf_counter()
+    log = None
+    if progress_log is not None:
+        log = open(progress_log, 'a')
+        progress = m2progress.Progress(m2progress.JSONLog(log, shot=name))
+    elif verbose:
+        progress = m2progress.Progress(m2progress.TerminalPrinter(name + ": "))
+    else:
+        progress = m2progress.Progress()
+    if profile:
+        m2profiling.enable()
+    try:
+        # Read the file and recreate the canvases
+        t0 = time.perf_counter()
+        shot = m2file.read(filename)
+        graph = m2pipeline.shot_graph(progress)
+        graph.set('nan_maps', nan_maps)
+        for env in ('background', 'plasma'):
+            if shot[env] is not None:
+                canvas, fringes = m2file.load_canvas(*shot[env], progress=progress,
+                                                     env=env, storage=storage)
+                m2pipeline.set_canvas(graph, env, canvas)
+                graph.set(env + '_method', method)
+        report['stages']['read'] = time.perf_counter() - t0
+        # Set the shot options, letting the command line override the file
+        for option in ('depth', 'wavelength', 'double', 'resolution', 'centre'):
+            value = overrides.get(option)
+            graph.set(option, value if value is not None else shot[option])
+        graph.set('abel_method', abel)
+        graph.set('registration', registration)
+        offset = overrides.get('offset')
+        if offset is None:
+            offset = shot['offset'] if shot['offset'] is not None else 0
+        # Run the stages one by one, so that they can be timed separately
+        for stage in STAGES:
+            if stage == 'density':
+                if graph.nodes['wavelength'].value is None:
+                    report['stages'][stage] = None
+                    continue
+                if offset == 'auto':
+                    # Like the 'Auto' button in the GUI, set the lowest
+                    # fringe shift to be zero
+                    offset = float(np.nanmin(graph.get('subtracted')))
+                graph.set('offset', offset)
+            if stage == 'abel' and abel is None:
+                report['stages'][stage] = None
+                continue
+            if stage == 'abel' and not graph.is_valid('density'):
+                report['stages'][stage] = None
+                report['warnings'].append(
+                    "The Abel inversion was skipped, as there is no plasma density "
+                    "map (is the wavelength set?)")
+                continue
+            if stage == 'abel' and graph.nodes['resolution'].value is None:
+                # The radial density needs the size of the pixels
+                report['stages'][stage] = None
+                report['warnings'].append(
+                    "The Abel inversion was skipped, as the resolution isn't known "
+                    "(set it with --resolution)")
+                continue
+            if stage == 'subtracted' and graph.get('plasma_map') is not None:
+                # Line up the background first, timed on its own
+                t0 = time.perf_counter()
+                estimate = graph.get('registration_estimate')
+                if estimate is not None:
+                    report['registration'] = {'transform': estimate.transform,
+                                              'confidence': estimate.confidence,
+                                              'accepted': estimate.accepted}
+                    if not estimate.accepted:
+                        report['warnings'].append(
+                            "The background could not be registered with enough "
+                            "confidence, so it was left as it is")
+                graph.get('aligned_background')
+                report['stages']['registration'] = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            value = graph.get(stage)
+            report['stages'][stage] = time.perf_counter() - t0
+            if value is None:
+                continue
+            t0 = time.perf_counter()
+            if storage is not None:
+                # Converted a band at a time, into another memory-mapped file
+                mask = None
+                if stage.endswith('_map'):
+                    mask = graph.nodes[stage.split("_")[0] + '_canvas'].value.mask
+                value = m2tiling.to_nan(value, mask,
+                                        graph.nodes['offset'].value if stage == 'subtracted' else 0,
+                                        directory=storage, name=stage)
+            elif stage.endswith('_map'):
+                value = to_nan_array(value, graph.nodes[stage.split("_")[0] + '_canvas'].value.mask)
+            elif stage == 'subtracted':
+                value = to_nan_array(value - graph.nodes['offset'].value)
+            else:
+                value = to_nan_array(value)
+            basename = os.path.join(output, name + "_" + stage)
+            save_map(value, basename, images, thumbnails)
+            report['outputs'].append(basename + ".npy")
+            report['stages']['write_' + stage] = time.perf_counter() - t0
+        report['ok'] = True
+    except Exception:
+        report['error'] = traceback.format_exc()
+    finally:
+        if log is not None:
+            log.close()
+        if storage is not None:
+            # The memory-mapped files are only needed while processing. They
+            # have to be let go of first, Windows can't delete mapped files
+            graph = canvas = fringes = value = None
+            shutil.rmtree(storage, ignore_errors=True)
+        if profile:
+            trace = os.path.join(output, name + "_profile.json")
+            m2profiling.write(trace)
+            m2profiling.disable()
+            report['profile'] = trace
+    report['total'] = time.perf_counter() - start
+    # The timings of the individual steps within the stages
+    report['substages'] = progress.timings
+    return report
+
+
+# Process many shots, spreading them over a pool of worker processes.
+# workers=None uses all the available processors
+def process_many(filenames, output, workers=None, callback=None, **kwargs):
+    os.makedirs(output, exist_ok=True)
+    reports = []
+    if workers == 1 or len(filenames) <= 1:
+        # There's no point in starting another process
+        for filename in filenames:
+            report = process_shot(filename, output, **kwargs)
+            reports.append(report)
+            if callback is not None:
+                callback(report)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(process_shot, filename, output, **kwargs): filename
+                       for filename in filenames}
+            for future in as_completed(futures):
+                try:
+                    report = future.result()
+                except Exception as error:
+                    # This happens if a worker dies (for example when it runs
+                    # out of memory), the other shots can still be processed
+                    filename = futures[future]
+                    report = {'file': filename, 'ok': False, 'stages': {},
+                              'outputs': [], 'total': 0, 'error': repr(error),
+                              'name': os.path.splitext(os.path.basename(filename))[0]}
+                reports.append(report)
+                if callback is not None:
+                    callback(report)
+    # Keep the reports in the order the files were given in
+    order = {filename: i for i, filename in enumerate(filenames)}
+    reports.sort(key=lambda report: order[report['file']])
+    return reports
+
+
+# Write the summary report as a JSON file
+def write_summary(reports, filename, settings=None):
+    with open(filename, 'w') as f:
+        json.dump({'settings': settings, 'shots': reports}, f, indent=2)
+
+
+# Format a one line summary of a shot's processing
+def format_report(report):
+    if not report['ok']:
+        return "{}: FAILED ({:.2f} s)\n{}".format(report['name'], report['total'],
+                                                 report['error'])
+    stages = ", ".join("{} {:.2f} s".format(stage, report['stages'][stage])
+                       for stage in ('read',) + STAGES[:2] + ('registration',) + STAGES[2:]
+                       if report['stages'].get(stage) is not None)
+    line = "{}: {:.2f} s ({})".format(report['name'], report['total'], stages)
+    for warning in report.get('warnings', []):
+        line += "\n  warning: " + warning
+    return line
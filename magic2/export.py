@@ -0,0 +1,279 @@
+# Magic2 (https://github.com/jdranczewski/Magic2)
+# Copyright (C) 2018  Jakub Dranczewski, based on work by George Swadling
+
+# This work was carried out during a UROP with the MAGPIE Group,
+# Department of Physics, Imperial College London and was supported in part
+# by the Engineering and Physical Sciences Research Council (EPSRC) Grant
+# No. EP/N013379/1, by the U.S. Department of Energy (DOE) Awards
+# No. DE-F03-02NA00057 and No. DE-SC- 0001063
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# This file writes maps and lineouts to files, in a format chosen by the
+# file's extension:
+#   .npy        float32 array, with the metadata in a .json file next to it
+#               (named like the file, plus .json)
+#   .npz        float32 array ('data') and the metadata as JSON ('metadata')
+#   .raw, .f32  raw little-endian float32, with a .json file describing it
+#   .tif, .tiff 16-bit greyscale TIFF, the values scaled to fit (the scaling
+#               is stored in the metadata)
+#   anything else (like .csv) is written as text (at full, float64
+#   precision), a block of rows at a time, so that memory use doesn't grow
+#   with the size of the map
+# Areas without data (masked, or NaN) are written as NaN (0 in TIFFs).
+import json
+import os
+import numpy as np
+from . import progress as m2progress
+
+# The extensions of the binary formats
+BINARY = ('.npy', '.npz', '.raw', '.f32', '.tif', '.tiff')
+# How many values are written to a text file at a time
+CHUNK = 2**20
+
+
+# The data as floats of the given type with NaNs where there is no data,
+# for a band of rows (all of them by default)
+def _as_float(data, rows=slice(None), dtype=np.float64):
+    band = data[rows]
+    if np.ma.isMaskedArray(band):
+        return np.ma.filled(band.astype(dtype), fill_value=np.nan)
+    return np.asarray(band, dtype=dtype)
+
+
+# The same, as float32 (for the binary formats)
+def _as_float32(data, rows=slice(None)):
+    return _as_float(data, rows, np.float32)
+
+
+# The name of the JSON file accompanying filename (like map.raw.json)
+def sidecar_name(filename):
+    return filename + ".json"
+
+
+def _write_sidecar(filename, metadata):
+    with open(sidecar_name(filename), 'w') as f:
+        json.dump(metadata, f, indent=1, default=_jsonable)
+
+
+# json can't serialise numpy scalars and arrays on its own
+def _jsonable(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError("{} is not JSON serialisable".format(type(value).__name__))
+
+
+# Save data (a 2D array, can be masked) to filename, in the format given by
+# its extension. metadata is an optional dictionary (shot options, units...)
+# stored with the binary formats, or as the header of text files. fmt is
+# the number format used in text files
+def save(filename, data, metadata=None, fmt="%.18e", delimiter=",",
+         progress=None):
+    progress = m2progress.wrap(progress)
+    metadata = dict(metadata or {})
+    metadata['shape'] = list(np.shape(data))
+    extension = os.path.splitext(filename)[1].lower()
+    progress.stage("Exporting", 0, 100, pixels=int(np.prod(np.shape(data))))
+    if extension == '.npy':
+        metadata['dtype'] = 'float32'
+        np.save(filename, _as_float32(data))
+        _write_sidecar(filename, metadata)
+    elif extension == '.npz':
+        np.savez(filename, data=_as_float32(data),
+                 metadata=json.dumps(metadata, default=_jsonable))
+    elif extension in ('.raw', '.f32'):
+        metadata['dtype'] = 'float32'
+        metadata['byte_order'] = 'little'
+        with open(filename, 'wb') as f:
+            for rows, fraction in _bands(data):
+                f.write(_as_float32(data, rows).astype('<f4').tobytes())
+                progress.update(fraction)
+        _write_sidecar(filename, metadata)
+    elif extension in ('.tif', '.tiff'):
+        save_tiff(filename, data, metadata)
+    else:
+        save_text(filename, data, metadata, fmt, delimiter, progress)
+    progress.done()
+
+
+# Split the rows of data into bands of about CHUNK values. Yields the slice
+# of rows and the fraction of the data written after it
+def _bands(data):
+    height = np.shape(data)[0]
+    width = int(np.prod(np.shape(data)[1:])) if np.ndim(data) > 1 else 1
+    band = max(1, CHUNK // max(width, 1))
+    for start in range(0, height, band):
+        stop = min(start+band, height)
+        yield slice(start, stop), stop / max(height, 1)
+
+
+# Write data as text, a band of rows at a time. The metadata goes into
+# the header, as "# key: value" lines
+def save_text(filename, data, metadata=None, fmt="%.18e", delimiter=",",
+              progress=None):
+    progress = m2progress.wrap(progress)
+    with open(filename, 'w') as f:
+        for key, value in (metadata or {}).items():
+            f.write("# {}: {}\n".format(key, json.dumps(value, default=_jsonable)))
+        for rows, fraction in _bands(data):
+            np.savetxt(f, _as_float(data, rows) if np.ndim(data) > 1
+                       else _as_float(data, rows)[:, np.newaxis],
+                       fmt=fmt, delimiter=delimiter)
+            progress.update(fraction)
+
+
+# Write data as a 16-bit greyscale TIFF. The values are scaled so that the
+# smallest one is 1 and the largest one 65535 (0 means no data), and the
+# scaling is stored in the metadata: value = scale * (pixel - 1) + minimum.
+# The metadata goes into the TIFF's description and into a .json file
+def save_tiff(filename, data, metadata=None):
+    # Pillow comes with matplotlib
+    from PIL import Image
+    values = _as_float32(data)
+    valid = np.isfinite(values)
+    minimum = float(values[valid].min()) if valid.any() else 0.0
+    maximum = float(values[valid].max()) if valid.any() else 0.0
+    scale = (maximum - minimum) / 65534 if maximum > minimum else 1.0
+    pixels = np.zeros(values.shape, dtype=np.uint16)
+    pixels[valid] = np.round((values[valid] - minimum) / scale) + 1
+    metadata = dict(metadata or {})
+    metadata.update({'minimum': minimum, 'scale': scale,
+                     'formula': "value = scale * (pixel - 1) + minimum, 0 = no data"})
+    description = json.dumps(metadata, default=_jsonable)
+    Image.fromarray(pixels).save(filename, tiffinfo={270: description})
+    _write_sidecar(filename, metadata)
+
+
+# Read a map written by save(), returning the data (NaNs where there is no
+# data) and the metadata
+def load(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.npz':
+        with np.load(filename) as f:
+            return f['data'], json.loads(str(f['metadata']))
+    metadata = {}
+    if extension not in BINARY:
+        # The metadata is in the header of text files
+        with open(filename) as f:
+            for line in f:
+                if not line.startswith("# "):
+                    break
+                key, value = line[2:].split(": ", 1)
+                metadata[key] = json.loads(value)
+        return np.loadtxt(filename, delimiter=",", ndmin=2), metadata
+    if os.path.exists(sidecar_name(filename)):
+        with open(sidecar_name(filename)) as f:
+            metadata = json.load(f)
+    if extension == '.npy':
+        return np.load(filename), metadata
+    if extension in ('.raw', '.f32'):
+        return np.fromfile(filename, dtype='<f4').reshape(metadata['shape']), metadata
+    if extension in ('.tif', '.tiff'):
+        from PIL import Image
+        pixels = np.array(Image.open(filename)).astype(np.float32)
+        data = metadata['scale'] * (pixels - 1) + metadata['minimum']
+        data[pixels == 0] = np.nan
+        return data, metadata
+
+
+# The colours of a colormap as a lookup table of n RGBA bytes, followed by
+# the colours for values under and over the range, and for no data
+def colour_table(cmap, n=256):
+    table = np.empty((n+3, 4), dtype=np.uint8)
+    table[:n] = cmap(np.linspace(0, 1, n), bytes=True)
+    # These are RGBA floats between 0 and 1
+    for i, colour in enumerate((cmap.get_under(), cmap.get_over(), cmap.get_bad())):
+        table[n+i] = np.round(np.array(colour) * 255)
+    return table
+
+
+# The range of the data (ignoring the areas without data), unless given
+def data_range(data, vmin=None, vmax=None):
+    if vmin is None or vmax is None:
+        values = _as_float32(data)
+        values = values[np.isfinite(values)]
+        if values.size:
+            vmin = float(values.min()) if vmin is None else vmin
+            vmax = float(values.max()) if vmax is None else vmax
+    return (0.0 if vmin is None else vmin), (1.0 if vmax is None else vmax)
+
+
+# Map data through a colormap, giving an RGBA image with a pixel for every
+# data pixel. norm is a matplotlib Normalize (like the one of the image on
+# the screen), or vmin and vmax can be given instead (the range of the data
+# by default). The work is done a band of rows at a time
+def colour_image(data, cmap, norm=None, vmin=None, vmax=None, n=256):
+    table = colour_table(cmap, n)
+    if norm is None:
+        vmin, vmax = data_range(data, vmin, vmax)
+        scale = 1.0 / (vmax - vmin) if vmax > vmin else 0.0
+        norm = lambda band: (band - vmin) * scale
+    image = np.empty(np.shape(data) + (4,), dtype=np.uint8)
+    for rows, fraction in _bands(data):
+        values = np.ma.filled(np.ma.masked_invalid(
+            np.asarray(norm(_as_float32(data, rows)), dtype=np.float64)), np.nan)
+        missing = np.isnan(values)
+        values[missing] = 0
+        # The same as matplotlib: a value of exactly 1 gets the last colour
+        index = np.floor(np.clip(values, -1, 2) * n).astype(np.int64)
+        index[values == 1] = n-1
+        index[values < 0] = n
+        index[values > 1] = n+1
+        index[missing] = n+2
+        image[rows] = table[index]
+    return image
+
+
+# Add a vertical colorbar strip to the right of an RGBA image, separated
+# by a transparent gap. The top of the strip is the top of the colour range
+def add_colorbar(image, cmap, width=None, n=256):
+    height = image.shape[0]
+    if width is None:
+        width = max(8, image.shape[1] // 40)
+    gap = max(2, width // 2)
+    strip = colour_table(cmap, n)[:n][
+        ((1 - (np.arange(height) + 0.5) / height) * n).astype(np.int64)]
+    result = np.zeros((height, image.shape[1] + gap + width, 4), dtype=np.uint8)
+    result[:, :image.shape[1]] = image
+    result[:, image.shape[1]+gap:] = strip[:, np.newaxis]
+    return result
+
+
+# Save data as a PNG with exactly one image pixel per data pixel, coloured
+# with cmap, without drawing a matplotlib figure. norm, vmin and vmax are as
+# in colour_image. colorbar adds a colour strip on the right (the range is
+# stored in the PNG's text fields, as are the entries of metadata).
+# max_size shrinks the image (by taking every n-th pixel) so that neither
+# side is longer than that, for thumbnails
+def save_png(filename, data, cmap, norm=None, vmin=None, vmax=None,
+             colorbar=False, metadata=None, max_size=None):
+    # Pillow comes with matplotlib
+    from PIL import Image
+    from PIL.PngImagePlugin import PngInfo
+    if max_size is not None and max(np.shape(data)) > max_size:
+        step = -(-max(np.shape(data)) // max_size)
+        data = data[::step, ::step]
+    if norm is not None:
+        vmin, vmax = norm.vmin, norm.vmax
+    else:
+        vmin, vmax = data_range(data, vmin, vmax)
+    image = colour_image(data, cmap, norm, vmin, vmax)
+    if colorbar:
+        image = add_colorbar(image, cmap)
+    info = PngInfo()
+    for key, value in dict(metadata or {}, vmin=vmin, vmax=vmax).items():
+        info.add_text(str(key), json.dumps(value, default=_jsonable))
+    Image.fromarray(image, 'RGBA').save(filename, pnginfo=info)
@@ -22,7 +22,7 @@
 
 # This file contains functionality related to dealing with fringes
 import numpy as np
-import matplotlib.pyplot as plt
+from . import profiling as m2profiling
 
 
 class Fringes():
@@ -50,8 +50,12 @@ class Fringe():
 # representation of the interferogram (where Truths are the Fringe
 # pixels) and an optional graph parameter that determines whether
 # results should be plotted (useful for debugging). Filter is the
-# minimum length a fringe should have to be detected
-def read_fringes(fringes, canvas, graph=False, filter=5, phases=None):
+# minimum length a fringe should have to be detected. progress is an optional
+# magic2.progress.Progress object
+@m2profiling.profiled("read_fringes", lambda result, fringes, canvas, *args, **kwargs: {
+    'pixels': canvas.fringes_image.size, 'fringes': len(fringes.list)})
+def read_fringes(fringes, canvas, graph=False, filter=5, phases=None,
+                 progress=None):
     # Pad the image with zeroes on each edge. This solves the issue
     # of searching for neighbours and reaching beyond the edges
     # without being too complicated. This is later accounted for
@@ -61,8 +65,11 @@ def read_fringes(fringes, canvas, graph=False, filter=5, phases=None):
     # Note that the coordinates will be in the order [y, x]
     # as this is the convention used for matrices: [row, column].
     black_points = np.transpose(np.nonzero(fringes_image))
+    initial_len = len(black_points)
     # While there are still points to process
     if graph:
+        # Only imported when needed, pyplot is slow to load
+        import matplotlib.pyplot as plt
         plt.imshow(fringes_image)
     fringe_index = -1
     while len(black_points):
@@ -118,5 +125,8 @@ def read_fringes(fringes, canvas, graph=False, filter=5, phases=None):
                 points = np.array(points)
                 plt.plot(points[:, 1], points[:, 0])
         black_points = np.transpose(np.nonzero(fringes_image))
+        if progress is not None:
+            progress.update(1 - len(black_points)/initial_len,
+                            fringes=fringe_index+1)
     if graph:
         plt.show()
@@ -21,27 +21,29 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib
-from matplotlib.colors import Normalize
 from copy import copy
+from . import profiling as m2profiling
 
 
 class Canvas():
-    def __init__(self, filename, fi=None, m=None, imshow=None):
+    # storage is an optional directory. If it's given, the large arrays are
+    # kept in memory-mapped files there instead of in memory (see
+    # magic2/tiling.py for the out-of-core processing)
+    def __init__(self, filename, fi=None, m=None, imshow=None, storage=None):
         # An image is loaded, and only its first colour component is taken
         # out of red, green, blue, alpha.
         # The .png images supplied are greyscale.
         self.error = False
         try:
             if filename != 'dump' and fi is None:
+                from matplotlib.image import imread
                 # The image may have 3-4 channels if its RGB(A), we only
                 # need one of them
                 try:
-                    image = plt.imread(filename.name)[:, :, 0]
+                    image = imread(filename.name)[:, :, 0]
                 # If the image is greyscale, just take the whole thing
                 except IndexError:
-                    image = plt.imread(filename.name)
+                    image = imread(filename.name)
                 # Fringes are black, extract them from the image
                 self.fringes_image = image == 0
                 # This is the user defined mask, it was grey (so neither black
@@ -51,6 +53,10 @@ class Canvas():
                 # This uses a provide mask and image (for example from an .m2 file)
                 self.fringes_image = fi
                 self.mask = m
+            if storage is not None:
+                self._create_rasters(storage)
+                self.imshow = imshow
+                return
             # This will store only the labelled fringes, currently empty
             self.fringes_image_clean = np.zeros_like(self.fringes_image)-0
             # -1024 indicates an area where there is no data
@@ -76,9 +82,29 @@ class Canvas():
         except OSError:
             self.error = True
 
+    # Create the same arrays as above, but as memory-mapped files
+    def _create_rasters(self, storage):
+        from . import tiling as m2tiling
+        shape = self.fringes_image.shape
+        # The dtypes are the same as for the in-memory arrays
+        integer = (np.zeros(1, dtype=self.fringes_image.dtype)-0).dtype
+        self.fringes_image_clean = m2tiling.raster(shape, integer, 0, storage, "clean")
+        self.fringe_phases_visual = m2tiling.raster(shape, integer, -1024, storage, "visual")
+        self.fringe_phases = m2tiling.raster(shape, integer, -1024, storage, "phases")
+        self.fringe_indices = m2tiling.raster(shape, integer, -1, storage, "indices")
+        self.x = m2tiling.raster(shape, np.int64, None, storage, "x")
+        self.y = m2tiling.raster(shape, np.int64, None, storage, "y")
+        self.xy = m2tiling.raster((shape[0]*shape[1], 2), np.int64, None, storage, "xy")
+        m2tiling.fill_coordinates(self)
+        self.interpolation_done = False
+        self.interpolated = m2tiling.raster(shape, np.float64, -1024.0, storage, "interpolated")
+
 
 # This function can be used to draw the fringes on a given canvas
 # at a specified line width. 'fringes' is a Fringes object.
+@m2profiling.profiled("render_fringes", lambda result, fringes, canvas, width=0, indices=None: {
+    'pixels': canvas.fringes_image.size,
+    'fringes': len(indices) if indices else len(fringes.list)})
 def render_fringes(fringes, canvas, width=0, indices=None):
     # Passing indices as an argument allows us to render only
     # the necessary subset of fringes.
@@ -125,11 +151,24 @@ def clear_visual(canvas):
     canvas.fringe_phases_visual = np.zeros_like(canvas.fringes_image)-1024
 
 
-# Define a normalization and a colour map that can be used with
-# matplotlib's imshow to show phase in a good looking way and on
-# a white background.
-cmap = copy(matplotlib.colormaps['plasma'])
-# White is for masking
-cmap.set_bad('white', 1.0)
-# Black is for unlabelled fringes
-cmap.set_under('black', 1.0)
+# Define a colour map that can be used with matplotlib's imshow to show
+# phase in a good looking way and on a white background.
+def make_cmap(name='plasma'):
+    import matplotlib
+    cmap = copy(matplotlib.colormaps[name])
+    # White is for masking
+    cmap.set_bad('white', 1.0)
+    # Black is for unlabelled fringes
+    cmap.set_under('black', 1.0)
+    return cmap
+
+
+# The default colour map (m2graphics.cmap) is only created when it is first
+# used, so that headless code that never draws anything doesn't have to
+# import matplotlib
+def __getattr__(name):
+    if name == 'cmap':
+        global cmap
+        cmap = make_cmap()
+        return cmap
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -23,12 +23,12 @@
 import numpy as np
 import scipy.special as special
 from . import graphics as m2graphics
-from matplotlib.animation import FuncAnimation
+from . import profiling as m2profiling
 
 
 # This class stores some data about the current labelling operation
 class Labeller():
-    def __init__(self, options=None):
+    def __init__(self, options=None, on_change=None):
         # List of the points of the line being drawn
         self.points = []
         # Is the control key pressed?
@@ -39,6 +39,8 @@ class Labeller():
         self.options = options
         # The animator object
         self.ani = None
+        # A function called every time the labelling changes
+        self.on_change = on_change
 
 
 # This function is used to handle the user pressing a mouse key
@@ -64,6 +66,8 @@ def onclick(event, labeller, line_plot, temp_line, fringes, canvas, fig, ax, ani
 
 
 # This uses the set of points chosen by the user to label the fringes
+@m2profiling.profiled("label_fringes", lambda result, labeller, fringes, *args: {
+    'line_points': len(labeller.points), 'fringes': len(fringes.list)})
 def label_fringes(labeller, fringes, canvas, fig, ax):
     # Create two empty lists of x and y coordinates that we will be
     # iterating over
@@ -162,6 +166,8 @@ def label_fringes(labeller, fringes, canvas, fig, ax):
     else:
         width = 3
     m2graphics.render_fringes(fringes, canvas, width=width, indices=fix_indices)
+    if labeller.on_change is not None and len(fix_indices):
+        labeller.on_change()
     canvas.imshow.set_data(np.ma.masked_where(canvas.fringe_phases_visual == -1024, canvas.fringe_phases_visual))
     # The small increment is included to make the limits work when all fringes
     # are unlabelled
@@ -220,8 +226,10 @@ def ani_update(i, line_plot, temp_line, imshow, prev_lim, ax, labeller):
 
 # This sets up the labeller object, the line that is drawn, as well as
 # attaches all the event handlers
-def label(fringes, canvas, fig, ax, master=None, options=None, imshow=None, mframe=None):
-    labeller = Labeller(options=options)
+def label(fringes, canvas, fig, ax, master=None, options=None, imshow=None,
+          mframe=None, on_change=None):
+    from matplotlib.animation import FuncAnimation
+    labeller = Labeller(options=options, on_change=on_change)
     line_plot, = ax.plot([], [], "--", animated=True)
     temp_line, = ax.plot([], [], "--", animated=True)
     b0 = fig.canvas.mpl_connect('button_press_event',
@@ -234,6 +242,8 @@ def label(fringes, canvas, fig, ax, master=None, options=None, imshow=None, mfra
     b3 = fig.canvas.mpl_connect('key_release_event',
                                 lambda event: onrelease(event, labeller))
     labeller.binds = [b0, b1, b2, b3]
+    # The lines are removed from the axes when the labelling stops
+    labeller.lines = [line_plot, temp_line]
     # Create an animation function that updates the state of the line
     # that is being drawn. blit is used to speed things up. It's cache
     # has to be cleared when fringe labelling is changed
@@ -257,4 +267,6 @@ def stop_labelling(fig, labeller, mframe=None):
         mframe.ani = None
     for bind in labeller.binds:
         fig.canvas.mpl_disconnect(bind)
+    for line in labeller.lines:
+        line.remove()
     del labeller
@@ -0,0 +1,118 @@
+# Magic2 (https://github.com/jdranczewski/Magic2)
+# Copyright (C) 2018  Jakub Dranczewski, based on work by George Swadling
+
+# This work was carried out during a UROP with the MAGPIE Group,
+# Department of Physics, Imperial College London and was supported in part
+# by the Engineering and Physical Sciences Research Council (EPSRC) Grant
+# No. EP/N013379/1, by the U.S. Department of Energy (DOE) Awards
+# No. DE-F03-02NA00057 and No. DE-SC- 0001063
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# This file handles reading and writing .m2 files. We are not saving all
+# the data, not even the interpolations, as they greatly increase the file
+# size required (pictures are big). What we do save are the boolean array
+# representing fringes and the user-defined mask, and a list of all the
+# assigned phases. As the fringe-reading process is completely
+# deterministic, the labelling will be assigned in the correct order
+import pickle
+import gzip
+import numpy as np
+from . import graphics as m2graphics
+from . import fringes as m2fringes
+from . import progress as m2progress
+
+# The names of the shot options, in the order they are stored in the file
+SHOT_OPTIONS = ('offset', 'namecore', 'resolution', 'depth', 'wavelength',
+                'double', 'centre')
+
+
+# Read an .m2 file. Returns a dictionary with 'background' and 'plasma'
+# entries (each either None or a (fringes_image, mask, phases) tuple),
+# as well as all the shot options
+def read(filename):
+    # We need to use gzip to decompress the .m2 file
+    with gzip.open(filename, 'rb') as f:
+        dump = pickle.load(f)
+    shot = {}
+    for env, i in (('background', 0), ('plasma', 3)):
+        if dump[i] is not None:
+            shot[env] = (dump[i], dump[i+1], dump[i+2])
+        else:
+            shot[env] = None
+    for i, name in enumerate(SHOT_OPTIONS):
+        # Files saved before v1.02 do not store the centre
+        try:
+            shot[name] = dump[6+i]
+        except IndexError:
+            shot[name] = None
+    if shot['centre'] is None:
+        shot['centre'] = [0, 0]
+    return shot
+
+
+# Write an .m2 file. background and plasma are (Canvas, Fringes) tuples or
+# None, the shot options are passed as keyword arguments
+def write(filename, background=None, plasma=None, **options):
+    dump = []
+    for objects in (background, plasma):
+        if objects is None or objects[0] is None:
+            dump += [None, None, None]
+        else:
+            canvas, fringes = objects
+            dump.append(canvas.fringes_image)
+            dump.append(canvas.mask)
+            dump.append([fringe.phase for fringe in fringes.list])
+    for name in SHOT_OPTIONS:
+        dump.append(options.get(name))
+    # We use gzip to make the file smaller. Normal pickling produced files
+    # that were around 30MB, while the compressed version of the same data
+    # is 188KB
+    with gzip.open(filename, 'wb') as f:
+        pickle.dump(dump, f)
+
+
+# Recreate the Canvas and Fringes objects from the data stored in
+# an .m2 file, reading the fringes and assigning the saved phases as we go.
+# progress is an optional magic2.progress.Progress object (or a status bar),
+# start is added to the percentages reported to it. storage is an optional
+# directory to keep the Canvas arrays in (see magic2/tiling.py)
+def load_canvas(fringes_image, mask, phases, width=0, progress=None, env="",
+                start=0, storage=None):
+    if progress is not None:
+        progress = m2progress.wrap(progress)
+        progress.stage("Reading "+env+" canvas", start + 10, start + 20,
+                       pixels=fringes_image.size)
+    # Create a new Canvas object
+    canvas = m2graphics.Canvas('dump', fi=fringes_image, m=mask,
+                               storage=storage)
+    if progress is not None:
+        progress.stage("Finding "+env+" fringes", start + 20, start + 35)
+    # Create a new fringes object
+    fringes = m2fringes.Fringes()
+    # Set the max and min for the colormap to have a correct scale
+    labelled = [phase for phase in phases if phase != -2048.0]
+    if len(labelled):
+        fringes.min = np.amin(labelled)
+        fringes.max = np.amax(labelled)
+    # Read the fringes, assigning phases as we go
+    m2fringes.read_fringes(fringes, canvas, phases=phases, progress=progress)
+    if progress is not None:
+        progress.stage("Rendering "+env+" fringes", start + 35, start + 45,
+                       fringes=len(fringes.list))
+    # Render the fringes
+    m2graphics.render_fringes(fringes, canvas, width=width)
+    if progress is not None:
+        progress.finish()
+    return canvas, fringes
@@ -0,0 +1,231 @@
+# Magic2 (https://github.com/jdranczewski/Magic2)
+# Copyright (C) 2018  Jakub Dranczewski, based on work by George Swadling
+
+# This work was carried out during a UROP with the MAGPIE Group,
+# Department of Physics, Imperial College London and was supported in part
+# by the Engineering and Physical Sciences Research Council (EPSRC) Grant
+# No. EP/N013379/1, by the U.S. Department of Energy (DOE) Awards
+# No. DE-F03-02NA00057 and No. DE-SC- 0001063
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# This file reports how much memory the objects making up a shot use: every
+# array held by a Canvas, the fringe points stored by Fringes, the
+# Triangulation and the derived maps in the processing graph. Arrays that
+# share their memory with one that has already been counted (like a view,
+# or the interpolated map that is both in the Canvas and in the graph)
+# are only counted once.
+import sys
+import numpy as np
+
+# The Canvas arrays, in the order they are created
+CANVAS_ARRAYS = ('fringes_image', 'mask', 'fringes_image_clean',
+                 'fringe_phases_visual', 'fringe_phases', 'fringe_indices',
+                 'x', 'y', 'xy', 'interpolated')
+
+
+# Find the array that actually owns an array's memory
+def _owner(array):
+    while isinstance(array.base, np.ndarray):
+        array = array.base
+    return array
+
+
+class Report():
+    def __init__(self):
+        # Every entry is a dictionary with the owner (like 'plasma canvas'),
+        # the name, the size in bytes, the dtype and shape (for arrays),
+        # and what it shares its memory with (if anything)
+        self.entries = []
+        # Maps the ids of the arrays already counted to their entries
+        self._seen = {}
+        # Keep the counted arrays alive, so that their ids aren't reused
+        self._keep = []
+
+    # Add an array. If its memory has been counted already, it's listed
+    # with a size of 0
+    def add_array(self, owner, name, array):
+        if array is None:
+            return
+        if np.ma.isMaskedArray(array):
+            self.add_array(owner, name, array.data)
+            if array.mask is not np.ma.nomask:
+                self.add_array(owner, name + ".mask", array.mask)
+            return
+        array = np.asarray(array)
+        base = _owner(array)
+        entry = {'owner': owner, 'name': name, 'bytes': base.nbytes,
+                 'dtype': str(array.dtype), 'shape': list(array.shape),
+                 'shared': None}
+        if id(base) in self._seen:
+            first = self._seen[id(base)]
+            entry['bytes'] = 0
+            entry['shared'] = first['owner'] + " " + first['name']
+        else:
+            self._seen[id(base)] = entry
+            self._keep.append(base)
+        self.entries.append(entry)
+
+    # Add something that isn't an array, with an estimated size
+    def add_object(self, owner, name, size, description=""):
+        self.entries.append({'owner': owner, 'name': name, 'bytes': int(size),
+                             'dtype': description, 'shape': None,
+                             'shared': None})
+
+    def total(self):
+        return sum(entry['bytes'] for entry in self.entries)
+
+    # The total for every owner, largest first
+    def by_owner(self):
+        totals = {}
+        for entry in self.entries:
+            totals[entry['owner']] = totals.get(entry['owner'], 0) + entry['bytes']
+        return sorted(totals.items(), key=lambda item: -item[1])
+
+    def largest(self, n=10):
+        return sorted(self.entries, key=lambda entry: -entry['bytes'])[:n]
+
+    # A human-readable version of the report
+    def format(self, n=10):
+        lines = ["Total: " + format_bytes(self.total())]
+        process = process_memory()
+        if process is not None:
+            lines.append("Process peak (resident): " + format_bytes(process))
+        lines.append("")
+        lines.append("By object:")
+        for owner, size in self.by_owner():
+            lines.append("  {:<24} {:>10}".format(owner, format_bytes(size)))
+        lines.append("")
+        lines.append("Largest contributors:")
+        for entry in self.largest(n):
+            if entry['shape'] is not None:
+                what = "{} {}".format(entry['dtype'], "x".join(str(i) for i in entry['shape']))
+            else:
+                what = entry['dtype']
+            lines.append("  {:<40} {:>10}  {}".format(
+                entry['owner'] + " " + entry['name'], format_bytes(entry['bytes']), what))
+        shared = [entry for entry in self.entries if entry['shared'] is not None]
+        if len(shared):
+            lines.append("")
+            lines.append("Sharing memory (not counted twice):")
+            for entry in shared:
+                lines.append("  {} -> {}".format(entry['owner'] + " " + entry['name'],
+                                                 entry['shared']))
+        return "\n".join(lines)
+
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB"):
+        if abs(size) < 1024:
+            return "{:.1f} {}".format(size, unit) if unit != "B" else "{} B".format(size)
+        size /= 1024
+    return "{:.2f} GB".format(size)
+
+
+# The peak resident memory of this process in bytes, or None if it can't
+# be found out on this system
+def process_memory():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def add_canvas(report, canvas, owner="canvas"):
+    for name in CANVAS_ARRAYS:
+        report.add_array(owner, name, getattr(canvas, name, None))
+
+
+# The fringe points are stored as Python lists of [y, x] pairs, so their
+# size is estimated from the first point of every fringe
+def add_fringes(report, fringes, owner="fringes"):
+    n_points = 0
+    size = sys.getsizeof(fringes.list)
+    for fringe in fringes.list:
+        size += sys.getsizeof(fringe) + sys.getsizeof(fringe.__dict__)
+        size += sys.getsizeof(fringe.points)
+        if len(fringe.points):
+            point = fringe.points[0]
+            size += len(fringe.points) * (sys.getsizeof(point) + sum(
+                sys.getsizeof(value) for value in point))
+        n_points += len(fringe.points)
+    report.add_object(owner, "points", size, "{} fringes, {} points".format(
+        len(fringes.list), n_points))
+
+
+# The Triangle objects are all alike, so their size is estimated from
+# the first one
+def add_triangulation(report, tri, owner="triangulation"):
+    if getattr(tri, 'error', False):
+        return
+    report.add_array(owner, "points", tri.points)
+    report.add_object(owner, "values", sys.getsizeof(tri.values)
+                      + len(tri.values) * (sys.getsizeof(tri.values[0]) if len(tri.values) else 0),
+                      "{} values".format(len(tri.values)))
+    # Only the arrays that Delaunay has already computed are counted
+    for name in ('simplices', 'neighbors', 'equations', 'points', 'coplanar'):
+        try:
+            report.add_array(owner, "dt." + name, getattr(tri.dt, name))
+        except AttributeError:
+            pass
+    if len(tri.triangles):
+        triangle = tri.triangles[0]
+        per_triangle = sys.getsizeof(triangle) + sum(
+            sys.getsizeof(getattr(triangle, name)) for name in
+            ('vertices', 'vert_coordinates', 'neighbours', 'long_edges'))
+        report.add_object(owner, "triangles",
+                          sys.getsizeof(tri.triangles) + len(tri.triangles) * per_triangle,
+                          "{} triangles".format(len(tri.triangles)))
+    report.add_object(owner, "flat_triangles", sys.getsizeof(tri.flat_triangles),
+                      "{} flat".format(len(tri.flat_triangles)))
+
+
+# The values of the processing graph's stages (the maps, and the
+# summed-area tables of magic2/regions.py)
+def add_graph(report, graph, owner="graph"):
+    for name, node in graph.nodes.items():
+        if node.function is not None and isinstance(node.value, np.ndarray):
+            report.add_array(owner, name, node.value)
+        elif node.function is not None and hasattr(node.value, 'sums'):
+            report.add_array(owner, name + ".sums", node.value.sums)
+            report.add_array(owner, name + ".counts", node.value.counts)
+
+
+# Make a report for a whole shot. objects is a dictionary like
+# {'background': {'canvas': ..., 'fringes': ...}, 'plasma': {...}} (the
+# way the GUI stores them), graph is the processing graph, and extra is an
+# optional dictionary of other objects to include, like a Triangulation
+def shot_report(objects, graph=None, extra=None):
+    report = Report()
+    for env in ('background', 'plasma'):
+        if objects.get(env) is None:
+            continue
+        if objects[env].get('canvas') is not None:
+            add_canvas(report, objects[env]['canvas'], env + " canvas")
+        if objects[env].get('fringes') is not None:
+            add_fringes(report, objects[env]['fringes'], env + " fringes")
+    if graph is not None:
+        add_graph(report, graph)
+    if extra is not None:
+        for name, value in extra.items():
+            if hasattr(value, 'triangles'):
+                add_triangulation(report, value, name)
+            elif hasattr(value, 'fringes_image'):
+                add_canvas(report, value, name)
+            elif isinstance(value, np.ndarray):
+                report.add_array("other", name, value)
+    return report
@@ -0,0 +1,440 @@
+# Magic2 (https://github.com/jdranczewski/Magic2)
+# Copyright (C) 2018  Jakub Dranczewski, based on work by George Swadling
+
+# This work was carried out during a UROP with the MAGPIE Group,
+# Department of Physics, Imperial College London and was supported in part
+# by the Engineering and Physical Sciences Research Council (EPSRC) Grant
+# No. EP/N013379/1, by the U.S. Department of Energy (DOE) Awards
+# No. DE-F03-02NA00057 and No. DE-SC- 0001063
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# This file contains a small dependency graph that keeps track of the
+# processing stages (interpolation -> registration -> subtraction -> plasma
+# density -> Abel inversion) and of the settings they depend on. Every node
+# has a version counter, and every computed stage remembers the versions of
+# its inputs, so a stage is only recomputed when something upstream of it
+# has actually changed.
+import os
+import numpy as np
+from . import triangulate as m2triangulate
+from . import abel as m2abel
+from . import registration as m2registration
+from . import regions as m2regions
+from . import profiling as m2profiling
+from . import tiling as m2tiling
+
+# The size in bytes of the bands of rows that the temporary masks of the
+# subtraction are made for
+BAND = 2**22
+
+
+# A single node of the graph. Input nodes just hold a value that is set from
+# the outside, stage nodes also have a function and a list of input names
+class Node():
+    def __init__(self, name, function=None, inputs=(), recycle=False):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        # Whether the function accepts the outdated value as out=, to
+        # write the new one into its memory
+        self.recycle = recycle
+        self.value = None
+        # The version is incremented every time the value changes
+        self.version = 0
+        # For stages, the versions of the inputs the value was computed
+        # from. None means that there is no valid value
+        self.input_versions = None
+
+
+class Graph():
+    def __init__(self):
+        self.nodes = {}
+        # This is passed to the stages that can report their progress
+        # (a magic2.progress.Progress object)
+        self.progress = None
+        # How many stages are being computed right now (get() can be
+        # re-entered, for example while a GUI refreshes its progress bar)
+        self.computing = 0
+
+    # Add a node holding a value set from the outside (a setting,
+    # or an object like a Canvas)
+    def add_input(self, name, value=None):
+        node = self.nodes[name] = Node(name)
+        node.value = value
+        node.input_versions = ()
+
+    # Add a node computed by calling function with the values of the
+    # named inputs. The function returning None means that the stage failed.
+    # If recycle is True, the function is also given the stage's outdated
+    # value (if there is one) as the out keyword argument, so that it can
+    # reuse its memory instead of allocating a new array
+    def add_stage(self, name, function, inputs, recycle=False):
+        for input_name in inputs:
+            if input_name not in self.nodes:
+                raise KeyError("Unknown input '{}' for stage '{}'".format(input_name, name))
+        self.nodes[name] = Node(name, function, inputs, recycle)
+
+    # The versions of a stage's inputs, as they are right now
+    def _current_versions(self, node):
+        return tuple(self.nodes[name].version for name in node.inputs)
+
+    # Check whether a node's value can be used without recomputing it
+    def is_valid(self, name):
+        node = self.nodes[name]
+        if node.function is None:
+            return True
+        if node.input_versions is None:
+            return False
+        # All the inputs have to be up to date too, and they must not
+        # have changed since this node was computed
+        return (all(self.is_valid(input_name) for input_name in node.inputs)
+                and node.input_versions == self._current_versions(node))
+
+    # Return the value if it is up to date, None otherwise. This never
+    # triggers any calculations
+    def cached(self, name):
+        if self.is_valid(name):
+            return self.nodes[name].value
+        return None
+
+    # Return the node's value, computing it (and anything it depends on)
+    # if necessary
+    def get(self, name):
+        node = self.nodes[name]
+        if self.is_valid(name):
+            return node.value
+        args = []
+        for input_name in node.inputs:
+            value = self.get(input_name)
+            # A failed upstream stage means that this one fails too
+            if value is None and self.nodes[input_name].function is not None:
+                return None
+            args.append(value)
+        kwargs = {}
+        if node.recycle and node.value is not None:
+            kwargs['out'] = node.value
+        self.computing += 1
+        try:
+            value = node.function(*args, **kwargs)
+        finally:
+            self.computing -= 1
+        if value is None:
+            return None
+        self._store(node, value)
+        return value
+
+    # The values of a stage's inputs together with the versions of the stage
+    # and its inputs, so that the stage can be computed outside of the graph
+    # (like in another thread) and stored with offer() later. None if some
+    # of the inputs are not up to date
+    def snapshot(self, name):
+        node = self.nodes[name]
+        args = []
+        for input_name in node.inputs:
+            if not self.is_valid(input_name):
+                return None
+            value = self.nodes[input_name].value
+            if value is None and self.nodes[input_name].function is not None:
+                return None
+            args.append(value)
+        return args, (node.version, self._current_versions(node))
+
+    # Store a value computed from a snapshot, unless the stage or any of its
+    # inputs have changed since the snapshot was taken - then the value is
+    # out of date and is thrown away. Returns whether the value was stored
+    def offer(self, name, value, versions):
+        node = self.nodes[name]
+        if value is None or versions != (node.version, self._current_versions(node)):
+            return False
+        self._store(node, value)
+        return True
+
+    # Store a value in a node, marking everything downstream as stale
+    def _store(self, node, value):
+        node.value = value
+        node.version += 1
+        node.input_versions = self._current_versions(node)
+
+    # Set a node's value from the outside. For stages this overrides the
+    # computed value (for example after inverting a map)
+    def set(self, name, value):
+        node = self.nodes[name]
+        # Setting a setting to the value it already has shouldn't cause
+        # any recalculations
+        if (node.function is None and type(value) is type(node.value)
+                and isinstance(value, (bool, int, float, str, type(None)))
+                and value == node.value):
+            return
+        self._store(node, value)
+
+    # Let the graph know that a value has been modified in place
+    # (for example a Canvas has been relabelled)
+    def touch(self, name):
+        node = self.nodes[name]
+        node.version += 1
+        if node.function is not None and node.input_versions is not None:
+            node.input_versions = self._current_versions(node)
+
+    # Throw away a stage's value, so that it is recomputed on the next get
+    def invalidate(self, name):
+        node = self.nodes[name]
+        if node.function is not None:
+            node.value = None
+            node.input_versions = None
+            node.version += 1
+
+
+# The maps can be kept in one of two ways: as float64 arrays with -1024
+# where the interpolation has no data (the way the interpolation makes them,
+# with the user-defined mask applied separately), or as float32 arrays with
+# NaNs where there is no data, the mask included ("NaN maps"). NaN maps
+# take half the memory, and the subtraction, the plasma density and the
+# display can use them with plain numpy arithmetic instead of masked arrays.
+# Arrays in the NaN representation are the only plain float32 ones
+def is_nan_array(array):
+    return (not np.ma.isMaskedArray(array) and not isinstance(array, np.memmap)
+            and array.dtype == np.float32)
+
+
+# An array of the given shape and dtype to write a result into: the memory
+# of out (an outdated result, can be masked) if it fits, a new array
+# otherwise. Memory-mapped files are never reused, as they may belong to
+# the out-of-core mode
+def _buffer(out, shape, dtype):
+    out = np.ma.getdata(out) if out is not None else None
+    if (isinstance(out, np.ndarray) and not isinstance(out, np.memmap)
+            and out.shape == shape and out.dtype == dtype):
+        return out
+    return np.empty(shape, dtype)
+
+
+# A NaN map from an interpolated map and the user-defined mask
+def nan_map(interpolated, mask):
+    result = interpolated.astype(np.float32)
+    result[np.logical_or(interpolated == -1024.0, mask == False)] = np.nan
+    return result
+
+
+# An interpolated map with -1024 where a NaN map has no data
+def sentinel_map(interpolated):
+    result = interpolated.astype(np.float64)
+    result[np.isnan(result)] = -1024.0
+    return result
+
+
+# Put the interpolated map of a canvas in the chosen representation (nan
+# is True for NaN maps), returning it. Maps kept in memory-mapped files
+# are left as they are (the out-of-core mode has its own NaN conversion)
+def finish_map(canvas, nan):
+    if isinstance(canvas.interpolated, np.memmap):
+        pass
+    elif nan and not is_nan_array(canvas.interpolated):
+        canvas.interpolated = nan_map(canvas.interpolated, canvas.mask)
+    elif not nan and is_nan_array(canvas.interpolated):
+        canvas.interpolated = sentinel_map(canvas.interpolated)
+    return canvas.interpolated
+
+
+# Interpolate a canvas using the chosen method ('fast', 'exact' or 'tiled'
+# for the out-of-core mode), returning the interpolated array, or None if
+# the interpolation failed. If nan is True the result is a NaN map
+def interpolate(canvas, method, progress=None, nan=False):
+    if canvas is None or method is None:
+        return None
+    if method == 'exact':
+        result = m2triangulate.triangulate(canvas, None, progress)
+    elif method == 'fast':
+        result = m2triangulate.fast_tri(canvas, None, progress)
+    elif method == 'tiled':
+        result = m2tiling.interpolate_tiled(canvas, progress=progress)
+    else:
+        raise ValueError("Unknown interpolation method '{}'".format(method))
+    if result is None:
+        return None
+    return finish_map(canvas, nan)
+
+
+# Estimate the transform lining up the background with the plasma image
+# (see magic2/registration.py) from their traced fringes, leaving out the
+# areas masked out in either. mode None means that the images are taken to
+# be lined up already. Returns a magic2.registration.Estimate
+def register(background, plasma, mode, progress=None):
+    if background is None or plasma is None:
+        return None
+    return m2registration.estimate(plasma.fringes_image, background.fringes_image,
+                                   mode, progress, plasma.mask, background.mask)
+
+
+# Resample the background map onto the plasma map's grid using
+# a transform. The background map is returned as it is if it already lines
+# up with the plasma map and has the same shape
+def align(background, plasma, transform, out=None, progress=None):
+    return m2registration.resample(background, transform, plasma.shape, out,
+                                   progress)
+
+
+# Subtract the interpolated phase maps, masking them with the user-defined
+# mask of the plasma image, as well as the regions that couldn't be
+# interpolated for both the background and plasma images. Maps kept in
+# memory-mapped files are subtracted out-of-core, with NaNs marking the
+# areas without data. NaN maps already have their masks applied, so they
+# are simply subtracted, giving a NaN array. The result is written into the
+# memory of out (the previous result) if possible, and no other full-size
+# arrays are made along the way
+@m2profiling.profiled("subtract", lambda result, background, *args, **kwargs: {
+    'pixels': background.size})
+def subtract(background, plasma, mask, out=None):
+    if isinstance(background, np.memmap):
+        return m2tiling.subtract_tiled(background, plasma, mask,
+                                       directory=os.path.dirname(background.filename))
+    if is_nan_array(background) and is_nan_array(plasma):
+        return np.subtract(background, plasma,
+                           out=_buffer(out, background.shape, np.float32))
+    data = np.subtract(background, plasma,
+                       out=_buffer(out, background.shape, np.float64))
+    missing = _buffer(np.ma.getmask(out), background.shape, bool)
+    np.logical_not(mask, out=missing)
+    # The comparisons are done a band of rows at a time, so that they
+    # don't need full-size temporary arrays
+    for rows in m2tiling.bands(background.shape, 1, BAND):
+        missing[rows] |= plasma[rows] == -1024.0
+        missing[rows] |= background[rows] == -1024.0
+    return np.ma.masked_array(data, mask=missing, copy=False)
+
+
+# Calculate the line-integrated electron density (in cm^-2) from
+# a subtracted phase map. depth is in mm, wavelength in nm
+@m2profiling.profiled("plasma_density", lambda result, subtracted, *args, **kwargs: {
+    'pixels': subtracted.size})
+def plasma_density(subtracted, offset, depth, wavelength, double, out=None):
+    if depth is None or wavelength is None:
+        return None
+    if isinstance(subtracted, np.memmap):
+        return m2tiling.plasma_density_tiled(
+            subtracted, offset, depth, wavelength, double,
+            directory=os.path.dirname(subtracted.filename))
+    # Speed of light
+    c = 3e8
+    # Electron charge
+    e = 1.602e-19
+    # Electron mass
+    me = 9.109e-31
+    # Permittivity of free space
+    e0 = 8.854e-12
+    # Sample depth in meters
+    d = depth * 1e-3
+    # Wavelength in meters
+    wavelength = wavelength * 1e-9
+    # If the double option was chosen, one traced fringe corresponds
+    # to half a fringe shift
+    if double:
+        multiplier = 0.5
+    else:
+        multiplier = 1
+    # The constant factor is worked out first, as the intermediate values
+    # would overflow float32 (used by NaN maps). The division by 1e6
+    # converts to centimetres cubed
+    factor = (multiplier * 8 * (np.pi * c / e)**2 * me * e0 / d / wavelength
+              / 1e6)
+    # Calculate the density map, in place in a single buffer (the memory
+    # of out if possible), keeping the precision of the subtracted map
+    values = np.ma.getdata(subtracted)
+    density = np.subtract(values, offset,
+                          out=_buffer(out, values.shape, values.dtype))
+    density *= factor
+    if not np.ma.isMaskedArray(subtracted):
+        return density
+    # The mask is copied, as the subtracted map may be recomputed in place
+    mask = np.ma.getmask(subtracted)
+    if mask is not np.ma.nomask:
+        copy = _buffer(np.ma.getmask(out), mask.shape, bool)
+        np.copyto(copy, mask)
+        mask = copy
+    return np.ma.masked_array(density, mask=mask, copy=False)
+
+
+# Give a canvas to the processing graph (None to take it away). The canvas
+# is also held by the <env>_image input, which stands for just its traced
+# fringe image and mask. Unlike <env>_canvas, it isn't touched when the
+# fringes are labelled, as those don't change, so the stages using only
+# them (the registration) aren't computed again after every relabel
+def set_canvas(graph, env, canvas):
+    graph.set(env + '_canvas', canvas)
+    graph.set(env + '_image', canvas)
+
+
+# Create the graph describing the processing of a single shot:
+#   <env>_canvas, <env>_method, nan_maps -> <env>_map
+#   background_image, plasma_image, registration -> registration_estimate
+#   registration_estimate -> transform
+#   background_map, plasma_map, transform -> aligned_background
+#   aligned_background, plasma_map, plasma_canvas -> subtracted
+#   subtracted, offset, depth, wavelength, double -> density
+#   density, centre, resolution, abel_method -> abel
+#   subtracted -> subtracted_table, density -> density_table
+def shot_graph(progress=None):
+    graph = Graph()
+    graph.progress = progress
+    # Whether the maps are NaN maps (see is_nan_array)
+    graph.add_input('nan_maps', False)
+    for env in ('background', 'plasma'):
+        graph.add_input(env + '_canvas')
+        # The same canvas, for its fringe image and mask (see set_canvas)
+        graph.add_input(env + '_image')
+        graph.add_input(env + '_method')
+        # The progress is looked up when the stage runs, so that it can be
+        # attached to the graph after it is created
+        graph.add_stage(env + '_map',
+                        lambda canvas, method, nan: interpolate(canvas, method,
+                                                                graph.progress, nan),
+                        [env + '_canvas', env + '_method', 'nan_maps'])
+    # The registration mode (see magic2/registration.py), None for none
+    graph.add_input('registration')
+    graph.add_stage('registration_estimate',
+                    lambda background, plasma, mode:
+                    register(background, plasma, mode, graph.progress),
+                    ['background_image', 'plasma_image', 'registration'])
+    graph.add_stage('transform', lambda estimate: estimate.transform,
+                    ['registration_estimate'])
+    graph.add_stage('aligned_background',
+                    lambda background, plasma, transform, out=None:
+                    align(background, plasma, transform, out, graph.progress),
+                    ['background_map', 'plasma_map', 'transform'], recycle=True)
+    graph.add_stage('subtracted',
+                    lambda background, plasma, canvas, out=None:
+                    subtract(background, plasma, canvas.mask, out),
+                    ['aligned_background', 'plasma_map', 'plasma_canvas'], recycle=True)
+    graph.add_input('offset', 0)
+    graph.add_input('depth', 10.0)
+    graph.add_input('wavelength')
+    graph.add_input('double')
+    graph.add_stage('density', plasma_density,
+                    ['subtracted', 'offset', 'depth', 'wavelength', 'double'],
+                    recycle=True)
+    # The centre of the density map (row, column in pixels), the column
+    # being the axis of symmetry, and the resolution in pixels per mm
+    graph.add_input('centre', (0, 0))
+    graph.add_input('resolution')
+    graph.add_input('abel_method', 'three_point')
+    graph.add_stage('abel',
+                    lambda density, centre, resolution, method, out=None:
+                    m2abel.invert(density, centre, resolution, method, out=out,
+                                  progress=graph.progress),
+                    ['density', 'centre', 'resolution', 'abel_method'], recycle=True)
+    # The summed-area tables for region statistics (see magic2/regions.py),
+    # made only when they are asked for
+    graph.add_stage('subtracted_table', m2regions.summed_area, ['subtracted'])
+    graph.add_stage('density_table', m2regions.summed_area, ['density'])
+    return graph
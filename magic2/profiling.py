@@ -0,0 +1,205 @@
+# Magic2 (https://github.com/jdranczewski/Magic2)
+# Copyright (C) 2018  Jakub Dranczewski, based on work by George Swadling
+
+# This work was carried out during a UROP with the MAGPIE Group,
+# Department of Physics, Imperial College London and was supported in part
+# by the Engineering and Physical Sciences Research Council (EPSRC) Grant
+# No. EP/N013379/1, by the U.S. Department of Energy (DOE) Awards
+# No. DE-F03-02NA00057 and No. DE-SC- 0001063
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# This file contains an opt-in profiler for the processing stages. When it is
+# switched on, every function decorated with @profiled records its wall time,
+# CPU time and peak traced memory, along with some sizes (pixels, fringes,
+# points, triangles). The result is a JSON file in the Chrome trace event
+# format, which can be loaded into viewers like Perfetto or speedscope, with
+# a per-stage summary that is easy to diff between versions.
+#
+# Profiling is switched on by setting the MAGIC2_PROFILE environment variable
+# to the name of the file the trace should be written to when Python exits
+# ("{pid}" in the name is replaced with the process ID), by calling enable(),
+# or with the --profile flag of the command line interface.
+# Set MAGIC2_PROFILE_MEMORY=0 to skip the (slow) memory tracing.
+import os
+import json
+import time
+import atexit
+import functools
+import threading
+import tracemalloc
+
+# The active Profiler, None when profiling is off
+profiler = None
+
+
+class Profiler():
+    def __init__(self, memory=True):
+        self.memory = memory
+        # Finished spans, as Chrome trace events
+        self.events = []
+        # Spans that have started, but not finished yet. Spans are opened
+        # from several threads (the GUI, the speculator, the tile workers),
+        # each nesting its own, so every thread has its own stack. The
+        # memory peaks are of the whole process though
+        self.local = threading.local()
+        self.origin = time.perf_counter()
+        self.started_tracing = False
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+
+    # The stack of open spans of the current thread
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def enter(self, name):
+        record = {'name': name, 'sizes': {}, 'tid': threading.get_ident()}
+        stack = self.stack()
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # tracemalloc only remembers one peak, so before resetting it
+            # for this span we store it in the enclosing one
+            if len(stack):
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+            record['memory'] = record['peak'] = current
+        stack.append(record)
+        record['cpu'] = time.process_time()
+        record['start'] = time.perf_counter()
+        return record
+
+    def exit(self, record):
+        end = time.perf_counter()
+        cpu = time.process_time() - record['cpu']
+        stack = self.stack()
+        # The span is normally the last one opened by this thread
+        if stack and stack[-1] is record:
+            stack.pop()
+        else:
+            stack[:] = [open_record for open_record in stack if open_record is not record]
+        args = {'wall_time': end - record['start'], 'cpu_time': cpu}
+        if self.memory:
+            peak = max(record['peak'], tracemalloc.get_traced_memory()[1])
+            args['peak_memory'] = peak - record['memory']
+            if len(stack):
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+        args.update(record['sizes'])
+        self.events.append({
+            'name': record['name'], 'cat': 'magic2', 'ph': 'X',
+            'ts': (record['start'] - self.origin) * 1e6,
+            'dur': (end - record['start']) * 1e6,
+            'pid': os.getpid(), 'tid': record['tid'],
+            'args': args
+        })
+
+    # Add up the spans with the same name
+    def summary(self):
+        summary = {}
+        for event in self.events:
+            entry = summary.setdefault(event['name'], {'calls': 0, 'wall_time': 0,
+                                                       'cpu_time': 0})
+            entry['calls'] += 1
+            entry['wall_time'] += event['args']['wall_time']
+            entry['cpu_time'] += event['args']['cpu_time']
+            if 'peak_memory' in event['args']:
+                entry['peak_memory'] = max(entry.get('peak_memory', 0),
+                                           event['args']['peak_memory'])
+        return summary
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms',
+                       'summary': self.summary()}, f, indent=1, default=float)
+
+    def stop(self):
+        if self.started_tracing:
+            tracemalloc.stop()
+
+
+# Switch the profiling on. If filename is given, the trace is written there
+# when Python exits. memory decides whether memory is traced, by default
+# it is unless MAGIC2_PROFILE_MEMORY is set to 0
+def enable(filename=None, memory=None):
+    global profiler
+    if memory is None:
+        memory = os.environ.get('MAGIC2_PROFILE_MEMORY', '1') != '0'
+    if profiler is None:
+        profiler = Profiler(memory)
+    if filename is not None:
+        atexit.register(write, filename.replace("{pid}", str(os.getpid())))
+    return profiler
+
+
+# Switch the profiling off, returning the Profiler with the data collected
+def disable():
+    global profiler
+    old = profiler
+    if old is not None:
+        old.stop()
+    profiler = None
+    return old
+
+
+def write(filename):
+    if profiler is not None:
+        profiler.write(filename)
+
+
+# A context manager measuring a block of code. Sizes can be added to the
+# dictionary it returns
+class span():
+    def __init__(self, name, **sizes):
+        self.name = name
+        self.sizes = sizes
+        self.record = None
+
+    def __enter__(self):
+        if profiler is not None:
+            self.record = profiler.enter(self.name)
+            self.record['sizes'].update(self.sizes)
+            return self.record['sizes']
+        return {}
+
+    def __exit__(self, *args):
+        if self.record is not None and profiler is not None:
+            profiler.exit(self.record)
+        return False
+
+
+# A decorator measuring every call of a function. sizes is an optional
+# function called with the result and the arguments of the decorated
+# function, returning a dictionary of sizes worth recording
+def profiled(name, sizes=None):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            # This is the only overhead when profiling is off
+            if profiler is None:
+                return function(*args, **kwargs)
+            with span(name) as record:
+                result = function(*args, **kwargs)
+                if sizes is not None:
+                    record.update(sizes(result, *args, **kwargs))
+            return result
+        return wrapper
+    return decorator
+
+
+# Switch the profiling on if asked to by the environment
+if os.environ.get('MAGIC2_PROFILE'):
+    enable(os.environ['MAGIC2_PROFILE'])
@@ -0,0 +1,137 @@
+# Magic2 (https://github.com/jdranczewski/Magic2)
+# Copyright (C) 2018  Jakub Dranczewski, based on work by George Swadling
+
+# This work was carried out during a UROP with the MAGPIE Group,
+# Department of Physics, Imperial College London and was supported in part
+# by the Engineering and Physical Sciences Research Council (EPSRC) Grant
+# No. EP/N013379/1, by the U.S. Department of Energy (DOE) Awards
+# No. DE-F03-02NA00057 and No. DE-SC- 0001063
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# This file contains a way for the processing functions to report their
+# progress without knowing who is listening. A Progress object turns calls
+# like progress.update(0.5, flipped=120) into Event objects and passes them
+# to a callback - the GUI's status bar, the terminal, or a JSON log.
+# Updates are rate-limited, so they can be reported from inside tight loops.
+import sys
+import json
+import time
+from collections import namedtuple
+
+# stage is the name of the current stage, fraction is how much of the stage
+# is done (0 to 1), percent is the overall progress (0 to 100), elapsed is
+# the time since the stage started (in seconds), and counts is a dictionary
+# of things like triangles flipped or points added
+Event = namedtuple('Event', ['stage', 'fraction', 'percent', 'elapsed', 'counts'])
+
+
+class Progress():
+    # callback is called with an Event. interval is the minimum time between
+    # two updates passed on to the callback (new stages and finished stages
+    # are always passed on)
+    def __init__(self, callback=None, interval=0.1):
+        self.callback = callback
+        self.interval = interval
+        self.name = None
+        # The part of the overall percentage taken up by this stage
+        self.start = 0
+        self.end = 100
+        self.started = None
+        self.last = None
+        self.counts = {}
+        # The time taken by every finished stage
+        self.timings = {}
+
+    # Start a new stage, finishing the previous one. start and end set the
+    # range of the overall percentage this stage takes up
+    def stage(self, name, start=0, end=None, **counts):
+        self.finish()
+        self.name = name
+        self.start = start
+        self.end = start if end is None else end
+        self.counts = counts
+        self.started = time.perf_counter()
+        self._emit(0)
+
+    # Report how far along the current stage is. The counts are remembered,
+    # so they don't need to be passed every time
+    def update(self, fraction, **counts):
+        if self.name is None:
+            return
+        self.counts.update(counts)
+        if time.perf_counter() - self.last >= self.interval:
+            self._emit(fraction)
+
+    # Finish the current stage, recording the time it took
+    def finish(self, **counts):
+        if self.name is not None:
+            self.counts.update(counts)
+            self._emit(1)
+            self.timings[self.name] = self.timings.get(self.name, 0) + self.last - self.started
+            self.name = None
+
+    # Finish the current stage and let the listeners know that
+    # everything is done
+    def done(self, name="Done"):
+        self.finish()
+        if self.callback is not None:
+            self.callback(Event(name, 1, 100, 0, {}))
+
+    def _emit(self, fraction):
+        self.last = time.perf_counter()
+        if self.callback is not None:
+            self.callback(Event(self.name, fraction,
+                                self.start + fraction*(self.end-self.start),
+                                self.last - self.started, dict(self.counts)))
+
+
+# Turn whatever was passed to a processing function into a Progress object:
+# None gives one that prints to the terminal, and an object with a
+# set(text, percent) method (like the GUI's status bar) gets wrapped
+def wrap(progress):
+    if progress is None:
+        return Progress(TerminalPrinter())
+    if isinstance(progress, Progress):
+        return progress
+    return Progress(lambda event: progress.set(event.stage, event.percent))
+
+
+# An adapter printing the events to the terminal
+class TerminalPrinter():
+    def __init__(self, prefix="", stream=None):
+        self.prefix = prefix
+        self.stream = stream
+
+    def __call__(self, event):
+        counts = ", ".join("{} {}".format(key, value)
+                           for key, value in event.counts.items())
+        print("{}{} {:3.0f}% ({:.2f} s){}".format(
+            self.prefix, event.stage, event.fraction*100, event.elapsed,
+            " - " + counts if counts else ""),
+            file=self.stream if self.stream is not None else sys.stdout)
+
+
+# An adapter writing the events to a file, one JSON object per line
+class JSONLog():
+    def __init__(self, f, **extra):
+        self.f = f
+        # Extra fields written with every event, like the shot's name
+        self.extra = extra
+
+    def __call__(self, event):
+        record = dict(self.extra)
+        record.update(event._asdict())
+        record['time'] = time.time()
+        self.f.write(json.dumps(record, default=float) + "\n")
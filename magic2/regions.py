@@ -0,0 +1,163 @@
+# Magic2 (https://github.com/jdranczewski/Magic2)
+# Copyright (C) 2018  Jakub Dranczewski, based on work by George Swadling
+
+# This work was carried out during a UROP with the MAGPIE Group,
+# Department of Physics, Imperial College London and was supported in part
+# by the Engineering and Physical Sciences Research Council (EPSRC) Grant
+# No. EP/N013379/1, by the U.S. Department of Energy (DOE) Awards
+# No. DE-F03-02NA00057 and No. DE-SC- 0001063
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# This file calculates statistics (the sum, mean and number of pixels with
+# data) of regions of a map, like the number of electrons in a box of the
+# plasma density map. A summed-area table is made for the map once: every
+# entry is the sum of all the values above and to the left of it, so the
+# sum over any rectangle takes just four lookups, however big it is. A
+# second table counts the pixels with data the same way. Polygons are split
+# into runs of pixels along every row they cover, and every run is two
+# lookups in each table.
+#
+# Regions are given in pixel coordinates in which pixel (row, column) covers
+# [row, row+1) x [column, column+1), and a pixel is in a region if its
+# centre is.
+import os
+import numpy as np
+from . import profiling as m2profiling
+from . import tiling as m2tiling
+
+
+class SummedArea():
+    # data is a map (can be masked, or have NaNs where there is no data).
+    # Maps kept in memory-mapped files get their tables in memory-mapped
+    # files next to them. The tables are built a band of rows at a time
+    def __init__(self, data):
+        height, width = self.shape = data.shape
+        # The counts can't go over the number of pixels
+        count_type = np.int32 if height*width < 2**31 else np.int64
+        if isinstance(data, np.memmap):
+            directory = os.path.dirname(data.filename)
+            self.sums = m2tiling.raster((height+1, width+1), np.float64, 0,
+                                        directory, "sums")
+            self.counts = m2tiling.raster((height+1, width+1), count_type, 0,
+                                          directory, "counts")
+        else:
+            self.sums = np.zeros((height+1, width+1))
+            self.counts = np.zeros((height+1, width+1), dtype=count_type)
+        # The values and counts of the last row of the previous band
+        sums = np.zeros(width)
+        counts = np.zeros(width, dtype=count_type)
+        for rows in m2tiling.bands(data.shape, 4*8):
+            band = data[rows]
+            values = np.array(np.ma.getdata(band), dtype=np.float64)
+            valid = np.isfinite(values)
+            if np.ma.isMaskedArray(band):
+                valid &= ~np.ma.getmaskarray(band)
+            values[~valid] = 0
+            values = np.cumsum(np.cumsum(values, axis=1), axis=0)
+            values += sums
+            valid = np.cumsum(np.cumsum(valid, axis=1, dtype=count_type), axis=0)
+            valid += counts
+            self.sums[rows.start+1:rows.stop+1, 1:] = values
+            self.counts[rows.start+1:rows.stop+1, 1:] = valid
+            sums, counts = values[-1], valid[-1]
+
+    # The rows and columns of the pixels whose centres are within
+    # [start, stop), as the indices of the table's entries around them
+    def _span(self, start, stop, axis):
+        size = self.shape[axis]
+        first = int(np.clip(np.ceil(start - 0.5), 0, size))
+        last = int(np.clip(np.ceil(stop - 0.5), first, size))
+        return first, last
+
+    # The sum of the values and the number of pixels with data in
+    # a rectangle, and the number of pixels in it
+    def rectangle(self, top, left, bottom, right):
+        top, bottom = self._span(min(top, bottom), max(top, bottom), 0)
+        left, right = self._span(min(left, right), max(left, right), 1)
+        total = (self.sums[bottom, right] - self.sums[top, right]
+                 - self.sums[bottom, left] + self.sums[top, left])
+        count = (int(self.counts[bottom, right]) - int(self.counts[top, right])
+                 - int(self.counts[bottom, left]) + int(self.counts[top, left]))
+        return float(total), count, (bottom-top) * (right-left)
+
+    # The sums and counts of every row (axis 0) or column (axis 1) of
+    # a rectangle, as arrays, and the index of the first row (or column)
+    def profile(self, top, left, bottom, right, axis=0):
+        top, bottom = self._span(min(top, bottom), max(top, bottom), 0)
+        left, right = self._span(min(left, right), max(left, right), 1)
+        if axis == 0:
+            sums = self.sums[top:bottom+1, right] - self.sums[top:bottom+1, left]
+            counts = (self.counts[top:bottom+1, right].astype(np.int64)
+                      - self.counts[top:bottom+1, left])
+            return np.diff(sums), np.diff(counts), top
+        sums = self.sums[bottom, left:right+1] - self.sums[top, left:right+1]
+        counts = (self.counts[bottom, left:right+1].astype(np.int64)
+                  - self.counts[top, left:right+1])
+        return np.diff(sums), np.diff(counts), left
+
+    # The runs of pixels inside a polygon (given as an array of (y, x)
+    # vertices), as arrays of the row, the first column and the column
+    # after the last one of every run. Every row through the polygon is
+    # crossed by its edges an even number of times, and the pixels between
+    # the first and second crossing, the third and fourth, etc. are inside
+    def _runs(self, vertices):
+        vertices = np.asarray(vertices, dtype=np.float64)
+        start, stop = self._span(vertices[:, 0].min(), vertices[:, 0].max(), 0)
+        # The centres of the rows
+        y = np.arange(start, stop)[:, np.newaxis] + 0.5
+        y0, x0 = vertices[:, 0], vertices[:, 1]
+        y1, x1 = np.roll(y0, -1), np.roll(x0, -1)
+        # An edge crosses a row if the row's centre is between its ends,
+        # counting only one end, so that vertices aren't counted twice
+        crosses = (y0 <= y) != (y1 <= y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = np.where(crosses, x0 + (y - y0) * (x1 - x0) / (y1 - y0), np.inf)
+        x.sort(axis=1)
+        runs = np.count_nonzero(crosses, axis=1) // 2
+        rows = np.repeat(np.arange(start, stop), runs)
+        # The crossings of every row in pairs
+        index = np.arange(runs.sum()) - np.repeat(np.cumsum(runs) - runs, runs)
+        ends = x[rows - start]
+        first = np.clip(np.ceil(ends[np.arange(len(rows)), 2*index] - 0.5), 0, self.shape[1])
+        last = np.clip(np.ceil(ends[np.arange(len(rows)), 2*index+1] - 0.5), first, self.shape[1])
+        return rows, first.astype(np.int64), last.astype(np.int64)
+
+    # The same as rectangle, for a polygon
+    def polygon(self, vertices):
+        rows, first, last = self._runs(vertices)
+        total = np.sum((self.sums[rows+1, last] - self.sums[rows, last])
+                       - (self.sums[rows+1, first] - self.sums[rows, first]))
+        count = np.sum((self.counts[rows+1, last].astype(np.int64) - self.counts[rows, last])
+                       - (self.counts[rows+1, first].astype(np.int64) - self.counts[rows, first]))
+        return float(total), int(count), int(np.sum(last - first))
+
+
+# Make the summed-area tables of a map, None if there is no map
+@m2profiling.profiled("summed_area", lambda result, data: {'pixels': data.size})
+def summed_area(data):
+    if data is None:
+        return None
+    return SummedArea(data)
+
+
+# The statistics of a region from its sum, count and area (as returned by
+# SummedArea.rectangle or polygon): the sum and mean of the values, and
+# the number of pixels in the region and of those with data. offset is
+# subtracted from every value first (like the zero shift point of the
+# subtracted map)
+def statistics(total, count, area, offset=0):
+    total -= offset * count
+    return {'sum': total, 'mean': total / count if count else np.nan,
+            'pixels': area, 'valid': count}
@@ -0,0 +1,476 @@
+# Magic2 (https://github.com/jdranczewski/Magic2)
+# Copyright (C) 2018  Jakub Dranczewski, based on work by George Swadling
+
+# This work was carried out during a UROP with the MAGPIE Group,
+# Department of Physics, Imperial College London and was supported in part
+# by the Engineering and Physical Sciences Research Council (EPSRC) Grant
+# No. EP/N013379/1, by the U.S. Department of Energy (DOE) Awards
+# No. DE-F03-02NA00057 and No. DE-SC- 0001063
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# This file lines up the background map with the plasma map before they are
+# subtracted, for when the camera has moved a little between the two shots
+# (or the images have different sizes). The shift is estimated by phase
+# correlation of the two traced fringe images: the peak of the inverse
+# Fourier transform of their normalised cross-power spectrum is at the shift
+# between them. The plasma moves the fringes too, and looks just like a
+# shift of the part of the image it is in, so only the parts of the images
+# without plasma can be used. To find them, the images are first compared
+# in tiles of TILE pixels. Every tile votes for all the shifts its
+# correlation is high at (a tile of nearly straight fringes can't tell a
+# shift along them, so it votes for a whole line of shifts), the shift with
+# the most votes is the one the tiles without plasma agree on, and the
+# tiles that agree with it are then compared together for the estimate.
+# This needs a part of the image without plasma - when the plasma covers
+# (nearly) all of it, there is nothing to line up and the estimate is
+# rejected. The shift is only looked for up to MAX_SHIFT pixels, as the
+# correlation of periodic fringes has peaks every fringe, and the areas
+# masked out in either image are left out. The traced fringes are a pixel
+# wide, so the estimate is good to about a pixel across them. Along them, it
+# is only as good as their curvature allows - a couple of pixels for gently
+# curved fringes, which matters little, as the phase hardly changes along
+# a fringe, and nothing at all for straight ones (see MIN_DISTINCTNESS).
+# The modes are:
+#   'translation'  a shift by whole pixels
+#   'subpixel'     a shift with a fraction of a pixel (found from the
+#                  height of the peak's neighbours)
+#   'rotation'     a small rotation too, found by trying a range of angles
+#                  and keeping the one the images match best at
+# A transform is (dy, dx, angle): a point q of the background is at
+# R(angle) (q - c) + c + (dy, dx) in the plasma image, where c is the centre
+# of the plasma image and the angle is in degrees. The background map is
+# then resampled onto the plasma map's grid, a band of rows at a time.
+# Estimates the images don't agree on well enough are rejected, and the
+# background is left as it is.
+import os
+from collections import namedtuple
+import numpy as np
+from scipy import fft as sfft
+from scipy import ndimage
+from . import progress as m2progress
+from . import profiling as m2profiling
+from . import tiling as m2tiling
+
+# The registration modes, in the order they are offered
+MODES = ('translation', 'subpixel', 'rotation')
+# The transform that leaves the background as it is
+IDENTITY = (0.0, 0.0, 0.0)
+# The largest side of the window the transform is estimated from, taken
+# from the middle of the images (large images don't need to be transformed
+# as a whole, and the estimate is no better for it)
+WINDOW = 2048
+# The largest rotation looked for, and the steps it is looked for in (see
+# _angle), in degrees
+MAX_ANGLE = 5.0
+ANGLE_STEP = 0.5
+FINE_ANGLE_STEP = 0.1
+# The largest side of the window the rotation is looked for in, larger
+# windows are reduced to it (by averaging blocks of pixels)
+ANGLE_WINDOW = 1024
+# The largest shift looked for along either axis, in pixels
+MAX_SHIFT = 32
+# The side of the tiles the images are compared in to find the parts
+# without plasma, in pixels, and the smallest part of a tile that has to be
+# used (not masked out) for the tile to be compared
+TILE = 256
+MIN_TILE_WEIGHT = 0.5
+# A tile votes for the shifts its correlation (smoothed by a Gaussian BLUR
+# pixels wide, so that a line of shifts isn't broken up by the single
+# pixels of the traces) is at least AGREEMENT of its highest value at
+BLUR = 1.5
+AGREEMENT = 0.5
+# The width of the Gaussian the edges of the part of the images the
+# estimate is made from are smoothed with, in pixels
+EDGE = 16
+# The lowest confidence (the height of the correlation peak over the
+# standard deviation of the whole correlation surface) an estimate is
+# accepted with. Images that line up give from under a hundred (when little
+# of them is free of plasma) to several hundred, while images that don't
+# match give around 10
+MIN_CONFIDENCE = 40.0
+# How many times higher than anywhere more than DISTINCT pixels away from
+# it the peak has to be for an estimate to be accepted. The peak of fringes
+# that are (nearly) straight is a ridge along them rather than a point, as
+# is the peak of a half pixel shift of traces a pixel wide
+DISTINCT = 3
+MIN_DISTINCTNESS = 2.5
+
+# The result of estimate: the transform, its confidence (None if it wasn't
+# estimated) and whether it was accepted. A rejected estimate's transform
+# is IDENTITY
+Estimate = namedtuple('Estimate', ('transform', 'confidence', 'accepted'))
+
+
+# The rotation matrix acting on (y, x) coordinates
+def _rotation(angle):
+    angle = np.radians(angle)
+    return np.array([[np.cos(angle), -np.sin(angle)],
+                     [np.sin(angle), np.cos(angle)]])
+
+
+# The same part of both images (around the middle of the area they have in
+# common), as float arrays, the part of it that is used (not masked out in
+# either image, as a float array of ones and zeros) and the position of its
+# corner. The masks are True where the image is used
+def _windows(reference, moving, reference_mask=None, moving_mask=None):
+    common = np.minimum(np.shape(reference), np.shape(moving))
+    size = np.minimum(common, WINDOW)
+    corner = (common - size) // 2
+    rows = slice(corner[0], corner[0]+size[0])
+    columns = slice(corner[1], corner[1]+size[1])
+    weight = np.ones(tuple(size), dtype=np.float32)
+    for mask in (reference_mask, moving_mask):
+        if mask is not None:
+            weight *= np.asarray(mask[rows, columns], dtype=np.float32)
+    return (np.asarray(reference[rows, columns], dtype=np.float32),
+            np.asarray(moving[rows, columns], dtype=np.float32),
+            weight, corner)
+
+
+# Prepare a window for the Fourier transform: remove its mean and
+# multiply it by the taper, which goes to zero at its edges (and wherever
+# the window isn't used), so that they don't show up as a peak at no shift
+def _taper(window, taper):
+    mean = np.sum(window * taper) / max(float(np.sum(taper)), 1e-12)
+    return (window - mean) * taper
+
+
+# The taper of a tile, with its unused parts left out
+def _tile_taper(weight):
+    return (np.hanning(weight.shape[0])[:, np.newaxis].astype(np.float32)
+            * np.hanning(weight.shape[1])[np.newaxis, :].astype(np.float32)
+            * weight)
+
+
+# The taper of a window of which only the tiles (pairs of slices) are
+# used: the tiles' weight, with its edges (and the window's) smoothed by
+# a Gaussian EDGE pixels wide (less for small windows)
+def _region_taper(weight, tiles):
+    taper = np.zeros(weight.shape, dtype=np.float32)
+    for tile in tiles:
+        taper[tile] = weight[tile]
+    border = min(2*EDGE, min(weight.shape) // 4)
+    taper[:border] = 0
+    taper[-border:] = 0
+    taper[:, :border] = 0
+    taper[:, -border:] = 0
+    return ndimage.gaussian_filter(taper, border / 2)
+
+
+# The phase correlation surface of two prepared windows (or of every pair
+# of a stack of them)
+def _correlation(reference, moving):
+    cross = sfft.rfft2(reference) * np.conj(sfft.rfft2(moving))
+    cross /= np.abs(cross) + 1e-12
+    return sfft.irfft2(cross, s=reference.shape[-2:])
+
+
+# The positions of a correlation surface of the given shape that are
+# shifts of at most MAX_SHIFT along both axes
+def _allowed(shape):
+    shifts = [np.abs(np.fft.fftfreq(n, 1/n)) <= MAX_SHIFT for n in shape]
+    return shifts[0][:, np.newaxis] & shifts[1][np.newaxis, :]
+
+
+# The offset of a peak from the sample at its top (centre), given the
+# samples on either side, by fitting a parabola through the three
+def _parabola(left, centre, right):
+    curvature = left - 2*centre + right
+    if curvature < 0:
+        return 0.5 * (left - right) / curvature
+    return 0.0
+
+
+# The same, for the peak of a phase correlation of two shifted images,
+# which has the shape of a sinc function rather than a parabola (see
+# H. Foroosh et al., IEEE Transactions on Image Processing 11, 188 (2002))
+def _sinc(left, centre, right):
+    if right > left:
+        return right / (right + centre)
+    if left > right:
+        return -left / (left + centre)
+    return 0.0
+
+
+# The position of the peak of a correlation surface (of any number of
+# dimensions), as signed shifts. refine is an optional function giving the
+# position between the samples (like _parabola), applied along every axis.
+# allowed is an optional boolean array of the positions the peak may be at
+def _peak(surface, refine=None, allowed=None):
+    if allowed is not None:
+        surface = np.where(allowed, surface, -np.inf)
+    index = np.unravel_index(np.argmax(surface), surface.shape)
+    shifts = []
+    for axis, position in enumerate(index):
+        shift = float(position)
+        if refine is not None:
+            neighbours = []
+            for step in (-1, 1):
+                neighbour = list(index)
+                neighbour[axis] = (position + step) % surface.shape[axis]
+                neighbours.append(surface[tuple(neighbour)])
+            if np.all(np.isfinite(neighbours)):
+                shift += refine(neighbours[0], surface[index], neighbours[1])
+        # The surface wraps around, so the second half are negative shifts
+        if shift > surface.shape[axis] / 2:
+            shift -= surface.shape[axis]
+        shifts.append(shift)
+    return shifts
+
+
+# The tiles (pairs of slices) of two windows that agree on the shift
+# between them (see the top of the file), and how well they match at it
+# (their smoothed correlation there, added up). side is the side of the
+# tiles. Returns an empty list if no tile is used enough
+def _agreeing(reference, moving, weight, side=TILE):
+    size = np.minimum(reference.shape, side)
+    tiles = []
+    for row in range(0, reference.shape[0] - size[0] + 1, size[0]):
+        for column in range(0, reference.shape[1] - size[1] + 1, size[1]):
+            tile = (slice(row, row+size[0]), slice(column, column+size[1]))
+            if np.mean(weight[tile]) >= MIN_TILE_WEIGHT:
+                tiles.append(tile)
+    if not tiles:
+        return tiles, 0.0
+    surfaces = _correlation(np.array([_taper(reference[tile], _tile_taper(weight[tile]))
+                                      for tile in tiles]),
+                            np.array([_taper(moving[tile], _tile_taper(weight[tile]))
+                                      for tile in tiles]))
+    surfaces = ndimage.gaussian_filter(surfaces, (0, BLUR, BLUR), mode='wrap')
+    limited = np.where(_allowed(size), surfaces, -np.inf)
+    highest = limited.reshape(len(tiles), -1).max(axis=1)
+    votes = np.sum(limited >= AGREEMENT * highest[:, np.newaxis, np.newaxis], axis=0)
+    # Of the shifts with the most votes, the one the tiles match best at
+    candidates = np.where(votes == votes.max(), surfaces.sum(axis=0), -np.inf)
+    position = np.unravel_index(np.argmax(candidates), candidates.shape)
+    agree = limited[(slice(None),) + position] >= AGREEMENT * highest
+    return ([tile for tile, agrees in zip(tiles, agree) if agrees],
+            float(np.sum(surfaces[(agree,) + position])))
+
+
+# How many times higher the peak of a correlation surface (at position) is
+# than the highest of the allowed positions more than DISTINCT pixels
+# away from it
+def _distinctness(surface, position, allowed):
+    far = np.zeros(surface.shape, dtype=bool)
+    for axis, index in enumerate(position):
+        distance = np.abs(np.arange(surface.shape[axis]) - index)
+        distance = np.minimum(distance, surface.shape[axis] - distance) > DISTINCT
+        far |= np.expand_dims(distance, 1 - axis)
+    far &= allowed
+    if not np.any(far) or surface[far].max() <= 0:
+        return np.inf
+    return surface[position] / surface[far].max()
+
+
+# The shift (dy, dx) such that reference(p) = moving(p - shift), refined
+# between the pixels by refine (see _peak), the height of the correlation
+# peak (1 for a perfect match), the confidence (see MIN_CONFIDENCE) and how
+# distinct the peak is (see MIN_DISTINCTNESS). Only the tiles that agree on
+# the shift are used. Returns None if there are no tiles to compare
+def _translation(reference, moving, weight, refine=None, side=TILE):
+    tiles = _agreeing(reference, moving, weight, side)[0]
+    if not tiles:
+        return None
+    taper = _region_taper(weight, tiles)
+    surface = _correlation(_taper(reference, taper), _taper(moving, taper))
+    allowed = _allowed(surface.shape)
+    limited = np.where(allowed, surface, -np.inf)
+    position = np.unravel_index(np.argmax(limited), limited.shape)
+    height = surface[position]
+    return (_peak(surface, refine, allowed), height,
+            height / max(float(surface.std()), 1e-12),
+            _distinctness(surface, position, allowed))
+
+
+# The angle (in degrees) the moving window has to be rotated by to match
+# the reference. It is looked for between -MAX_ANGLE and MAX_ANGLE every
+# ANGLE_STEP degrees, keeping the angle most tiles agree on the shift at
+# (at the wrong angle the tiles away from the middle are shifted more than
+# the ones near it), or that they match best at if that is a tie, and then between the neighbouring steps every
+# FINE_ANGLE_STEP, keeping the angle the tiles that agreed match best at
+# (refined by fitting a parabola through it and its neighbours). As every
+# angle of the first search needs its own correlation, the windows are
+# reduced to ANGLE_WINDOW for it (the whole of them is used, as the middle
+# is usually all plasma). Returns None if there are no tiles to compare
+def _angle(reference, moving, weight, progress):
+    factor = int(np.ceil(max(reference.shape) / ANGLE_WINDOW))
+    reduced = [_reduce(window, factor) if factor > 1 else window
+               for window in (reference, moving, weight)]
+    angles = np.arange(-MAX_ANGLE, MAX_ANGLE + ANGLE_STEP/2, ANGLE_STEP)
+    agreeing = []
+    for i, angle in enumerate(angles):
+        agreeing.append(_agreeing(reduced[0], _transform_window(reduced[1], (0.0, 0.0, angle)),
+                                  reduced[2], TILE // factor))
+        progress.update(0.5 * (i+1) / len(angles))
+    best = max(range(len(angles)),
+               key=lambda i: (len(agreeing[i][0]), agreeing[i][1]))
+    if not agreeing[best][0]:
+        return None
+    tiles = [tuple(slice(part.start*factor, part.stop*factor) for part in tile)
+             for tile in agreeing[best][0]]
+    taper = _region_taper(weight, tiles)
+    prepared = _taper(reference, taper)
+    allowed = _allowed(reference.shape)
+    angles = angles[best] + np.arange(-ANGLE_STEP, ANGLE_STEP + FINE_ANGLE_STEP/2,
+                                      FINE_ANGLE_STEP)
+    heights = []
+    for i, angle in enumerate(angles):
+        surface = _correlation(prepared, _taper(_transform_window(moving, (0.0, 0.0, angle)),
+                                                taper))
+        heights.append(surface[allowed].max())
+        progress.update(0.5 + 0.3 * (i+1) / len(angles))
+    best = int(np.argmax(heights))
+    if 0 < best < len(angles) - 1:
+        return angles[best] + FINE_ANGLE_STEP * _parabola(*heights[best-1:best+2])
+    return angles[best]
+
+
+# A window reduced factor times, by averaging blocks of factor by factor
+# pixels (the pixels that don't make up a whole block are left out)
+def _reduce(window, factor):
+    rows, columns = np.array(window.shape) // factor
+    window = window[:rows*factor, :columns*factor]
+    return window.reshape(rows, factor, columns, factor).mean(axis=(1, 3))
+
+
+# Resample an image with no missing data (like a fringe window) by
+# a transform, linearly
+def _transform_window(window, transform):
+    centre = (np.array(window.shape) - 1) / 2
+    y, x = np.mgrid[0:window.shape[0], 0:window.shape[1]].astype(np.float64)
+    source = _source(transform, centre, y, x)
+    return ndimage.map_coordinates(window, source, order=1, prefilter=False)
+
+
+# The coordinates in the background of the plasma image's pixels (y, x)
+def _source(transform, centre, y, x):
+    dy, dx, angle = transform
+    inverse = _rotation(-angle)
+    y = y - centre[0] - dy
+    x = x - centre[1] - dx
+    return [inverse[0, 0]*y + inverse[0, 1]*x + centre[0],
+            inverse[1, 0]*y + inverse[1, 1]*x + centre[1]]
+
+
+# Estimate the transform lining up moving (the background's traced fringe
+# image) with reference (the plasma's), using the chosen mode. The masks are
+# True where the images can be used. Returns an Estimate, with the identity
+# if mode is None, the images are too small to compare, the estimate's
+# confidence is too low or its peak isn't distinct (see MIN_DISTINCTNESS)
+@m2profiling.profiled("registration", lambda result, reference, *args, **kwargs: {
+    'pixels': np.size(reference)})
+def estimate(reference, moving, mode='subpixel', progress=None,
+             reference_mask=None, moving_mask=None):
+    if mode is None:
+        return Estimate(IDENTITY, None, True)
+    if mode not in MODES:
+        raise ValueError("Unknown registration mode '{}'".format(mode))
+    progress = m2progress.wrap(progress)
+    reference_window, moving_window, weight, corner = _windows(
+        reference, moving, reference_mask, moving_mask)
+    if min(reference_window.shape) < 16 or not weight.any():
+        return Estimate(IDENTITY, None, False)
+    progress.stage("Registering the images", 0, 100,
+                   pixels=reference_window.size)
+    angle = 0.0
+    if mode == 'rotation':
+        angle = _angle(reference_window, moving_window, weight, progress)
+    if angle is None:
+        result = None
+    elif angle:
+        # The rotated window is smoothed by the resampling, which makes its
+        # correlation peak rounder, closer to a parabola than a sinc
+        result = _translation(
+            reference_window, _transform_window(moving_window, (0.0, 0.0, angle)),
+            weight, _parabola)
+    else:
+        result = _translation(reference_window, moving_window, weight,
+                              _sinc if mode != 'translation' else None)
+    if result is None:
+        progress.done()
+        return Estimate(IDENTITY, None, False)
+    (dy, dx), height, confidence, distinctness = result
+    confidence = float(confidence)
+    if confidence < MIN_CONFIDENCE or distinctness < MIN_DISTINCTNESS:
+        progress.done()
+        return Estimate(IDENTITY, confidence, False)
+    # The rotation was about the middle of the window, rather than of the
+    # plasma image, which only changes the shift
+    offset = ((np.array(np.shape(reference)) - 1) / 2
+              - (corner + (np.array(reference_window.shape) - 1) / 2))
+    dy, dx = _rotation(angle) @ offset - offset + (dy, dx)
+    progress.done()
+    return Estimate((float(dy), float(dx), float(angle)), confidence, True)
+
+
+# Resample a map (with -1024 or NaN where there is no data, see
+# magic2/pipeline.py) by a transform onto a grid of the given shape. The
+# pixels that need any data from outside of the map, or from an area without
+# data, have no data. The result is in the same representation as the map,
+# written into out if it fits (a new array, or a memory-mapped file next to
+# the map's, otherwise). The map is returned as it is if nothing changes
+@m2profiling.profiled("resample", lambda result, data, *args, **kwargs: {
+    'pixels': data.size})
+def resample(data, transform, shape, out=None, progress=None):
+    # Imported here, as the pipeline module imports this one
+    from . import pipeline as m2pipeline
+    if data is None or transform is None:
+        return None
+    shape = tuple(shape)
+    if tuple(transform) == IDENTITY and data.shape == shape:
+        return data
+    progress = m2progress.wrap(progress)
+    nan = m2pipeline.is_nan_array(data)
+    dtype = np.float32 if nan else np.float64
+    fill = np.nan if nan else -1024.0
+    if isinstance(data, np.memmap):
+        out = m2tiling.raster(shape, dtype, directory=os.path.dirname(data.filename),
+                              name="aligned")
+    elif (not isinstance(out, np.ndarray) or isinstance(out, np.memmap)
+          or np.ma.isMaskedArray(out) or out.shape != shape or out.dtype != dtype
+          or np.may_share_memory(out, data)):
+        out = np.empty(shape, dtype)
+    centre = (np.array(shape) - 1) / 2
+    progress.stage("Resampling the background", 0, 100, pixels=out.size)
+    # A pixel of a band takes up its coordinates, value and weight, and
+    # the same for the map's pixel it comes from
+    for rows in m2tiling.bands(shape, 6*8):
+        y, x = np.mgrid[rows, 0:shape[1]].astype(np.float64)
+        source = _source(transform, centre, y, x)
+        # Only the rows of the map the band needs are read
+        first = max(int(np.floor(source[0].min())), 0)
+        last = min(int(np.ceil(source[0].max())) + 2, data.shape[0])
+        if first >= last:
+            out[rows] = fill
+            continue
+        values = np.array(data[first:last], dtype=np.float64)
+        missing = np.logical_or(values == -1024.0, np.isnan(values))
+        values[missing] = 0
+        source[0] -= first
+        result = ndimage.map_coordinates(values, source, order=1, cval=0.0,
+                                         prefilter=False)
+        # The share of every pixel's value that comes from actual data
+        weights = ndimage.map_coordinates((~missing).astype(np.float64), source,
+                                          order=1, cval=0.0, prefilter=False)
+        valid = weights > 1 - 1e-6
+        result[valid] /= weights[valid]
+        result[~valid] = fill
+        out[rows] = result
+        progress.update(rows.stop / shape[0])
+    if isinstance(out, np.memmap):
+        out.flush()
+    progress.done()
+    return out
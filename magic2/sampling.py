@@ -0,0 +1,124 @@
+# Magic2 (https://github.com/jdranczewski/Magic2)
+# Copyright (C) 2018  Jakub Dranczewski, based on work by George Swadling
+
+# This work was carried out during a UROP with the MAGPIE Group,
+# Department of Physics, Imperial College London and was supported in part
+# by the Engineering and Physical Sciences Research Council (EPSRC) Grant
+# No. EP/N013379/1, by the U.S. Department of Energy (DOE) Awards
+# No. DE-F03-02NA00057 and No. DE-SC- 0001063
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# This file samples maps along lines (lineouts). Any number of lines is
+# sampled with a single call to scipy's map_coordinates: the coordinates of
+# all the points of all the lines (and of all the points across their
+# width) are put into one array, and the width is averaged over afterwards.
+# The sampling is the same as skimage's profile_line: linear interpolation,
+# both ends of the line included, one point per pixel of its length, the
+# width sampled every pixel across the line, reflected at the map's edges,
+# and a point next to an area without data has no data (NaN).
+#
+# A line is [[y0, x0], [y1, x1]] in pixels. Families of lines can be made
+# from a line with parallel() (lines shifted sideways) and fan() (lines
+# rotated about the start point).
+import numpy as np
+from scipy import ndimage
+
+
+# The data as a float32 array with NaNs where there is no data (masked,
+# or NaN already). Arrays that already are that are returned as they are
+def nan_view(data):
+    if (not np.ma.isMaskedArray(data) and isinstance(data, np.ndarray)
+            and not isinstance(data, np.memmap) and data.dtype == np.float32):
+        return data
+    if np.ma.isMaskedArray(data):
+        return np.ma.filled(data.astype(np.float32), fill_value=np.nan)
+    return np.asarray(data, dtype=np.float32)
+
+
+# The number of points a line is sampled at
+def line_length(line):
+    line = np.asarray(line, dtype=np.float64)
+    return int(np.ceil(np.hypot(*(line[1] - line[0])) + 1))
+
+
+# The coordinates of the points of lines (an (n, 2, 2) array) sampled
+# width pixels wide, as a (2, points, width) array, and the number of
+# points of every line. points sets the same number of points for all
+# the lines
+def coordinates(lines, width=1, points=None):
+    lines = np.asarray(lines, dtype=np.float64).reshape(-1, 2, 2)
+    width = max(int(round(width)), 1)
+    if points is None:
+        lengths = np.array([line_length(line) for line in lines], dtype=np.int64)
+    else:
+        lengths = np.full(len(lines), points, dtype=np.int64)
+    # How far along its line every point is (0 to 1)
+    line_index = np.repeat(np.arange(len(lines)), lengths)
+    starts = np.cumsum(lengths) - lengths
+    along = np.arange(lengths.sum()) - np.repeat(starts, lengths)
+    along = along / np.maximum(np.repeat(lengths, lengths) - 1, 1)
+    start = lines[line_index, 0]
+    delta = lines[line_index, 1] - start
+    centres = start + along[:, np.newaxis] * delta
+    # The unit vector across every line, and the offsets along it
+    angle = np.arctan2(delta[:, 0], delta[:, 1])
+    across = np.stack((np.cos(angle), -np.sin(angle)), axis=1)
+    offsets = np.linspace((width - 1) / 2, -(width - 1) / 2, width)
+    points = centres[:, np.newaxis, :] + offsets[np.newaxis, :, np.newaxis] * across[:, np.newaxis, :]
+    return np.moveaxis(points, 2, 0), lengths
+
+
+# Sample data (ideally a nan_view) along lines, averaging over their width.
+# Returns a list with the profile of every line
+def profiles(data, lines, width=1, points=None):
+    points, lengths = coordinates(lines, width, points)
+    values = ndimage.map_coordinates(data, points.reshape(2, -1), order=1,
+                                     mode='reflect', prefilter=False)
+    values = values.reshape(points.shape[1:]).mean(axis=1)
+    return np.split(values, np.cumsum(lengths)[:-1])
+
+
+# The same as profiles, for lines of the same length (like a family made
+# by parallel or fan), as an array with a profile in every row. The lines
+# of a fan can differ in length by a rounding error, so all are sampled
+# at the number of points of the longest
+def profile_array(data, lines, width=1):
+    lines = np.asarray(lines, dtype=np.float64).reshape(-1, 2, 2)
+    points = max(line_length(line) for line in lines)
+    return np.vstack(profiles(data, lines, width, points))
+
+
+# count lines parallel to line, spacing pixels apart, with the original
+# in the middle
+def parallel(line, count, spacing):
+    line = np.asarray(line, dtype=np.float64)
+    delta = line[1] - line[0]
+    across = np.array((delta[1], -delta[0])) / max(np.hypot(*delta), 1e-12)
+    offsets = (np.arange(count) - (count - 1) / 2) * spacing
+    return line[np.newaxis] + offsets[:, np.newaxis, np.newaxis] * across
+
+
+# count lines of the same length as line, starting where it does and
+# spread evenly over angle degrees, with the original in the middle
+def fan(line, count, angle):
+    line = np.asarray(line, dtype=np.float64)
+    delta = line[1] - line[0]
+    angles = np.radians((np.arange(count) - (count - 1) / 2) * (angle / max(count - 1, 1)))
+    cos, sin = np.cos(angles), np.sin(angles)
+    ends = np.stack((cos*delta[0] + sin*delta[1], -sin*delta[0] + cos*delta[1]), axis=1)
+    lines = np.empty((count, 2, 2))
+    lines[:, 0] = line[0]
+    lines[:, 1] = line[0] + ends
+    return lines
@@ -0,0 +1,171 @@
+# Magic2 (https://github.com/jdranczewski/Magic2)
+# Copyright (C) 2018  Jakub Dranczewski, based on work by George Swadling
+
+# This work was carried out during a UROP with the MAGPIE Group,
+# Department of Physics, Imperial College London and was supported in part
+# by the Engineering and Physical Sciences Research Council (EPSRC) Grant
+# No. EP/N013379/1, by the U.S. Department of Energy (DOE) Awards
+# No. DE-F03-02NA00057 and No. DE-SC- 0001063
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# This file lets worker processes use the arrays of a Canvas without
+# pickling them. The arrays are moved into shared memory blocks
+# (multiprocessing.shared_memory), or for the out-of-core mode left in
+# their memory-mapped files, and the workers get a small handle that they
+# use to attach to the same memory by name. Whatever a worker writes into
+# the arrays (like an interpolated tile) is visible to everyone else.
+#
+# The blocks belong to a SharedBlocks object in the main process, which
+# removes them when it is closed (it's best used in a with statement),
+# when it is garbage collected, or when Python exits - whether or not the
+# workers finished cleanly. If the main process itself is killed,
+# Python's resource tracker removes the blocks.
+import sys
+import weakref
+from multiprocessing import shared_memory
+import numpy as np
+
+# The Canvas arrays an interpolation needs
+INTERPOLATION_ARRAYS = ('fringes_image', 'mask', 'fringes_image_clean',
+                        'fringe_phases', 'interpolated')
+
+
+# Close and remove a list of blocks. This is a plain function (and not
+# a method), so that weakref.finalize doesn't keep the SharedBlocks alive
+def _release(blocks):
+    while len(blocks):
+        block = blocks.pop()
+        try:
+            block.close()
+        except BufferError:
+            # Something still uses the memory, it will be freed when that
+            # lets go of it. The name can still be removed
+            pass
+        try:
+            block.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class SharedBlocks():
+    def __init__(self):
+        self.blocks = []
+        # (object, attribute) pairs that were pointed at shared memory,
+        # and that get a private copy back when the blocks are released
+        self.shared_attributes = []
+        self._finalizer = weakref.finalize(self, _release, self.blocks)
+
+    # Put a copy of an array into a new shared block. Returns the shared
+    # array and a (picklable) description used to attach to it.
+    # Memory-mapped arrays are already shared through their files,
+    # so they are left where they are
+    def share(self, array):
+        if isinstance(array, np.memmap) and array.filename is not None:
+            return array, ('file', array.filename, array.shape,
+                           array.dtype.str, array.offset)
+        array = np.asarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.blocks.append(block)
+        shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+        shared[...] = array
+        return shared, ('shm', block.name, array.shape, array.dtype.str)
+
+    # Move some of an object's array attributes into shared memory.
+    # Returns a handle that can be passed to attach()
+    def share_attributes(self, obj, names):
+        handle = {}
+        for name in names:
+            shared, handle[name] = self.share(getattr(obj, name))
+            if handle[name][0] == 'shm':
+                setattr(obj, name, shared)
+                self.shared_attributes.append((obj, name))
+        return handle
+
+    # Give the objects their own copies of the data back and remove
+    # the blocks
+    def close(self):
+        while len(self.shared_attributes):
+            obj, name = self.shared_attributes.pop()
+            setattr(obj, name, np.array(getattr(obj, name)))
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+
+# Blocks a worker has attached to, kept open for as long as it's alive
+_attached = {}
+
+
+# Attach to a shared block without registering it with the resource
+# tracker, which would remove it when this process exits - the block
+# belongs to the process that created it
+def _open_block(name):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    from multiprocessing import resource_tracker
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args, **kwargs: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+# Get the array described by SharedBlocks.share, without copying it
+def attach_array(description):
+    if description[0] == 'file':
+        kind, filename, shape, dtype, offset = description
+        return np.memmap(filename, dtype=np.dtype(dtype), mode='r+',
+                         shape=tuple(shape), offset=offset)
+    kind, name, shape, dtype = description
+    if name not in _attached:
+        _attached[name] = _open_block(name)
+    return np.ndarray(tuple(shape), dtype=np.dtype(dtype),
+                      buffer=_attached[name].buf)
+
+
+# Let go of all the blocks this process attached to
+def detach_all():
+    for name in list(_attached):
+        try:
+            _attached.pop(name).close()
+        except BufferError:
+            pass
+
+
+# Share the arrays of a Canvas. The Canvas keeps working as before, but
+# its arrays now live in blocks owned by blocks (a SharedBlocks object).
+# Returns a handle the workers can pass to attach_canvas
+def share_canvas(canvas, blocks, names=INTERPOLATION_ARRAYS):
+    return blocks.share_attributes(canvas, names)
+
+
+# Recreate a Canvas in a worker from a handle. Only the shared arrays
+# are there, pointing at the same memory as in the main process
+def attach_canvas(handle):
+    # Imported here, to keep this module light for the workers
+    from . import graphics as m2graphics
+    canvas = m2graphics.Canvas.__new__(m2graphics.Canvas)
+    canvas.error = False
+    canvas.interpolation_done = False
+    canvas.imshow = None
+    for name, description in handle.items():
+        setattr(canvas, name, attach_array(description))
+    return canvas
@@ -0,0 +1,255 @@
+# Magic2 (https://github.com/jdranczewski/Magic2)
+# Copyright (C) 2018  Jakub Dranczewski, based on work by George Swadling
+
+# This work was carried out during a UROP with the MAGPIE Group,
+# Department of Physics, Imperial College London and was supported in part
+# by the Engineering and Physical Sciences Research Council (EPSRC) Grant
+# No. EP/N013379/1, by the U.S. Department of Energy (DOE) Awards
+# No. DE-F03-02NA00057 and No. DE-SC- 0001063
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# This file creates synthetic traced interferograms from known phase fields.
+# The phase (in fringes) is given as an array, for example a sum of the
+# tilted_plane, gaussian_bump and cylinder fields below, and the fringes are
+# drawn along its integer contours - like a user tracing a real
+# interferogram would. As the true phase is known, the fringes come already
+# labelled, and the result of an interpolation can be compared with it.
+# This is used by the benchmarks, and can be used from the command line:
+#   python -m magic2.synthetic shot.m2 --size 4096 --spacing 20 --bump 6
+import argparse
+import numpy as np
+from . import graphics as m2graphics
+from . import fringes as m2fringes
+from . import m2file
+
+
+# The coordinates of the pixels, as a column and a row (so that they
+# broadcast to the full image without storing two full arrays)
+def _grid(shape):
+    y = np.arange(shape[0], dtype=np.float32)[:, np.newaxis]
+    x = np.arange(shape[1], dtype=np.float32)[np.newaxis, :]
+    return y, x
+
+
+# A background phase: a plane rising by one fringe every spacing pixels,
+# with the fringes at angle (in degrees) to the vertical
+def tilted_plane(shape, spacing=20, angle=30, offset=0):
+    y, x = _grid(shape)
+    angle = np.radians(angle)
+    return (offset + (np.cos(angle)*x + np.sin(angle)*y) / spacing).astype(np.float32)
+
+
+# A Gaussian plasma bump, height fringes high. The centre and the width are
+# given as fractions of the image size
+def gaussian_bump(shape, height=5, width=0.15, centre=(0.5, 0.5)):
+    y, x = _grid(shape)
+    y = (y - centre[0]*shape[0]) / (width*shape[0])
+    x = (x - centre[1]*shape[1]) / (width*shape[1])
+    return (height * np.exp(-(x**2 + y**2)/2)).astype(np.float32)
+
+
+# A uniform plasma column seen from the side: its line-integrated phase
+# goes as the chord length, height*sqrt(1-(r/R)^2). axis is 0 for a vertical
+# column and 1 for a horizontal one, the radius and the centre are
+# fractions of the image size
+def cylinder(shape, height=5, radius=0.25, centre=0.5, axis=0):
+    y, x = _grid(shape)
+    if axis == 0:
+        r = (x - centre*shape[1]) / (radius*shape[1])
+    else:
+        r = (y - centre*shape[0]) / (radius*shape[0])
+    chord = np.sqrt(np.clip(1 - r**2, 0, None))
+    return np.broadcast_to(height * chord, shape).astype(np.float32)
+
+
+# A circular mask (True inside), the radius and the centre are fractions
+# of the image size
+def circle_mask(shape, radius=0.45, centre=(0.5, 0.5)):
+    y, x = _grid(shape)
+    size = min(shape)
+    return ((y - centre[0]*shape[0])**2 + (x - centre[1]*shape[1])**2
+            <= (radius*size)**2)
+
+
+# The traced interferogram of a phase field. breaks is the number of gaps
+# (each break_length pixels across) cut into the traces, noise is the
+# fraction of pixels turned into stray black dots. seed makes these
+# reproducible
+class SyntheticImage():
+    def __init__(self, phase, mask=None, breaks=0, break_length=6, noise=0,
+                 seed=None):
+        rng = np.random.default_rng(seed)
+        # The true phase, in fringes
+        self.phase = phase
+        if mask is None:
+            mask = np.ones(phase.shape, dtype=bool)
+        self.mask = mask
+        # The fringe a pixel is on the lower side of
+        level = np.floor(phase).astype(np.int32)
+        # A pixel is on a trace if the next pixel along either axis
+        # is on a higher level, which gives thin, connected contours
+        contours = np.zeros(phase.shape, dtype=bool)
+        contours[:, :-1] |= level[:, :-1] < level[:, 1:]
+        contours[:-1, :] |= level[:-1, :] < level[1:, :]
+        # The fringe number of every traced pixel is one more than its level,
+        # as the contour sits on the boundary with the next level up
+        self.levels = level + 1
+        del level
+        # Cut the gaps, centred on randomly chosen trace pixels
+        traced = np.transpose(np.nonzero(contours))
+        if breaks and len(traced):
+            half = break_length // 2
+            for y, x in traced[rng.integers(0, len(traced), breaks)]:
+                contours[max(y-half, 0):y+half+1, max(x-half, 0):x+half+1] = False
+        # Stray dots, which are not part of any contour
+        self.noise = np.zeros(phase.shape, dtype=bool)
+        if noise:
+            self.noise = rng.random(phase.shape, dtype=np.float32) < noise
+            self.noise &= ~contours
+        # Nothing outside of the mask is traced
+        self.fringes_image = np.logical_and(np.logical_or(contours, self.noise), mask)
+        self.phases = None
+
+    # The image as a user would prepare it: black fringes, white background
+    # and the masked out areas in grey
+    def image(self):
+        image = np.where(self.mask, 1.0, 0.5).astype(np.float32)
+        image[self.fringes_image] = 0
+        return image
+
+    def save_png(self, filename):
+        # Imported here, so that the module doesn't need matplotlib
+        # unless PNGs are written
+        from matplotlib.image import imsave
+        imsave(filename, self.image(), cmap='gray', vmin=0, vmax=1)
+
+    # Read the fringes and label them with their true phases, returning
+    # (Canvas, Fringes) objects like the ones the GUI works with. Fringes
+    # made up of stray dots only are left unlabelled
+    def canvas(self, width=0, progress=None):
+        canvas = m2graphics.Canvas('dump', fi=self.fringes_image, m=self.mask)
+        fringes = m2fringes.Fringes()
+        m2fringes.read_fringes(fringes, canvas, progress=progress)
+        self.phases = []
+        for fringe in fringes.list:
+            points = np.array(fringe.points)
+            real = ~self.noise[points[:, 0], points[:, 1]]
+            if np.any(real):
+                # A trace can touch its neighbours where the fringes are
+                # dense, so the most common value is used
+                values, counts = np.unique(self.levels[points[real, 0], points[real, 1]],
+                                           return_counts=True)
+                fringe.phase = int(values[np.argmax(counts)])
+            self.phases.append(fringe.phase)
+        labelled = [phase for phase in self.phases if phase != -2048]
+        if len(labelled):
+            fringes.min = np.amin(labelled)
+            fringes.max = np.amax(labelled)
+        m2graphics.render_fringes(fringes, canvas, width=width)
+        return canvas, fringes
+
+    # The data as stored in an .m2 file: (fringes_image, mask, phases)
+    def m2_data(self):
+        if self.phases is None:
+            self.canvas()
+        return self.fringes_image, self.mask, self.phases
+
+
+# Compare an interpolated map with the true phase, returning the RMS and
+# maximum error (in fringes) and the fraction of the mask that has data.
+# The overall offset between the two doesn't matter, as the labelling can
+# start at any fringe
+def interpolation_error(interpolated, phase, mask=None):
+    valid = interpolated != -1024.0
+    if mask is not None:
+        valid &= mask
+    if not np.any(valid):
+        return {'rms': None, 'max': None, 'coverage': 0.0}
+    difference = interpolated[valid] - phase[valid]
+    difference -= np.mean(difference)
+    return {'rms': float(np.sqrt(np.mean(difference**2))),
+            'max': float(np.amax(np.abs(difference))),
+            'coverage': float(np.count_nonzero(valid)
+                              / (np.count_nonzero(mask) if mask is not None else valid.size))}
+
+
+# Create a background and plasma image pair. The background is a tilted
+# plane, the plasma image adds a Gaussian bump and/or a cylinder to it.
+# The remaining keyword arguments are passed to SyntheticImage
+def shot(size, spacing=20, angle=30, bump=5, bump_width=0.15, column=0,
+         column_radius=0.25, mask=False, **kwargs):
+    if np.isscalar(size):
+        size = (size, size)
+    background = tilted_plane(size, spacing, angle)
+    plasma = background.copy()
+    if bump:
+        plasma += gaussian_bump(size, bump, bump_width)
+    if column:
+        plasma += cylinder(size, column, column_radius)
+    mask = circle_mask(size) if mask else None
+    # The two images shouldn't have their breaks in the same places
+    seed = kwargs.pop('seed', None)
+    return (SyntheticImage(background, mask, seed=seed, **kwargs),
+            SyntheticImage(plasma, mask, seed=None if seed is None else seed+1,
+                           **kwargs))
+
+
+# Save a background and plasma pair as an .m2 file
+def write_m2(filename, background, plasma, **options):
+    m2file.write(filename, background=background.canvas(),
+                 plasma=plasma.canvas(), **options)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m magic2.synthetic",
+                                     description="Create a synthetic traced interferogram")
+    parser.add_argument("output", help="an .m2 file, or a name for the two .png images")
+    parser.add_argument("--size", type=int, nargs="+", default=[1024],
+                        help="image size in pixels (one number, or height and width)")
+    parser.add_argument("--spacing", type=float, default=20,
+                        help="background fringe spacing in pixels")
+    parser.add_argument("--angle", type=float, default=30,
+                        help="background fringe angle in degrees")
+    parser.add_argument("--bump", type=float, default=5,
+                        help="height of the Gaussian plasma bump in fringes")
+    parser.add_argument("--column", type=float, default=0,
+                        help="height of the cylindrical plasma column in fringes")
+    parser.add_argument("--mask", action="store_true", help="add a circular mask")
+    parser.add_argument("--breaks", type=int, default=0,
+                        help="number of gaps cut into the traces")
+    parser.add_argument("--noise", type=float, default=0,
+                        help="fraction of pixels turned into stray dots")
+    parser.add_argument("--seed", type=int, help="random seed")
+    parser.add_argument("--truth", action="store_true",
+                        help="also save the true phase maps as .npy files")
+    args = parser.parse_args(argv)
+    size = args.size[0] if len(args.size) == 1 else tuple(args.size[:2])
+    background, plasma = shot(size, args.spacing, args.angle, args.bump,
+                              column=args.column, mask=args.mask,
+                              breaks=args.breaks, noise=args.noise, seed=args.seed)
+    base = args.output[:-3] if args.output.endswith(".m2") else args.output
+    if args.output.endswith(".m2"):
+        write_m2(args.output, background, plasma, offset=0, depth=10.0,
+                 double=False, centre=[0, 0])
+    else:
+        background.save_png(base + "_background.png")
+        plasma.save_png(base + "_plasma.png")
+    if args.truth:
+        np.save(base + "_background_phase.npy", background.phase)
+        np.save(base + "_plasma_phase.npy", plasma.phase)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+# Magic2 (https://github.com/jdranczewski/Magic2)
+# Copyright (C) 2018  Jakub Dranczewski, based on work by George Swadling
+
+# This work was carried out during a UROP with the MAGPIE Group,
+# Department of Physics, Imperial College London and was supported in part
+# by the Engineering and Physical Sciences Research Council (EPSRC) Grant
+# No. EP/N013379/1, by the U.S. Department of Energy (DOE) Awards
+# No. DE-F03-02NA00057 and No. DE-SC- 0001063
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# This file contains the out-of-core mode, for images too big to keep all
+# the Canvas arrays in memory (like stitched mosaics). The arrays live in
+# memory-mapped files (np.memmap), and the interpolation, subtraction and
+# plasma density are calculated a tile or a band of rows at a time, so
+# that the memory used depends on the chosen budget rather than on the
+# size of the image.
+#
+# Every tile is interpolated using only the fringe points within the tile
+# and a halo around it. The halo has to be wide enough to contain the
+# points of the triangles covering the tile's edges - a few fringe spacings
+# (or the widest gap between the labelled fringes) is plenty.
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from scipy.interpolate import LinearNDInterpolator
+from . import progress as m2progress
+from . import profiling as m2profiling
+from . import sharing as m2sharing
+
+# The memory budget, in bytes. This is used by all the functions below
+# unless they are given a budget directly
+BUDGET = 256 * 2**20
+# How many processes interpolate_tiled uses by default
+WORKERS = 1
+# Roughly how many bytes of working memory a pixel of a tile takes up
+# while being interpolated (the coordinates, the simplex search and the
+# values, plus the window of fringe data read from the disk)
+BYTES_PER_PIXEL = 96
+
+
+# Create an array of the given shape and dtype in a memory-mapped file in
+# directory (a temporary directory if None), filled with fill (if given).
+# The filling is done a band of rows at a time
+def raster(shape, dtype, fill=None, directory=None, name="raster"):
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix="magic2_")
+    os.makedirs(directory, exist_ok=True)
+    # Every raster gets its own file, even if the name repeats
+    handle, filename = tempfile.mkstemp(prefix=name + "_", suffix=".dat",
+                                       dir=directory)
+    os.close(handle)
+    array = np.memmap(filename, dtype=dtype, mode='w+', shape=tuple(shape))
+    # A new file is full of zeros already
+    if fill is not None and fill != 0:
+        for rows in bands(shape, np.dtype(dtype).itemsize):
+            array[rows] = fill
+    return array
+
+
+# Split the rows of an image into bands of roughly budget bytes,
+# given how many bytes a pixel takes up. Yields slices
+def bands(shape, bytes_per_pixel, budget=None):
+    if budget is None:
+        budget = BUDGET
+    width = int(np.prod(shape[1:])) if len(shape) > 1 else 1
+    band = max(1, int(budget // (bytes_per_pixel * max(width, 1))))
+    for start in range(0, shape[0], band):
+        yield slice(start, min(start+band, shape[0]))
+
+
+# The largest square tile (without the halo) that fits in the budget
+def tile_size(budget=None, halo=64):
+    if budget is None:
+        budget = BUDGET
+    size = int(np.sqrt(budget / BYTES_PER_PIXEL)) - 2*halo
+    return max(size, 64)
+
+
+# Fill the coordinate arrays of an out-of-core Canvas a band at a time
+def fill_coordinates(canvas):
+    height, width = canvas.fringes_image.shape
+    for rows in bands((height, width), 3*8):
+        y = np.arange(rows.start, rows.stop)[:, np.newaxis]
+        x = np.arange(width)[np.newaxis, :]
+        canvas.x[rows] = x
+        canvas.y[rows] = y
+        canvas.xy[rows.start*width:rows.stop*width, 0] = np.repeat(y.ravel(), width)
+        canvas.xy[rows.start*width:rows.stop*width, 1] = np.tile(x.ravel(), rows.stop-rows.start)
+
+
+# Interpolate the pixels of one tile using the fringe points within halo
+# pixels of it. Returns None if there are not enough points
+def _interpolate_tile(canvas, ty, ty1, tx, tx1, halo):
+    height, width = canvas.fringes_image.shape
+    # The window of fringe data the tile's interpolation is based on
+    y0, x0 = max(ty-halo, 0), max(tx-halo, 0)
+    y1, x1 = min(ty1+halo, height), min(tx1+halo, width)
+    rows, columns = np.nonzero(canvas.fringes_image_clean[y0:y1, x0:x1])
+    if len(rows) < 3:
+        return None
+    values = canvas.fringe_phases[y0:y1, x0:x1][rows, columns]
+    try:
+        interpolation = LinearNDInterpolator(
+            np.transpose([rows+y0, columns+x0]), values, fill_value=-1024.0)
+    except (ValueError, RuntimeError):
+        # Qhull fails if all the points are on a line
+        return None
+    y, x = np.mgrid[ty:ty1, tx:tx1]
+    return interpolation(np.transpose([y.ravel(), x.ravel()])).reshape(ty1-ty, tx1-tx)
+
+
+# The number of pixels within the mask that a tile has no data for
+def _missing(result, mask):
+    if result is None:
+        return mask.size
+    return np.count_nonzero(np.logical_and(result == -1024.0, mask))
+
+
+# Interpolate one tile into canvas.interpolated. If the tile has pixels
+# without data within the mask, it is redone with the halo doubled, up to
+# max_halo. Returns whether there were any points to interpolate, and how
+# many times the halo was grown
+def _fill_tile(canvas, ty, tx, tile, halo, max_halo):
+    height, width = canvas.fringes_image.shape
+    ty1, tx1 = min(ty+tile, height), min(tx+tile, width)
+    size = halo
+    regrown = 0
+    result = _interpolate_tile(canvas, ty, ty1, tx, tx1, size)
+    mask = canvas.mask[ty:ty1, tx:tx1]
+    missing = _missing(result, mask)
+    # There's no point in growing the halo past the edges of the image,
+    # or if growing it didn't help (the pixels are outside of all the
+    # fringes, not just the ones near the tile)
+    while (missing and size < max_halo
+           and (ty-size > 0 or tx-size > 0 or ty1+size < height or tx1+size < width)):
+        size = min(2*size, max_halo)
+        regrown += 1
+        grown = _interpolate_tile(canvas, ty, ty1, tx, tx1, size)
+        if _missing(grown, mask) >= missing:
+            break
+        result = grown
+        missing = _missing(result, mask)
+    if result is None:
+        canvas.interpolated[ty:ty1, tx:tx1] = -1024.0
+        return False, regrown
+    canvas.interpolated[ty:ty1, tx:tx1] = result
+    return True, regrown
+
+
+# The Canvas a tile worker process is working on
+_worker_canvas = None
+
+
+def _start_worker(handle):
+    global _worker_canvas
+    _worker_canvas = m2sharing.attach_canvas(handle)
+
+
+# Fill a group of tiles in a worker process. The results go straight
+# into the shared canvas.interpolated
+def _fill_tiles(tiles, tile, halo, max_halo):
+    any_points = False
+    regrown = 0
+    for ty, tx in tiles:
+        points, grown = _fill_tile(_worker_canvas, ty, tx, tile, halo, max_halo)
+        any_points = any_points or points
+        regrown += grown
+    if isinstance(_worker_canvas.interpolated, np.memmap):
+        _worker_canvas.interpolated.flush()
+    return any_points, regrown, len(tiles)
+
+
+# Fill the tiles using a pool of worker processes. The Canvas arrays the
+# interpolation needs are put into shared memory (unless they are memmaps
+# already), so the workers read and write them without any copying.
+# Yields the number of tiles done so far and the halo regrowths
+def _fill_parallel(canvas, tiles, tile, halo, max_halo, workers):
+    # A few groups per worker, so that the work is spread evenly even if
+    # some tiles take longer than others
+    n_groups = min(len(tiles), 4*workers)
+    groups = [tiles[i::n_groups] for i in range(n_groups)]
+    with m2sharing.SharedBlocks() as blocks:
+        handle = m2sharing.share_canvas(canvas, blocks)
+        with ProcessPoolExecutor(workers, initializer=_start_worker,
+                                 initargs=(handle,)) as executor:
+            futures = [executor.submit(_fill_tiles, group, tile, halo, max_halo)
+                       for group in groups]
+            done = 0
+            for future in as_completed(futures):
+                # If a worker crashed, this raises (BrokenProcessPool), and
+                # the blocks are removed on the way out
+                points, regrown, n = future.result()
+                done += n
+                yield done, points, regrown
+
+
+# Interpolate a canvas one tile at a time, writing into canvas.interpolated
+# (which can be a memmap). This is the same linear interpolation as fast_tri,
+# and gives the same results as long as the halo is wide enough (except
+# where the triangulation is ambiguous, as for points on a circle). If a tile
+# has pixels without data within the mask, the tile is redone with the halo
+# doubled, up to max_halo (4 times the halo by default).
+# budget (in bytes) sets the tile size, unless it is given directly.
+# With more than one worker (WORKERS by default), the tiles are shared out
+# between that many processes
+@m2profiling.profiled("interpolate_tiled", lambda result, canvas, *args, **kwargs: {
+    'pixels': canvas.fringes_image.size})
+def interpolate_tiled(canvas, halo=64, tile=None, budget=None, max_halo=None,
+                      progress=None, workers=None):
+    progress = m2progress.wrap(progress)
+    if tile is None:
+        tile = tile_size(budget, halo)
+    if max_halo is None:
+        max_halo = 4*halo
+    if workers is None:
+        workers = WORKERS
+    height, width = canvas.fringes_image.shape
+    tiles = [(ty, tx) for ty in range(0, height, tile) for tx in range(0, width, tile)]
+    progress.stage("Interpolating tiles", 0, 100, tiles=len(tiles), regrown=0)
+    any_points = False
+    regrown = 0
+    if workers > 1 and len(tiles) > 1:
+        for done, points, grown in _fill_parallel(canvas, tiles, tile, halo,
+                                                  max_halo, workers):
+            any_points = any_points or points
+            regrown += grown
+            progress.update(done/len(tiles), regrown=regrown)
+    else:
+        for i, (ty, tx) in enumerate(tiles):
+            points, grown = _fill_tile(canvas, ty, tx, tile, halo, max_halo)
+            any_points = any_points or points
+            regrown += grown
+            progress.update((i+1)/len(tiles), regrown=regrown)
+    if isinstance(canvas.interpolated, np.memmap):
+        canvas.interpolated.flush()
+    if not any_points:
+        # Same as fast_tri, this means that no fringes were labelled
+        return None
+    canvas.interpolation_done = True
+    progress.done()
+    return True
+
+
+# The out-of-core version of pipeline.subtract. Instead of a masked array
+# this returns a float array with NaNs where there is no data, which is
+# written into out (a new raster in directory if None)
+def subtract_tiled(background, plasma, mask, out=None, directory=None,
+                   budget=None):
+    if out is None:
+        out = raster(background.shape, np.float64, directory=directory,
+                     name="subtracted")
+    for rows in bands(background.shape, 4*8, budget):
+        band = np.subtract(background[rows], plasma[rows], dtype=np.float64)
+        band[np.logical_or(np.logical_or(mask[rows] == False,
+                                         plasma[rows] == -1024.0),
+                           background[rows] == -1024.0)] = np.nan
+        out[rows] = band
+    return out
+
+
+# The out-of-core version of pipeline.plasma_density, working a band
+# at a time on a subtracted map with NaNs where there is no data
+def plasma_density_tiled(subtracted, offset, depth, wavelength, double,
+                         out=None, directory=None, budget=None):
+    # Imported here, as the pipeline module imports this one
+    from . import pipeline as m2pipeline
+    if depth is None or wavelength is None:
+        return None
+    if out is None:
+        out = raster(subtracted.shape, np.float64, directory=directory,
+                     name="density")
+    for rows in bands(subtracted.shape, 3*8, budget):
+        out[rows] = m2pipeline.plasma_density(np.asarray(subtracted[rows]),
+                                              offset, depth, wavelength, double)
+    return out
+
+
+# Convert a map into a float raster with NaNs where there is no data
+# (-1024, or outside of the mask), a band at a time. offset is subtracted
+# from the values
+def to_nan(data, mask=None, offset=0, out=None, directory=None, name="map",
+           budget=None):
+    if out is None:
+        out = raster(data.shape, np.float64, directory=directory, name=name)
+    for rows in bands(data.shape, 3*8, budget):
+        band = np.array(data[rows], dtype=np.float64)
+        band[band == -1024.0] = np.nan
+        band -= offset
+        if mask is not None:
+            band[mask[rows] == False] = np.nan
+        out[rows] = band
+    return out
@@ -23,12 +23,13 @@
 import numpy as np
 from scipy.spatial import Delaunay
 from scipy.interpolate import LinearNDInterpolator
-import matplotlib.pyplot as plt
-import tkinter as Tk
-import ctypes
 from time import sleep
 from . import graphics as m2graphics
-import magic2gui.matplotlib_frame as m2mframe
+from . import progress as m2progress
+from . import profiling as m2profiling
+# matplotlib.pyplot, tkinter and the GUI's modules are only needed for the
+# debug mode, so they are imported when it is used. This keeps the library
+# quick to import in headless mode
 
 # added_points = []
 
@@ -37,13 +38,18 @@ import magic2gui.matplotlib_frame as m2mframe
 # Delaunay triangulation, points that are used to create it, a list
 # of triangles and flat triangles. It's got methods used to retrieve a list
 # of all the triangles (for triplot for example) and an optimise function
-# that clears up flat fetures
+# that clears up flat fetures.
+# progress can be a magic2.progress.Progress object, an object with
+# a set(text, percent) method (like the GUI's status bar), or None to
+# print the progress to the terminal
 class Triangulation:
-    def __init__(self, points, canvas, status=None):
-        if status is not None:
-            status.set("Performing Delaunay triangulation",0)
-        else:
-            print("Performing Delaunay triangulation")
+    @m2profiling.profiled("Triangulation.__init__", lambda result, self, points, *args: {
+        'points': len(points), 'triangles': len(getattr(self, 'triangles', [])),
+        'flat': len(getattr(self, 'flat_triangles', []))})
+    def __init__(self, points, canvas, progress=None):
+        progress = m2progress.wrap(progress)
+        progress.stage("Performing Delaunay triangulation", 0, 5,
+                       points=len(points))
         # Store the points and their values
         self.points = points
         self.values = [canvas.fringe_phases[p[0], p[1]] for p in self.points]
@@ -58,37 +64,39 @@ class Triangulation:
         self.triangles = []
         # A list of the flat triangles' indices
         self.flat_triangles = []
-        if status is not None:
-            status.set("Building data structures", 5)
-        else:
-            print("Building the data")
+        n_triangles = len(self.dt.simplices)
+        progress.stage("Building data structures", 5, 15,
+                       triangles=n_triangles)
         # Create Triangle objects and add them to lists
-        for i in range(len(self.dt.simplices)):
+        for i in range(n_triangles):
             triangle = Triangle(self.dt, i, self.points, self.values)
             if triangle.flat:
                 self.flat_triangles.append(i)
             self.triangles.append(triangle)
-        # Print out some stats
-        if status is None:
-            print("Finished")
-            print("Flat triangles are {:0.2f} percent of the data".format(
-                len(self.flat_triangles)/len(self.triangles)))
-            print(len(self.flat_triangles), "flat triangles,",
-                  len(self.triangles), "triangles in total")
+            if i % 1024 == 0:
+                progress.update(i/n_triangles, flat=len(self.flat_triangles))
+        # Report some stats
+        progress.finish(flat=len(self.flat_triangles))
 
     # Get a list of all the triangles. Each elements is a list of three indices
     # pointing to vertices in self.points
     def get_simplices(self):
         return [triangle.vertices for triangle in self.triangles]
 
-    def optimise(self, status=None):
-        if status is not None:
-            status.set("Removing flat triangles", 15)
-        else:
-            print("Removing flat triangles")
+    @m2profiling.profiled("optimise", lambda result, self, *args: {
+        'points': len(self.points), 'triangles': len(self.triangles),
+        'flat': len(self.flat_triangles)})
+    def optimise(self, progress=None):
+        progress = m2progress.wrap(progress)
         # Initial length of the flat triangle list is stored to keep track
         # of our progress
         initial_len = len(self.flat_triangles)
+        # Keep count of what has been done, for reporting
+        flipped = 0
+        added = 0
+        sweeps = 0
+        progress.stage("Removing flat triangles", 15, 70, flat=initial_len,
+                       flipped=0, points_added=0, sweeps=0)
         # This loop will run until no further changes are possible
         changes = 1
         while changes:
@@ -158,17 +166,22 @@ class Triangulation:
                         del self.flat_triangles[i]
                         # ...and increment the change counter
                         changes += 1
+                        flipped += 1
                     else:
                         # Otherwise, add a point in the middle of the line
                         # shared by the triangles
                         self.add_point(triangle, neighbour, op1, op2)
                         del self.flat_triangles[i]
                         changes += 1
+                        added += 1
             # This indicates how many flat triangles we have processed
-            if status is not None:
-                status.set("Removing flat triangles", 15+55*(1-len(self.flat_triangles)/initial_len))
-            else:
-                print(1-len(self.flat_triangles)/initial_len)
+            sweeps += 1
+            if initial_len:
+                progress.update(1-len(self.flat_triangles)/initial_len,
+                                flat=len(self.flat_triangles), flipped=flipped,
+                                points_added=added, sweeps=sweeps)
+        progress.finish(flat=len(self.flat_triangles), flipped=flipped,
+                        points_added=added, sweeps=sweeps)
 
     def switch_triangles(self, triangle, neighbour, op1, op2):
         # print("switching", triangle.index, neighbour.index,
@@ -281,15 +294,19 @@ class Triangulation:
         triangle.flat = False
 
     # Interpolate the data based on the calculated triangulation
-    def interpolate(self, canvas, status=None):
+    @m2profiling.profiled("interpolate", lambda result, self, canvas, *args: {
+        'pixels': canvas.fringes_image.size, 'triangles': len(self.triangles)})
+    def interpolate(self, canvas, progress=None):
+        progress = m2progress.wrap(progress)
         # Clear the interpolated canvas
         canvas.interpolated = np.zeros_like(canvas.fringes_image)-1024.0
-        if status is not None:
-            status.set("Performing the interpolation", 70)
-        else:
-            print("Performing the interpolation")
+        n_triangles = len(self.triangles)
+        progress.stage("Performing the interpolation", 70, 100,
+                       triangles=n_triangles)
         # Iterate over all the triangles in the triangulation
-        for triangle in self.triangles:
+        for i, triangle in enumerate(self.triangles):
+            if i % 256 == 0:
+                progress.update(i/n_triangles)
             # Create a shortcut to the triangle's vertices
             co = triangle.vert_coordinates
             # Calculate a few constants for the Barycentric Coordinates
@@ -337,6 +354,7 @@ class Triangulation:
             # Change the points in the actual canvas
             canvas.interpolated[ymin:ymax, xmin:xmax][mask] = slice[mask]
         canvas.interpolation_done = True
+        progress.finish()
 
 
 # Calculate the distance between two points in the points list
@@ -416,48 +434,153 @@ class TriangleCopy(Triangle):
 
 # This is the main interpolation method, using a special algorithm to
 # remove all flat triangles that are possible to remove
-def triangulate(canvas, ax, status):
+@m2profiling.profiled("triangulate", lambda result, canvas, *args: {
+    'pixels': canvas.fringes_image.size})
+def triangulate(canvas, ax, progress=None):
+    progress = m2progress.wrap(progress)
     # Create a Triangulation object
     tri = Triangulation(np.transpose(
                         np.nonzero(canvas.fringes_image_clean)),
-                        canvas, status)
+                        canvas, progress)
     # Check if an error has been encountered (this would be due to the
     # user not labelling any fringes)
     if tri.error:
         return None
     else:
         # If the triangulation was succesfull, optimise it...
-        tri.optimise(status)
+        tri.optimise(progress)
         # ...and perform the interpolation
-        tri.interpolate(canvas, status)
-        status.set("Done", 100)
+        tri.interpolate(canvas, progress)
+        progress.done()
         return True
 
 
 # This is a quick interpolation method that does not bother with fixing
 # flat triangles. It uses standard numpy functions, which makes it faster
-def fast_tri(canvas, ax, status):
-    if status is not None:
-        status.set("Creating the interpolant", 0)
+@m2profiling.profiled("fast_tri", lambda result, canvas, *args: {
+    'pixels': canvas.fringes_image.size,
+    'points': int(np.count_nonzero(canvas.fringes_image_clean))})
+def fast_tri(canvas, ax, progress=None):
+    progress = m2progress.wrap(progress)
     # Create a list of the points for the triangulation
     points = np.transpose(np.nonzero(canvas.fringes_image_clean))
+    progress.stage("Creating the interpolant", 0, 60, points=len(points))
     try:
         # Create an interpolation object. The second argument is a list
         # of values for all the supplied points
         interpolation = LinearNDInterpolator(points, [canvas.fringe_phases[p[0], p[1]] for p in points], fill_value=-1024.0)
-        status.set("Calculating values for points on canvas", 60)
+        progress.stage("Calculating values for points on canvas", 60, 100,
+                       pixels=canvas.fringes_image.size)
         # This calls the interpolant's calculating function and returns values
         # for every point on the canvas. This is then reshaped to fit the
         # original image
         canvas.interpolated = np.reshape(interpolation.__call__([canvas.xy]), canvas.fringes_image.shape)
         canvas.interpolation_done = True
-        status.set("Done", 100)
+        progress.done()
         return True
     except ValueError:
         # This will happen if no fringes were labelled
         return None
 
 
+# This performs the fast interpolation a piece at a time, so that a preview
+# can be shown long before the whole canvas is done. First the interpolant
+# is calculated on a coarse grid (every stride-th pixel) and stretched over
+# the canvas, then a chosen area (like the part of the image that is on the
+# screen) is done at full resolution, and then the rest of the canvas.
+# The final result is the same as that of fast_tri (up to rounding).
+# chunk is the number of pixels calculated between the steps
+class ProgressiveInterpolation:
+    def __init__(self, canvas, stride=8, chunk=2**17, progress=None):
+        self.progress = m2progress.wrap(progress)
+        self.progress.stage("Creating the interpolant", 0, 5)
+        self.canvas = canvas
+        self.stride = stride
+        self.chunk = chunk
+        points = np.transpose(np.nonzero(canvas.fringes_image_clean))
+        self.error = False
+        try:
+            self.interpolation = LinearNDInterpolator(
+                points, canvas.fringe_phases[points[:, 0], points[:, 1]],
+                fill_value=-1024.0)
+        except ValueError:
+            # This will happen if no fringes were labelled
+            self.error = True
+            return None
+        self.shape = canvas.fringes_image.shape
+        # The values are written directly into the canvas, so that whatever
+        # is displaying it shows the latest version
+        self.values = canvas.interpolated = np.zeros(self.shape)-1024.0
+        canvas.interpolation_done = False
+        # Which pixels have their final values
+        self.done = np.zeros(self.shape, dtype=bool)
+
+    # Calculate the interpolant at the given rows and columns
+    def _evaluate(self, rows, columns):
+        return self.interpolation(np.transpose([rows, columns]))
+
+    # Fill the canvas with a preview calculated on a coarse grid
+    def coarse(self):
+        height, width = self.shape
+        rows, columns = np.meshgrid(np.arange(0, height, self.stride),
+                                    np.arange(0, width, self.stride),
+                                    indexing='ij')
+        preview = self._evaluate(rows.ravel(), columns.ravel()).reshape(rows.shape)
+        # Every coarse value covers a stride x stride block of pixels
+        preview = np.repeat(np.repeat(preview, self.stride, axis=0),
+                            self.stride, axis=1)[:height, :width]
+        self.values[~self.done] = preview[~self.done]
+
+    # Calculate the final values in an area, a band of rows at a time,
+    # yielding the fraction of the area done after every band
+    def refine(self, ymin=0, ymax=None, xmin=0, xmax=None):
+        height, width = self.shape
+        ymax = height if ymax is None else min(ymax, height)
+        xmax = width if xmax is None else min(xmax, width)
+        ymin, xmin = max(ymin, 0), max(xmin, 0)
+        if ymax <= ymin or xmax <= xmin:
+            return
+        band = max(1, self.chunk // (xmax-xmin))
+        for start in range(ymin, ymax, band):
+            end = min(start+band, ymax)
+            # Only the pixels that are not done yet need calculating
+            rows, columns = np.nonzero(~self.done[start:end, xmin:xmax])
+            if len(rows):
+                rows += start
+                columns += xmin
+                self.values[rows, columns] = self._evaluate(rows, columns)
+                self.done[rows, columns] = True
+            yield (end-ymin) / (ymax-ymin)
+
+    # Go through all the steps of the interpolation. This yields
+    # a (stage, finished) tuple after every chunk of work, finished being
+    # True when there is a new version worth displaying. view is an optional
+    # (ymin, ymax, xmin, xmax) area that is done before the rest
+    def steps(self, view=None):
+        self.progress.stage("Calculating a preview", 5, 10)
+        self.coarse()
+        yield ("preview", True)
+        if view is not None:
+            self.progress.stage("Interpolating the visible area", 10, 40)
+            for fraction in self.refine(*view):
+                self.progress.update(fraction)
+                yield ("view", False)
+            yield ("view", True)
+        self.progress.stage("Interpolating the rest", 40, 100)
+        for fraction in self.refine():
+            self.progress.update(fraction)
+            yield ("rest", False)
+        self.canvas.interpolation_done = True
+        self.progress.done()
+        yield ("rest", True)
+
+    # Do everything at once
+    def run(self, view=None):
+        for step in self.steps(view):
+            pass
+        return True
+
+
 # Here be dragons
 # On a more serious note, this function was used while creating this software.
 # It didn't have a GUI, so this just displays output in separate matplotlib
@@ -472,9 +595,10 @@ def triangulate_debug(canvas, options=None):
     # closed (and that's not very useful). By redefining plt we are able to
     # leave the code in this function alone, so that it still works in
     # headless mode (with main_old.py)
-    global plt
     if options is not None:
         plt = DebugWindow(options)
+    else:
+        import matplotlib.pyplot as plt
     tri = Triangulation(np.transpose(
                         np.nonzero(canvas.fringes_image_clean)),
                         canvas)
@@ -515,6 +639,9 @@ class DebugWindow:
         self.window = None
 
     def make_window(self):
+        import tkinter as Tk
+        import ctypes
+        import magic2gui.matplotlib_frame as m2mframe
         # Create a window for the graph
         window = self.window = Tk.Toplevel()
         window.wm_title("Debug mode interpolation")
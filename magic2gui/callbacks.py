@@ -25,20 +25,22 @@ import tkinter.messagebox as mb
 import tkinter as Tk
 import tkinter.ttk as ttk
 import numpy as np
-from copy import copy
-import pickle
-import gzip
 import os
+import time
 import webbrowser
-from matplotlib.pyplot import cm
 import matplotlib.ticker as ticker
 
 import magic2gui.dialog as m2dialog
 import magic2gui.lineouts as m2lineouts
+import magic2gui.regions as m2regions
 import magic2.graphics as m2graphics
 import magic2.fringes as m2fringes
 import magic2.labelling as m2labelling
 import magic2.triangulate as m2triangulate
+import magic2.m2file as m2file
+import magic2.memory as m2memory
+import magic2.export as m2export
+import magic2.pipeline as m2pipeline
 
 
 # Open and image for either the background or plasma fringes (determined
@@ -66,8 +68,7 @@ def open_image(options, env):
             if options.objects[env]['canvas'] is not None:
                 del options.objects[env]['canvas']
                 del options.objects[env]['fringes']
-                del options.subtracted
-                options.subtracted = None
+                m2pipeline.set_canvas(options.graph, env, None)
             # Create a canvas object
             canvas = options.objects[env]['canvas'] = m2graphics.Canvas(filename)
             if canvas.error:
@@ -81,59 +82,34 @@ def open_image(options, env):
             options.status.set("Rendering fringes", 66)
             # Render the fringes onto the canvas
             m2graphics.render_fringes(fringes, canvas, width=options.width_var.get())
+            # Give the canvas to the processing graph. This makes the software
+            # go over the interpolation, subtraction and plasma density
+            # calculation again, as the data has changed
+            m2pipeline.set_canvas(options.graph, env, canvas)
+            options.offset = 0
             # Reset the image limits
             options.conserve_limits = False
             # Set the mode (the set_mode function handles rendering)
             options.mode = env + "_fringes"
             set_mode(options)
-            # Make the software go over the subtraction and plasma density
-            # calculation again, as the data has changed
-            options.subtracted = None
-            options.density = None
-            options.offset = 0
             options.status.set("Done", 100)
 
 
-# Save the minimum of the data necessary to reconstruct the labelling.
-# We are not saving all the data, not even the interpolations, as they
-# greatly increase the file size required (pictures are big). What we do
-# save are the boolean array representing fringes and the user-defined mask,
-# and a list of all the assigned phases. As the fringe-reading process is
-# completely deterministic, the labelling will be assigned in the correct order
+# Save the minimum of the data necessary to reconstruct the labelling
+# (see magic2/m2file.py for the details of the format)
 def m_save(options):
     filename = fd.asksaveasfilename(filetypes=[("Magic2 file", "*.m2")],
                                     defaultextension=".m2",
                                     initialfile=options.namecore)
     if filename != '':
         options.status.set("Exporting", 0)
-        dump = []
-        try:
-            dump.append(options.objects['background']['canvas'].fringes_image)
-            dump.append(options.objects['background']['canvas'].mask)
-            dump.append([fringe.phase for fringe in options.objects['background']['fringes'].list])
-        except AttributeError:
-            dump = [None, None, None]
-        try:
-            dump.append(options.objects['plasma']['canvas'].fringes_image)
-            dump.append(options.objects['plasma']['canvas'].mask)
-            dump.append([fringe.phase for fringe in options.objects['plasma']['fringes'].list])
-        except AttributeError:
-            dump = dump[:3]
-            dump.append(None)
-            dump.append(None)
-            dump.append(None)
-        dump.append(options.offset)
-        dump.append(options.namecore)
-        dump.append(options.resolution)
-        dump.append(options.depth)
-        dump.append(options.wavelength)
-        dump.append(options.double)
-        dump.append(options.centre)
-        # We use gzip to make the file smaller. Normal pickling produced files
-        # that were around 30MB, while the compressed version of the same data
-        # is 188KB
-        with gzip.open(filename, 'wb') as f:
-            pickle.dump(dump, f)
+        m2file.write(filename,
+                     background=(options.objects['background']['canvas'],
+                                 options.objects['background']['fringes']),
+                     plasma=(options.objects['plasma']['canvas'],
+                             options.objects['plasma']['fringes']),
+                     **{name: getattr(options, name)
+                        for name in m2file.SHOT_OPTIONS})
         options.status.set("Done", 100)
 
 
@@ -143,73 +119,49 @@ def m_open(options, interpolate = None):
         return False
     filename = fd.askopenfile(filetypes=[("Magic2 files", "*.m2")])
     if filename is not None:
-        # We need to use gzip to decompress the .m2 file
-        with gzip.open(filename.name, 'rb') as f:
-            options.status.set("Loading file", 0)
-            dump = pickle.load(f)
-            for env, i in (('background', 0), ('plasma', 3)):
-                if dump[i] is not None:
-                    # Delete the old data
-                    if options.objects[env]['canvas'] is not None:
-                        del options.objects[env]['canvas']
-                        del options.objects[env]['fringes']
-                        del options.subtracted
-                    options.status.set("Reading "+env+" canvas", i%2*45 + 10)
-                    # Create a new Canvas object
-                    canvas = options.objects[env]['canvas'] = m2graphics.Canvas('dump', fi=dump[i], m=dump[i+1])
-                    options.status.set("Finding "+env+" fringes", i%2*45 + 20)
-                    # Create a new fringes object
-                    fringes = options.objects[env]['fringes'] = m2fringes.Fringes()
-                    # Set the max and min for the colormap to have a correct scale
-                    fringes.min = np.amin([phase for phase in dump[i+2] if phase != -2048.0])
-                    fringes.max = np.amax([phase for phase in dump[i+2] if phase != -2048.0])
-                    # Read the fringes, assigning phases as we go
-                    m2fringes.read_fringes(fringes, canvas, phases=dump[i+2])
-                    options.status.set("Rendering "+env+" fringes", i%2*45 + 35)
-                    # Render the fringes
-                    m2graphics.render_fringes(fringes, canvas, width=options.width_var.get())
-                    # Indicate that the subtracted and density maps need to be
-                    # recalculated
-                    options.subtracted = None
-                    options.density = None
-            # Set the shot options
-            options.offset = dump[6]
-            options.namecore = dump[7]
-            options.status.set_name_label(options.namecore)
-            options.resolution = dump[8]
-            options.depth = dump[9]
-            options.wavelength = dump[10]
-            options.double = dump[11]
-            # For saved variables introduced in v1.02
-            try:
-                options.centre = dump[12]
-            except IndexError:
-                # The centre option is set to a default of [0, 0] when creating
-                # the Options object.
-                pass
-            options.status.set("Done", 100)
-            # If data is available for either background or plasma fringes,
-            # display them
-            if dump[0] is not None:
-                options.conserve_limits = False
-                options.mode = "background_fringes"
-                set_mode(options)
-            elif dump[3] is not None:
-                options.conserve_limits = False
-                options.mode = "plasma_fringes"
-                set_mode(options)
-            # Allow for automatic interpolation of the just-loaded
-            # interfererograms
-            if interpolate == "fast":
-                if dump[0] is not None:
-                    interpolate_fast(options, env='background')
-                if dump[3] is not None:
-                    interpolate_fast(options, env='plasma')
-            elif interpolate == "exact":
-                if dump[0] is not None:
-                    interpolate_exact(options, env='background')
-                if dump[3] is not None:
-                    interpolate_exact(options, env='plasma')
+        options.status.set("Loading file", 0)
+        shot = m2file.read(filename.name)
+        for env, start in (('background', 0), ('plasma', 45)):
+            if shot[env] is not None:
+                # Delete the old data
+                if options.objects[env]['canvas'] is not None:
+                    del options.objects[env]['canvas']
+                    del options.objects[env]['fringes']
+                    m2pipeline.set_canvas(options.graph, env, None)
+                # Create new Canvas and Fringes objects
+                canvas, fringes = m2file.load_canvas(*shot[env],
+                                                     width=options.width_var.get(),
+                                                     progress=options.progress,
+                                                     env=env, start=start)
+                options.objects[env]['canvas'] = canvas
+                options.objects[env]['fringes'] = fringes
+                # Hand the canvas over to the processing graph, which
+                # means that the maps depending on it will be recalculated
+                m2pipeline.set_canvas(options.graph, env, canvas)
+        # Set the shot options. The centre option is set to a default
+        # of [0, 0] for files saved before v1.02
+        for name in m2file.SHOT_OPTIONS:
+            setattr(options, name, shot[name])
+        options.status.set_name_label(options.namecore)
+        options.status.set("Done", 100)
+        # If data is available for either background or plasma fringes,
+        # display them
+        if shot['background'] is not None:
+            options.conserve_limits = False
+            options.mode = "background_fringes"
+            set_mode(options)
+        elif shot['plasma'] is not None:
+            options.conserve_limits = False
+            options.mode = "plasma_fringes"
+            set_mode(options)
+        # Allow for automatic interpolation of the just-loaded
+        # interfererograms
+        for env in ('background', 'plasma'):
+            if shot[env] is not None:
+                if interpolate == "fast":
+                    interpolate_fast(options, env=env)
+                elif interpolate == "exact":
+                    interpolate_exact(options, env=env)
 
 
 # This dialog is used for exporting the graph as an image.
@@ -244,24 +196,67 @@ def set_namecore(options):
         options.status.set_name_label(options.namecore)
 
 
+# The file types data can be exported as (the format is chosen by the
+# extension, see magic2/export.py)
+EXPORT_FILETYPES = [(".npy array (float32)", "*.npy"),
+                    (".npz archive (float32 and metadata)", "*.npz"),
+                    ("Raw float32 and .json description", "*.raw"),
+                    ("16-bit TIFF", "*.tif"),
+                    (".csv file", "*.csv"),
+                    ("All files", "*")]
+
+
+# The units and shot options stored with exported data
+def export_metadata(options, mode=None):
+    if mode is None:
+        mode = options.mode
+    key = mode.split("_")
+    units = {'fringes': "fringe number", 'map': "fringes",
+             'cosine': "cosine of the phase"}
+    metadata = {'name': options.namecore, 'mode': mode,
+                'units': ("line-integrated electron density (cm^-2)" if key[0] == 'density'
+                          else "electron density (cm^-3)" if key[0] == 'abel'
+                          else "fringe shift" if key[0] == 'subtracted'
+                          else units.get(key[1], "")),
+                'pixel_units': "px",
+                'wavelength_nm': options.wavelength, 'depth_mm': options.depth,
+                'double': options.double, 'offset': options.offset,
+                'resolution_px_per_mm': options.resolution}
+    if key[0] == 'density' or key[0] == 'abel':
+        metadata['centre_px'] = list(options.centre)
+    if key[0] == 'abel':
+        metadata['abel_method'] = options.abel_method
+    if key[0] in ('subtracted', 'density', 'abel') and options.registration is not None:
+        # The transform the background was resampled with, (dy, dx) in
+        # pixels and the angle in degrees
+        metadata['registration'] = options.registration
+        metadata['background_transform'] = options.graph.cached('transform')
+        # Whether the estimate was confident enough to be used (the
+        # background is left as it is otherwise)
+        estimate = options.graph.cached('registration_estimate')
+        if estimate is not None:
+            metadata['registration_confidence'] = estimate.confidence
+            metadata['registration_accepted'] = estimate.accepted
+    return metadata
+
+
 # Export the data from the current view
 def export(options):
     if options.mode is not None:
-        filename = fd.asksaveasfilename(filetypes=[(".csv file", "*.csv"),
-                                                   ("All files", "*")],
-                                        defaultextension=".csv",
+        filename = fd.asksaveasfilename(filetypes=EXPORT_FILETYPES,
+                                        defaultextension=".npy",
                                         initialfile=options.namecore)
         if filename != '':
-            options.status.set("Exporting", 0)
             # The mask is filled with -1024 to make the masking uniform
             if options.mode.split("_")[1] == 'fringes':
-                fringe_phases = options.objects[options.mode.split("_")[0]]['canvas'].fringe_phases.astype(float)
-                np.savetxt(filename, np.ma.filled(
-                    np.ma.masked_where(fringe_phases==-1024.0, fringe_phases),
-                    fill_value=np.nan), delimiter=",", fmt="%.0f")
+                fringe_phases = options.objects[options.mode.split("_")[0]]['canvas'].fringe_phases
+                data = np.ma.masked_where(fringe_phases == -1024.0, fringe_phases)
+                fmt = "%.0f"
             else:
-                np.savetxt(filename, np.ma.filled(options.imshow.get_array(),fill_value=np.nan), delimiter=",")
-            options.status.set("Done", 100)
+                data = options.imshow.get_array()
+                fmt = "%.18e"
+            m2export.save(filename, data, export_metadata(options), fmt=fmt,
+                          progress=options.progress)
     else:
         mb.showinfo("No mode chosen", "Please choose one of the display modes from the menu on the right!")
 
@@ -308,6 +303,25 @@ def export_image(options=None, fig=None):
                 fig.savefig(filename, dpi=dialog.result)
 
 
+# Save the current view's data as a PNG with one pixel per data pixel,
+# coloured the same way as on the screen (without the axes)
+def export_data_image(options):
+    if options.mode is not None and options.imshow is not None:
+        filename = fd.asksaveasfilename(filetypes=[("PNG files", "*.png;*.PNG"),
+                                                   ("All files", "*")],
+                                        defaultextension=".png",
+                                        initialfile=options.namecore)
+        if filename != '':
+            colorbar = mb.askyesno("Colorbar", "Add a colorbar strip on the right?")
+            options.status.set("Exporting", 0)
+            m2export.save_png(filename, options.imshow.get_array(),
+                              options.imshow.get_cmap(), norm=options.imshow.norm,
+                              colorbar=colorbar, metadata=export_metadata(options))
+            options.status.set("Done", 100)
+    else:
+        mb.showinfo("No mode chosen", "Please choose one of the display modes from the menu on the right!")
+
+
 # This dialog is used by the function that sets the colormap
 class CmapDialog(m2dialog.Dialog):
     def __init__(self, parent, options, title=None, parent_mframe=None):
@@ -361,21 +375,23 @@ class CmapDialog(m2dialog.Dialog):
 def set_colormap(options):
     dialog = CmapDialog(options.root, options, parent_mframe=options.mframe)
     if dialog.result is not None:
-        options.cmap = copy(cm.get_cmap(dialog.result))
-        # White is for masking
-        options.cmap.set_bad('white', 1.0)
-        # Black is for unlabelled fringes
-        options.cmap.set_under('black', 1.0)
-        # Refresh the graph if needed
-        if options.mode is not None:
-            set_mode(options)
+        # White is for masking, black is for unlabelled fringes
+        options.cmap = m2graphics.make_cmap(dialog.result)
+        # Restyle the image (the colorbar follows it), leaving the data
+        # alone. The cosine view stays grey
+        if options.mode is not None and options.imshow is not None and "cosine" not in options.mode:
+            options.imshow.set_cmap(options.cmap)
+            # The labeller's animation has to pick up the new background
+            if options.labeller is not None:
+                options.labeller.ani._blit_cache.clear()
+            options.fig.canvas.draw_idle()
 
 
 class FastExactDialog(m2dialog.Dialog):
     def body(self, master):
         labelframe = Tk.Frame(master, bg='#fff')
         labelframe.pack(fill=Tk.BOTH, expand=1)
-        label = Tk.Label(labelframe, text="Choose an interpolation mode. The fast one is fast, but less exact. The slow one removes flat triangles from the triangulation that is used when interpolating.", background='#fff', wraplength=350, padx=15, pady=15, justify=Tk.LEFT, anchor=Tk.W)
+        label = Tk.Label(labelframe, text="Choose an interpolation mode. The fast one is fast, but less exact. The slow one removes flat triangles from the triangulation that is used when interpolating. The preview does the fast interpolation, but shows a rough version straight away and the visible area next, so that you can look for labelling mistakes while the rest is done.", background='#fff', wraplength=350, padx=15, pady=15, justify=Tk.LEFT, anchor=Tk.W)
         label.pack(fill=Tk.BOTH, expand=1)
 
     # Create the buttons
@@ -385,6 +401,8 @@ class FastExactDialog(m2dialog.Dialog):
         w.pack(side=Tk.RIGHT, padx=5, pady=5)
         w = ttk.Button(box, text="Slow and exact", width=15, command=self.slow)
         w.pack(side=Tk.RIGHT, padx=5, pady=5)
+        w = ttk.Button(box, text="Preview", width=10, command=self.progressive)
+        w.pack(side=Tk.RIGHT, padx=5, pady=5)
         w = ttk.Button(box, text="Fast", width=10, command=self.fast,
                        default=Tk.ACTIVE)
         w.pack(side=Tk.RIGHT, padx=5, pady=5)
@@ -400,6 +418,10 @@ class FastExactDialog(m2dialog.Dialog):
         self.result = "Slow"
         self.ok()
 
+    def progressive(self):
+        self.result = "Progressive"
+        self.ok()
+
 
 # Handle the user choosing one of the radio buttons
 def show_radio(options):
@@ -417,7 +439,8 @@ def show_radio(options):
             set_mode(options)
         # If the user wants the interpolated map, check if it exists...
         elif key[1] == 'map':
-            if options.objects[key[0]]['canvas'].interpolation_done:
+            if (options.graph.is_valid(key[0] + '_map')
+                    or key[0] in options.progressive):
                 options.mode = "_".join(key)
                 set_mode(options)
             # ...if not, give the user the option to generate one
@@ -427,6 +450,8 @@ def show_radio(options):
                     interpolate_exact(options, key[0])
                 elif dialog.result == "Fast":
                     interpolate_fast(options, key[0])
+                elif dialog.result == "Progressive":
+                    interpolate_progressive(options, key[0])
 
     # If the user wants the subtracted map, show it or calculate it and show it
     # (the calculation is a quick process, so it doesn't make sense to ask
@@ -444,6 +469,13 @@ def show_radio(options):
         else:
             options.mode = "_".join(key)
             set_mode(options)
+    # And its Abel inversion
+    elif key[0] == 'abel':
+        if options.abel is None:
+            abel_invert(options)
+        else:
+            options.mode = "_".join(key)
+            set_mode(options)
     # Give the focus back to the graph
     options.mframe.canvas._tkcanvas.focus_set()
 
@@ -462,15 +494,109 @@ def recompute(event, options):
             pass
     if key[1] == 'map':
         options.show_var.set(event.widget['value'])
-        if options.objects[key[0]]['canvas'] is not None:
-            options.objects[key[0]]['canvas'].interpolation_done = False
+        options.graph.invalidate(key[0] + '_map')
         # Let the show_radio function handle all the logic and dialogs
         # that are needed here
         show_radio(options)
     elif key[0] == 'subtracted':
+        options.graph.invalidate('subtracted')
         subtract(options)
     elif key[0] == 'density':
+        options.graph.invalidate('density')
         plasma_density(options)
+    elif key[0] == 'abel':
+        options.graph.invalidate('abel')
+        abel_invert(options)
+
+
+# The array shown in a display mode. It is taken from the display cache
+# if the data it's made from hasn't changed since it was last shown
+def display_array(options, key):
+    graph = options.graph
+    # Whether the array is the graph's own (see magic2gui/display_cache.py)
+    shared = False
+    if key[1] == 'fringes':
+        canvas = options.objects[key[0]]['canvas']
+        # The fringes image is masked where there is no data. Changing the
+        # width redraws the fringes without relabelling them
+        versions = (graph.nodes[key[0] + '_canvas'].version, options.width_var.get())
+        build = lambda: np.ma.masked_where(canvas.fringe_phases_visual == -1024,
+                                           canvas.fringe_phases_visual)
+    elif key[1] == 'map':
+        canvas = options.objects[key[0]]['canvas']
+        # The map image is masked where there is no interpolation data and
+        # on the user-defined mask. NaN maps already are, so they are shown
+        # as they are
+        versions = (graph.nodes[key[0] + '_canvas'].version,
+                    graph.nodes[key[0] + '_map'].version)
+        if m2pipeline.is_nan_array(canvas.interpolated):
+            build = lambda: canvas.interpolated
+            shared = True
+        else:
+            build = lambda: np.ma.masked_where(
+                np.logical_or(canvas.mask == False, canvas.interpolated == -1024.0),
+                canvas.interpolated)
+    elif key[0] == 'subtracted':
+        versions = (graph.nodes['subtracted'].version, graph.nodes['offset'].version)
+        build = lambda: options.subtracted - options.offset
+    elif key[0] == 'density':
+        versions = (graph.nodes['density'].version,)
+        build = lambda: options.density
+        shared = True
+    else:
+        versions = (graph.nodes['abel'].version,)
+        build = lambda: options.abel
+        shared = True
+    return options.display_cache.get("_".join(key), versions, build, shared)
+
+
+# Show data on the graph. There is a single image artist, created the first
+# time this is called, and from then on only its data, extent, colormap and
+# colour limits are changed. extent defaults to the pixels of the data, and
+# labels is an optional (x label, y label) pair. The display limits are set
+# to the extent (set_mode restores them if they are to be conserved).
+# Returns the image artist
+def show_image(options, data, extent=None, labels=("", "")):
+    if extent is None:
+        # The same as imshow's default extent
+        extent = (-0.5, data.shape[1]-0.5, data.shape[0]-0.5, -0.5)
+    if options.imshow is None or options.imshow.axes is not options.ax:
+        # Get rid of the placeholder image
+        for image in list(options.ax.images):
+            image.remove()
+        options.imshow = options.mframe.imshow(data, cmap=options.cmap, extent=extent)
+    else:
+        options.imshow.set_data(data)
+        options.imshow.set_extent(extent)
+        options.imshow.set_cmap(options.cmap)
+        # Fit the colour limits to the new data, the way imshow does
+        options.imshow.autoscale()
+    options.ax.set_xlim(extent[0], extent[1])
+    options.ax.set_ylim(extent[2], extent[3])
+    options.ax.set_xlabel(labels[0])
+    options.ax.set_ylabel(labels[1])
+    return options.imshow
+
+
+# Show the colorbar with the given label, or hide it if the label is None.
+# The colorbar is created once and follows the image artist's colour
+# limits and colormap from then on
+def show_colorbar(options, label):
+    cax = options.mframe.cax
+    if label is None:
+        cax.set_visible(False)
+        return
+    if options.cbar is None or options.cbar.mappable is not options.imshow:
+        if options.cbar is not None:
+            cax.clear()
+        # Add a colorbar using its own subplot
+        options.cbar = options.fig.colorbar(options.imshow, cax=cax)
+    # Unhide the colorbar's subplot
+    cax.set_visible(True)
+    cax.axis('on')
+    # Add a label. Rotate is so that it's easier to read, labelpad
+    # stops it from touching the colorbar's ticks' labels
+    options.cbar.ax.set_ylabel(label, rotation=270, labelpad=20)
 
 
 # Render the correct image on the graph's canvas
@@ -486,65 +612,43 @@ def set_mode(options):
         xlim = options.ax.get_xlim()
     if options.lineout_meta is not None:
         m2lineouts.stop_lineout(options)
-    # Clear the axes and all labellers/event handlers attached to them
-    # (if they exist)
-    options.ax.clear()
+    # Stop the labeller and its event handlers (if it exists)
     if options.labeller is not None:
         m2labelling.stop_labelling(options.fig, options.labeller, options.mframe)
         options.labeller = None
-    if options.cbar is not None:
-        # If there exists a colorbar, clean it and hide it
-        options.mframe.cax.clear()
-        options.mframe.cax.axis('off')
-        options.cbar = None
     if key[1] == 'fringes':
         canvas = options.objects[key[0]]['canvas']
         fringes = options.objects[key[0]]['fringes']
-        # The fringes image is masked where there is no data
-        options.imshow = canvas.imshow = options.ax.imshow(
-            np.ma.masked_where(canvas.fringe_phases_visual == -1024,
-                               canvas.fringe_phases_visual),
-            cmap=options.cmap
-        )
+        canvas.imshow = show_image(options, display_array(options, key))
         # The small increment is included to make the limits work when all fringes
         # are unlabelled
         canvas.imshow.set_clim(fringes.min, fringes.max+0.0000000001)
+        show_colorbar(options, None)
     elif key[1] == 'map':
         canvas = options.objects[key[0]]['canvas']
-        # The map image is masked where there is no interpolation data and
-        # on the user-defined mask
-        options.imshow = canvas.imshow = options.ax.imshow(
-            np.ma.masked_where(np.logical_or(canvas.mask == False, canvas.interpolated == -1024.0),
-                               canvas.interpolated),
-            cmap=options.cmap
-        )
+        canvas.imshow = show_image(options, display_array(options, key))
+        show_colorbar(options, None)
     elif key[0] == 'subtracted':
         # Show the subtracted image
         # note: this function works on the assumption that the things it is
         # attempting to show have been generated previously. It is the burden
         # of event handlers to check whether this is corrct
-        options.imshow = options.ax.imshow(options.subtracted-options.offset, cmap=options.cmap)
-        # Add a colorbar using its own subplot
-        options.cbar = options.fig.colorbar(options.imshow, cax=options.mframe.cax)
-        # Unhide the colorbar's subplot
-        options.mframe.cax.axis('on')
-        # Add a label. Rotate is so that it's easier to read, labelpad
-        # stops it from touching the colorbar's ticks' labels
-        options.cbar.ax.set_ylabel('Fringe shift', rotation=270, labelpad=20)
-    elif key[0] == 'density':
-        y_size, x_size = options.density.shape
+        show_image(options, display_array(options, key))
+        show_colorbar(options, 'Fringe shift')
+    elif key[0] == 'density' or key[0] == 'abel':
+        data = display_array(options, key)
+        y_size, x_size = data.shape
         extent = np.array([0-options.centre[1],x_size-options.centre[1],y_size-options.centre[0],0-options.centre[0]])/options.resolution
         # Don't conserve limits (we're changing the range here)
         options.conserve_limits = False
         # This means that next time we switch mode, the limits will be reset:
         stop_reverting = True
-        options.imshow = options.ax.imshow(options.density, cmap=options.cmap, extent=extent)
-        # Add x and y axis labels
-        options.ax.set_xlabel("Distance / $mm$")
-        options.ax.set_ylabel("Distance / $mm$")
-        options.cbar = options.fig.colorbar(options.imshow, cax=options.mframe.cax)
-        options.mframe.cax.axis('on')
-        options.cbar.ax.set_ylabel(r'Line-Integrated Electron Density, $\int n_e dL$ / $cm^{-2}$', rotation=270, labelpad=20)
+        show_image(options, data, extent,
+                   ("Distance / $mm$", "Distance / $mm$"))
+        if key[0] == 'density':
+            show_colorbar(options, r'Line-Integrated Electron Density, $\int n_e dL$ / $cm^{-2}$')
+        else:
+            show_colorbar(options, r'Electron Density, $n_e$ / $cm^{-3}$')
     # Clear the view history stack
     options.mframe.clear_nav_stack()
     if options.conserve_limits:
@@ -559,17 +663,29 @@ def set_mode(options):
     # Update all the active lineouts
     for lineout in options.lineouts:
         lineout.update()
+    # The data the lineouts are sampled from is made again for the new
+    # image when it is next needed
+    if (options.lineout_data is not None
+            and options.lineout_data[0] is not options.imshow.get_array()):
+        options.lineout_data = None
+    # and the region statistics
+    if options.regions is not None:
+        options.regions.update()
     # Initialising the labeller is left till the very last moment, as it grabs
     # the first frame it sees to be the blit background. This can result in
     # things like the zoom being off and layouts not being shown for a split
     # second if doen too early. Now we have drawn everything we wanted, we can
     # peacefully start the animation.
     if key[1] == 'fringes':
+        # Relabelling the fringes means that the maps computed from them
+        # are out of date
+        env = key[0]
         options.labeller = m2labelling.label(fringes, canvas,
                                              options.fig, options.ax,
                                              options=options,
                                              imshow=options.imshow,
-                                             mframe=options.mframe)
+                                             mframe=options.mframe,
+                                             on_change=lambda: options.graph.touch(env + '_canvas'))
     # Refresh the graph's canvas
     options.fig.canvas.draw()
     # Set the radio buttons to the correct position
@@ -626,8 +742,11 @@ def interpolate_exact(options, env=None):
         # interpolation, and let set_mode render it
         if env is None:
             env = options.mode.split("_")[0]
-        tri = m2triangulate.triangulate(options.objects[env]['canvas'],
-                                        options.ax, options.status)
+        stop_progressive(options, env)
+        # The graph only redoes the interpolation if the labelling or
+        # the method have changed since the last time
+        options.graph.set(env + '_method', 'exact')
+        tri = options.graph.get(env + '_map')
         if tri is None:
             mb.showerror("Triangulation failed", "No points detected, so the triangulation failed. Have you labelled the fringes?")
         else:
@@ -647,8 +766,9 @@ def interpolate_fast(options, env=None):
         # interpolation, and let set_mode render it
         if env is None:
             env = options.mode.split("_")[0]
-        tri = m2triangulate.fast_tri(options.objects[env]['canvas'],
-                                     options.ax, options.status)
+        stop_progressive(options, env)
+        options.graph.set(env + '_method', 'fast')
+        tri = options.graph.get(env + '_map')
         if tri is None:
             mb.showerror("Triangulation failed", "No points detected, so the triangulation failed. Have you labelled the fringes?")
         else:
@@ -656,6 +776,99 @@ def interpolate_fast(options, env=None):
             set_mode(options)
 
 
+# This performs the fast interpolation progressively: a rough preview is
+# shown straight away, then the area visible on the screen is refined, and
+# then the rest of the canvas is filled in. The work is done in small
+# chunks scheduled with tkinter's after(), so the window stays responsive
+def interpolate_progressive(options, env=None):
+    if options.mode is None:
+        mb.showinfo("No file loaded", "You need to load and label an interferogram file first in order to interpolate the phase!")
+    elif options.mode.split("_")[0] != 'plasma' and options.mode.split("_")[0] != 'background' and env==None:
+        mb.showinfo("No mode chosen", "Please choose either the background or plasma display mode from the menu on the right!")
+    else:
+        if env is None:
+            env = options.mode.split("_")[0]
+        stop_progressive(options, env)
+        canvas = options.objects[env]['canvas']
+        # The visible area, in pixels
+        xlim = options.ax.get_xlim()
+        ylim = options.ax.get_ylim()
+        view = (int(np.floor(min(ylim)+0.5)), int(np.ceil(max(ylim)+0.5)),
+                int(np.floor(min(xlim)+0.5)), int(np.ceil(max(xlim)+0.5)))
+        interpolation = m2triangulate.ProgressiveInterpolation(
+            canvas, progress=options.progress)
+        if interpolation.error:
+            mb.showerror("Triangulation failed", "No points detected, so the triangulation failed. Have you labelled the fringes?")
+            return
+        # The canvas' interpolated map is being replaced
+        options.graph.invalidate(env + '_map')
+        options.progressive[env] = interpolation
+        steps = interpolation.steps(view)
+        version = options.graph.nodes[env + '_canvas'].version
+
+        def step():
+            # Stop if the interpolation was cancelled, or the fringes were
+            # changed or replaced in the meantime
+            if (options.progressive.get(env) is not interpolation
+                    or options.objects[env]['canvas'] is not canvas
+                    or options.graph.nodes[env + '_canvas'].version != version):
+                if options.progressive.get(env) is interpolation:
+                    del options.progressive[env]
+                return
+            # Do as many chunks as fit in a short slice of time
+            start = time.perf_counter()
+            for stage, finished in steps:
+                if finished or time.perf_counter() - start > 0.05:
+                    break
+            else:
+                finished = False
+            if finished and stage == 'rest':
+                # The result is the same as that of the fast interpolation,
+                # so the graph can treat it as one
+                del options.progressive[env]
+                options.graph.set(env + '_method', 'fast')
+                options.graph.set(env + '_map', m2pipeline.finish_map(
+                    canvas, options.graph.nodes['nan_maps'].value))
+            if finished:
+                # Switch to the map on the first preview, and later on only
+                # refresh it if the user is still looking at it
+                if stage == 'preview' or options.mode == env + "_map":
+                    # The map was filled in in place, so the displayed
+                    # version of it is out of date
+                    if stage != 'rest':
+                        options.graph.touch(env + '_map')
+                    options.mode = env + "_map"
+                    set_mode(options)
+            if env in options.progressive:
+                options.root.after(1, step)
+        step()
+
+
+# Cancel a progressive interpolation (if there is one running)
+def stop_progressive(options, env):
+    options.progressive.pop(env, None)
+
+
+# Switch between keeping the maps as float32 arrays with NaNs and as float64
+# arrays with -1024 (see magic2/pipeline.py). The maps that have already
+# been computed are converted, rather than interpolated again
+def set_nan_maps(options, nan):
+    graph = options.graph
+    envs = [env for env in ('background', 'plasma') if graph.is_valid(env + '_map')]
+    graph.set('nan_maps', nan)
+    for env in envs:
+        graph.set(env + '_map', m2pipeline.finish_map(options.objects[env]['canvas'], nan))
+    # Show the current view again, computed from the converted maps
+    if options.mode is not None:
+        key = options.mode.split("_")
+        if key[0] == 'subtracted':
+            subtract(options)
+        elif key[0] == 'density':
+            plasma_density(options)
+        elif key[1] == 'map':
+            set_mode(options)
+
+
 # This performs the interpolation in debug mode, meaning feedback is in
 # instead of the status bar, and output of every step is displayed in
 # a separate window
@@ -669,7 +882,13 @@ def interpolate_debug(options, env=None):
         # the risks and advantages to the user
         if env is None:
             env = options.mode.split("_")[0]
+        stop_progressive(options, env)
         m2triangulate.triangulate_debug(options.objects[env]['canvas'], options)
+        # The interpolation was done outside of the processing graph, so we
+        # store its result there by hand
+        options.graph.set(env + '_method', 'debug')
+        options.graph.set(env + '_map', m2pipeline.finish_map(
+            options.objects[env]['canvas'], options.graph.nodes['nan_maps'].value))
         options.mode = env + "_map"
         set_mode(options)
 
@@ -679,32 +898,28 @@ def interpolate_debug(options, env=None):
 def subtract(options):
     if options.objects['background']['canvas'] is None:
         mb.showinfo("No background loaded", "You need to load, label, and interpolate a background interferogram file first in order to perform the subtraction.")
-    elif not options.objects['background']['canvas'].interpolation_done:
+    elif not options.graph.is_valid('background_map'):
         mb.showinfo("No background interpolation", "You need to perform an interpolation of the background fringes before the subtraction.")
     elif options.objects['plasma']['canvas'] is None:
         mb.showinfo("No background loaded", "You need to load, label, and interpolate a plasma interferogram file first in order to perform the subtraction.")
-    elif not options.objects['plasma']['canvas'].interpolation_done:
+    elif not options.graph.is_valid('plasma_map'):
         mb.showinfo("No background interpolation", "You need to perform an interpolation of the plasma fringes before the subtraction.")
     else:
-        # Subtract the interferograms, masking them with the user-defined mask,
-        # as well as the regions that couldn't be interpolated for both
-        # background and plasma images
-        # try:
-        options.subtracted = np.ma.masked_where(
-            np.logical_or(np.logical_or(
-                options.objects['plasma']['canvas'].mask == False,
-                options.objects['plasma']['canvas'].interpolated == -1024.0),
-                options.objects['background']['canvas'].interpolated == -1024.0
-            ),
-            options.objects['background']['canvas'].interpolated
-            - options.objects['plasma']['canvas'].interpolated
-        )
+        # Subtract the interferograms (the graph will reuse the previous
+        # result if neither of the interpolations has changed). The
+        # background is resampled onto the plasma image's grid first if it
+        # needs lining up, or if the images have different shapes
+        options.graph.get('subtracted')
         # Let set_mode do the rendering
         options.mode = "subtracted_graph"
         set_mode(options)
+        estimate = options.graph.cached('registration_estimate')
+        if options.registration is not None and estimate is not None:
+            if estimate.accepted:
+                options.status.set("Background shifted by ({:.2f}, {:.2f}) px and rotated by {:.2f} degrees".format(*estimate.transform), 100)
+            else:
+                options.status.set("Background not lined up: the images don't match well enough to register them", 100)
         return True
-        # except ValueError:
-        #     mb.showinfo("Wrong shape", "The shapes of the background and plasma images are different ({} and {}). They need to be the same for the subtraction to be performed!".format(options.objects['background']['canvas'].interpolated.shape, options.objects['plasma']['canvas'].interpolated.shape))
 
 
 # This dialog allows the user to set the shift that should be normalised
@@ -769,7 +984,8 @@ def set_zero(options):
     if options.mode == "subtracted_graph":
         dialog = ZeroDialog(options.root, options, title="Choose zero point", parent_mframe=options.mframe)
         if dialog.result == "auto":
-            options.offset = np.amin(options.subtracted)
+            # NaN maps have NaNs where there is no data
+            options.offset = float(np.nanmin(options.subtracted))
         elif dialog.result is not None:
             options.offset = dialog.result
         set_mode(options)
@@ -781,22 +997,24 @@ def set_zero(options):
 def invert(options):
     if options.mode is not None:
         key = options.mode.split("_")
+        # The data is negated in place, so that no new full-size array is
+        # made. The graph is told about it, as everything computed from
+        # the data is now out of date
         if key[1] == 'map':
             interpolated = options.objects[key[0]]['canvas'].interpolated
             # Using a mask ensures we do not touch the -1024 pixels
-            # (they indicate that no data is available)
-            mask = interpolated != -1024.0
-            interpolated[mask] = -interpolated[mask]
+            # (they indicate that no data is available). NaNs stay NaNs
+            np.negative(interpolated, out=interpolated, where=interpolated != -1024.0)
+            options.graph.touch(key[0] + '_map')
             set_mode(options)
             # This return is a convenient way of escaping the function before
             # The error message is shown
             return True
-        elif key[0] == 'subtracted':
-            options.subtracted = -options.subtracted
-            set_mode(options)
-            return True
-        elif key[0] == 'density':
-            options.density = -options.density
+        elif key[0] in ('subtracted', 'density', 'abel'):
+            # The masked values are negated too, which doesn't matter
+            data = np.ma.getdata(options.graph.get(key[0]))
+            np.negative(data, out=data)
+            options.graph.touch(key[0])
             set_mode(options)
             return True
     mb.showerror("Not available in this mode", "To invert data you have to be viewing an interpolation, subtraction or a plasma density map.")
@@ -876,43 +1094,74 @@ def plasma_density(options):
          and options.wavelength is not None and options.double is not None)
         or shot_options(options)
     ):
-        # Speed of light
-        c = 3e8
-        # Electron charge
-        e = 1.602e-19
-        # Electron mass
-        me = 9.109e-31
-        # Permittivity of free space
-        e0 = 8.854e-12
-        # Sample depth in meters
-        d = options.depth * 1e-3
-        # Wavelength in meters
-        wavelength = options.wavelength * 1e-9
-        # If the double option was chosen, one traced fringe corresponds
-        # to half a fringe shift
-        if options.double:
-            multiplier = 0.5
-        else:
-            multiplier = 1
-        # Calculate the density map
-        options.density = (multiplier * (options.subtracted-options.offset) * 8
-                           * (np.pi * c / e)**2 * me * e0 / d / wavelength)
-        # Convert to centimetres cubed
-        options.density /= 1e6
+        # Calculate the density map. This is recalculated only if the
+        # subtracted map or the shot options have changed
+        options.graph.get('density')
         # Let set_mode render the map
         options.mode = "density_graph"
         set_mode(options)
 
 
+# This function Abel-inverts the plasma density map, giving the electron
+# density as a function of the radius from the axis of symmetry (the
+# vertical line through the centre of the density map)
+def abel_invert(options):
+    if options.density is None:
+        plasma_density(options)
+        if options.density is None:
+            return False
+    # This is recalculated only if the density map, its centre or the
+    # method have changed
+    if options.graph.get('abel') is None:
+        return False
+    options.mode = "abel_graph"
+    set_mode(options)
+    return True
+
+
+# Choose how the background is lined up with the plasma image ('none',
+# or one of the modes in magic2/registration.py), showing the view again
+# if it depends on the subtraction
+def set_registration(options, mode):
+    options.registration = None if mode == "none" else mode
+    if options.mode is not None:
+        key = options.mode.split("_")
+        if key[0] == 'subtracted':
+            subtract(options)
+        elif key[0] == 'density':
+            plasma_density(options)
+        elif key[0] == 'abel':
+            abel_invert(options)
+
+
+# Choose the Abel inversion method, showing the new inversion if the
+# current one is being shown
+def set_abel_method(options, method):
+    options.abel_method = method
+    if options.mode == "abel_graph":
+        abel_invert(options)
+
+
+# Show the current view again after its centre has changed (the Abel
+# inversion depends on it)
+def refresh_centre(options):
+    if options.mode == "abel_graph":
+        abel_invert(options)
+    else:
+        set_mode(options)
+
+
 # Event handler for setting the centre of the density map
 def set_centre_onclick(event, options, binds):
-    options.centre = [event.ydata*options.resolution, event.xdata*options.resolution]
+    # The graph's coordinates are relative to the current centre
+    options.centre = [event.ydata*options.resolution + options.centre[0],
+                      event.xdata*options.resolution + options.centre[1]]
     # Unbind all the event handlers
     for bind in binds:
         options.fig.canvas.mpl_disconnect(bind)
     # Allow the graph to resize after the centre is set
     options.conserve_limits = False
-    set_mode(options)
+    refresh_centre(options)
     options.mframe.config(cursor="")
 
 
@@ -927,8 +1176,9 @@ def set_centre_onpress(event, options, binds):
 
 # Set centre of the plasma density map
 def set_centre(options):
-    if options.mode == "density_graph":
+    if options.mode == "density_graph" or options.mode == "abel_graph":
         ans = mb.askyesnocancel("Set centre?", "Press 'Yes' and then click anywhere on the graph to set the centre of the density map. Use the escape key to cancel.\n\n"
+                                "The vertical line through the centre is the axis of symmetry used by the Abel inversion.\n\n"
                                 "Press 'No' to reset the centre to [0, 0].")
         if ans:
             options.mframe.config(cursor="crosshair")
@@ -939,7 +1189,7 @@ def set_centre(options):
                 lambda event: set_centre_onpress(event, options, binds))
         elif ans is not None:
             options.centre = [0, 0]
-            set_mode(options)
+            refresh_centre(options)
     else:
         mb.showinfo("Not in plasma density mode", "You need to be in the plasma density map mode to set the centre of that map.")
 
@@ -955,10 +1205,10 @@ def cosine(options):
         # This mode is a spetial little snowflake, in that it doesn't have
         # a radio button or a set_mode if clause. We handle its rendering
         # ourselves here:
-        # Clear the canvas
-        options.ax.clear()
         # Draw the cosine
-        options.imshow = options.ax.imshow(np.cos(options.imshow.get_array()*multiplier*np.pi), cmap="Greys")
+        show_image(options, np.cos(options.imshow.get_array()*multiplier*np.pi))
+        options.imshow.set_cmap("Greys")
+        show_colorbar(options, None)
         # Set the mode variable
         mode = options.mode.split("_")[0]+"_cosine_graph"
         options.show_var.set(mode)
@@ -982,6 +1232,17 @@ def lineout(options):
         mb.showinfo("No mode chosen", "Please choose one of the display modes from the menu on the right!")
 
 
+# Open the region statistics window (or bring it to the front)
+def region_statistics(options):
+    if options.mode not in m2regions.TABLES:
+        mb.showinfo("Open a map", "Region statistics can be calculated for the subtracted map and the plasma density map.")
+    elif options.regions is None:
+        options.regions = m2regions.RegionStatistics(options)
+    else:
+        options.regions.window.lift()
+        options.regions.window.focus_set()
+
+
 class AboutDialog(m2dialog.Dialog):
     def body(self, master):
         photo = Tk.PhotoImage(file="logo_s.png")
@@ -999,6 +1260,43 @@ def about(options):
     AboutDialog(options.root, parent_mframe=options.mframe)
 
 
+class MemoryDialog(m2dialog.Dialog):
+    def __init__(self, parent, text, **kwargs):
+        self.text = text
+        m2dialog.Dialog.__init__(self, parent, title="Memory usage", **kwargs)
+
+    def body(self, master):
+        lines = self.text.split("\n")
+        text = Tk.Text(master, font="TkFixedFont", wrap=Tk.NONE,
+                       width=max(len(line) for line in lines)+2,
+                       height=min(len(lines), 40))
+        text.insert(Tk.END, self.text)
+        # The report is read-only
+        text.config(state=Tk.DISABLED)
+        text.pack(fill=Tk.BOTH, expand=1)
+
+    def buttonbox(self):
+        box = Tk.Frame(self)
+        w = ttk.Button(box, text="Close", width=10, command=self.cancel,
+                       default=Tk.ACTIVE)
+        w.pack(side=Tk.RIGHT, padx=5, pady=5)
+        self.bind("<Return>", self.cancel)
+        self.bind("<Escape>", self.cancel)
+        box.pack(fill=Tk.BOTH, padx=10, pady=5)
+
+
+# Show how much memory the images, fringes and maps take up
+def memory_report(options):
+    extra = {"display " + mode: array for mode, array
+             in options.display_cache.arrays().items()}
+    # The lineouts' data, if it is a copy of the displayed array
+    if (options.lineout_data is not None
+            and options.lineout_data[2] is not options.lineout_data[0]):
+        extra["lineout data"] = options.lineout_data[2]
+    report = m2memory.shot_report(options.objects, options.graph, extra=extra)
+    MemoryDialog(options.root, report.format(), parent_mframe=options.mframe)
+
+
 def close_window(options):
     if mb.askokcancel("Quit", "Do you actually want to quit?"):
         options.root.destroy()
@@ -1018,6 +1316,7 @@ def reset_labelling(options):
             # Re-render the fringes with the new phases
             m2graphics.clear_visual(canvas)
             m2graphics.render_fringes(fringes, canvas, width=options.width_var.get())
+            options.graph.touch(key[0] + '_canvas')
             
             set_mode(options)
     else:
@@ -0,0 +1,101 @@
+# Magic2 (https://github.com/jdranczewski/Magic2)
+# Copyright (C) 2018  Jakub Dranczewski, based on work by George Swadling
+
+# This work was carried out during a UROP with the MAGPIE Group,
+# Department of Physics, Imperial College London and was supported in part
+# by the Engineering and Physical Sciences Research Council (EPSRC) Grant
+# No. EP/N013379/1, by the U.S. Department of Energy (DOE) Awards
+# No. DE-F03-02NA00057 and No. DE-SC- 0001063
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# This file keeps the arrays shown in every display mode (the masked maps,
+# the subtracted map with the offset applied, etc.), so that switching back
+# to a mode doesn't build them again. Every array is stored together with
+# the versions of the data it was made from (taken from the processing
+# graph), and is only reused if those haven't changed. The least recently
+# shown arrays are dropped when the cache goes over its memory budget.
+# Some modes show the graph's own arrays as they are (the NaN maps, the
+# density): those are kept, but not counted against the budget, as they
+# are in memory anyway and dropping them frees nothing. They aren't copied
+# either, even though the graph recomputes them in place - the versions
+# change when it does, so an entry that is out of date is never used.
+import os
+from collections import OrderedDict
+import numpy as np
+
+# The default budget in bytes, which can be changed with the
+# MAGIC2_DISPLAY_CACHE environment variable (in MB)
+BUDGET = int(float(os.environ.get('MAGIC2_DISPLAY_CACHE', 512)) * 2**20)
+
+
+# The memory used by an array (including the mask of a masked array)
+def array_bytes(array):
+    size = np.ma.getdata(array).nbytes
+    mask = np.ma.getmask(array)
+    if mask is not np.ma.nomask:
+        size += mask.nbytes
+    return size
+
+
+class DisplayCache():
+    def __init__(self, budget=None):
+        self.budget = BUDGET if budget is None else budget
+        # mode -> (versions, array, size), the most recently used last
+        # (the size is 0 for shared arrays).
+        # The versions only ever go up, so an older array for a mode can
+        # never be used again and there is only one entry per mode
+        self.entries = OrderedDict()
+
+    # Return the array for a mode, calling build() to make it if it isn't
+    # cached or the versions differ. shared is True if build() returns an
+    # array that is kept elsewhere (see the top of the file)
+    def get(self, mode, versions, build, shared=False):
+        entry = self.entries.get(mode)
+        if entry is not None and entry[0] == versions:
+            self.entries.move_to_end(mode)
+            return entry[1]
+        # Drop the outdated entry before building the new one, so that
+        # both don't have to be in memory at the same time
+        self.entries.pop(mode, None)
+        array = build()
+        self.entries[mode] = (versions, array, 0 if shared else array_bytes(array))
+        self._evict()
+        return array
+
+    # The versions of the data the cached array for a mode was made from,
+    # None if there is none
+    def versions(self, mode):
+        entry = self.entries.get(mode)
+        return None if entry is None else entry[0]
+
+    def total(self):
+        return sum(entry[2] for entry in self.entries.values())
+
+    # Drop the least recently used arrays until the cache fits in the
+    # budget. The one used last is always kept, as it is on the screen
+    def _evict(self):
+        while len(self.entries) > 1 and self.total() > self.budget:
+            self.entries.popitem(last=False)
+
+    def set_budget(self, budget):
+        self.budget = budget
+        self._evict()
+
+    def clear(self):
+        self.entries.clear()
+
+    # The cached arrays, by mode (for the memory report)
+    def arrays(self):
+        return {mode: entry[1] for mode, entry in self.entries.items()}
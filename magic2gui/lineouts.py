@@ -27,9 +27,116 @@ from matplotlib.animation import FuncAnimation
 from matplotlib.patches import Polygon
 import numpy as np
 import ctypes
-from skimage.measure import profile_line
 
 import magic2gui.matplotlib_frame as m2mframe
+import magic2.export as m2export
+import magic2.sampling as m2sampling
+
+# The display modes with axes in mm from the centre of the density map
+# (rather than in pixels), with the label of their values on the graph
+# and in exported files
+MM_MODES = {
+    "density_graph": (r"Line-Integrated Electron Density $\int n_e dL$ / $cm^{-2}$",
+                      "line-integrated electron density (cm^-2)"),
+    "abel_graph": (r"Electron Density $n_e$ / $cm^{-3}$",
+                   "electron density (cm^-3)")
+}
+
+# While a lineout is being drawn, its profile is previewed in the side
+# panel, sampled again at most every PREVIEW_FRAME ms
+PREVIEW_FRAME = 50
+
+# The kinds of lineout families, with the label of their spacing setting
+# and its default. A family is sampled together with the lineout
+FAMILIES = {
+    "Single line": (None, ""),
+    "Parallel lines": ("Spacing (px):", 10),
+    "Fan": ("Spread (deg):", 30)
+}
+
+
+# The data shown on the main graph as a float32 array with NaNs where there
+# is no data, which the lineouts are sampled from. It is made once for every
+# version of the data (see magic2gui/display_cache.py) and shared by all
+# the lineouts
+def lineout_data(options):
+    array = options.imshow.get_array()
+    versions = options.display_cache.versions(options.mode)
+    cached = options.lineout_data
+    if cached is None or cached[0] is not array or cached[1] != versions:
+        # The old view is dropped first, so that both don't have to be
+        # in memory at the same time
+        options.lineout_data = None
+        options.lineout_data = (array, versions, m2sampling.nan_view(array))
+    return options.lineout_data[2]
+
+
+# Convert a line ([[y0, x0], [y1, x1]]) from the main graph's coordinates
+# into pixels (the density maps are shown in mm from their centre)
+def to_pixels(options, line):
+    line = np.array(line, dtype=np.float64)
+    if options.mode in MM_MODES:
+        line *= options.resolution
+        line += options.centre
+    return line
+
+
+# A small graph in the side panel showing the profile along the line
+# that is being drawn, following the mouse. Moving the mouse only stores
+# the line: it is sampled (from the lineouts' shared data, just along the
+# line) and drawn a frame later, so that the preview keeps up on large maps
+class LineoutPreview():
+    def __init__(self, parent):
+        self.frame = Tk.LabelFrame(parent, text="Lineout preview", padx=5, pady=5)
+        self.mframe = m2mframe.GraphFrame(self.frame, figsize=(2.5, 2))
+        self.mframe.pack(fill=Tk.BOTH, expand=1)
+        self.mframe.ax.tick_params(labelsize=7)
+        self.profile_plot, = self.mframe.ax.plot([], [], color='tab:orange')
+        self.options = None
+        # The line waiting to be previewed (in the main graph's
+        # coordinates), and the scheduled preview
+        self.line = None
+        self.scheduled = None
+
+    # Show the (empty) panel when a lineout starts being drawn
+    def start(self, options):
+        self.options = options
+        self.line = None
+        self.profile_plot.set_data([], [])
+        units = "mm" if options.mode in MM_MODES else "px"
+        self.mframe.ax.set_xlabel("Distance / ${}$".format(units), fontsize=7)
+        self.mframe.canvas.draw_idle()
+        self.frame.pack(fill=Tk.BOTH, pady=5)
+
+    # Hide the panel once the lineout is drawn (or cancelled)
+    def stop(self):
+        if self.scheduled is not None:
+            self.frame.after_cancel(self.scheduled)
+            self.scheduled = None
+        self.line = None
+        self.frame.pack_forget()
+
+    # Preview a line, when the next frame is due
+    def request(self, line):
+        self.line = line
+        if self.scheduled is None:
+            self.scheduled = self.frame.after(PREVIEW_FRAME, self.draw)
+
+    # Sample the latest line and show its profile
+    def draw(self):
+        self.scheduled = None
+        options = self.options
+        if self.line is None or options is None or options.imshow is None:
+            return
+        line = to_pixels(options, self.line)
+        profile = m2sampling.profiles(lineout_data(options), line)[0]
+        scale = options.resolution if options.mode in MM_MODES else 1
+        self.profile_plot.set_data(np.linspace(0, len(profile)/scale, len(profile)),
+                                   profile)
+        ax = self.mframe.ax
+        ax.relim()
+        ax.autoscale_view()
+        self.mframe.canvas.draw_idle()
 
 
 # A class for working with layouts
@@ -46,19 +153,23 @@ class Lineout():
         if redoing is not None:
             self.colour = redoing.colour
             self.width = redoing.width
+            self.family = redoing.family
         else:
             self.colour = 'tab:blue'
             self.width = 1
+            # The kind of family (see FAMILIES), the number of lines and
+            # their spacing
+            self.family = ("Single line", 5, 0)
 
         # Save the coordinates of the line
         self.line = line.copy()
         # The coordinates have to be in pixels, not in mm
-        if options.mode == "density_graph" and redoing is None:
+        if options.mode in MM_MODES and redoing is None:
             self.line *= options.resolution
             self.line += options.centre
         # Check if the line will require to be scaled or moved while drawing
         # (self.line is always pixels and relative to the left top corner)
-        if self.options.mode == "density_graph":
+        if self.options.mode in MM_MODES:
             scale = self.options.resolution
             offset = self.options.centre
         else:
@@ -68,6 +179,12 @@ class Lineout():
         self.line_plot, = options.ax.plot((self.line[:, 1]-offset[1])/scale,
                                           (self.line[:, 0]-offset[0])/scale,
                                           color=self.colour)
+        # The other lines of the family, drawn as a single line broken
+        # into segments
+        self.family_plot, = options.ax.plot([], [], color=self.colour,
+                                            linewidth=0.8, alpha=0.6)
+        self.lines = self.get_lines()
+        self.family_plot.set_data(*self.family_data())
 
         # Draw the rectangle
         patch = Polygon(self.get_verts(), color=self.colour, linewidth=0,
@@ -146,25 +263,50 @@ class Lineout():
         self.colour_option = ttk.OptionMenu(cframe, self.colourvar, self.colour,
                                             *choice, command=self.update_colour)
         self.colour_option.pack(side=Tk.LEFT)
-
-        # Calculate the profile
-        self.profile = profile_line(np.ma.filled(options.imshow.get_array().astype(float), fill_value=np.nan), self.line[0], self.line[1], linewidth=self.width)
+        # The family of lines sampled together with the lineout
+        fframe = Tk.Frame(oframe)
+        fframe.grid(row=2, column=0, columnspan=3, sticky=Tk.W)
+        ttk.Label(fframe, text="Lines:").pack(side=Tk.LEFT)
+        self.familyvar = Tk.StringVar()
+        self.family_option = ttk.OptionMenu(fframe, self.familyvar, self.family[0],
+                                            *FAMILIES, command=self.change_family)
+        self.family_option.pack(side=Tk.LEFT)
+        self.count_box = Tk.Spinbox(fframe, from_=2, to=100, increment=1,
+                                    width=4, command=self.update_family)
+        self.count_box.bind("<Return>", self.update_family)
+        self.count_box.delete(0, Tk.END)
+        self.count_box.insert(Tk.END, self.family[1])
+        self.count_box.pack(side=Tk.LEFT)
+        self.spacingvar = Tk.StringVar()
+        ttk.Label(fframe, textvariable=self.spacingvar).pack(side=Tk.LEFT)
+        self.spacing_box = Tk.Spinbox(fframe, from_=-1024, to=1024, increment=1,
+                                      width=5, command=self.update_family)
+        self.spacing_box.bind("<Return>", self.update_family)
+        self.spacing_box.delete(0, Tk.END)
+        self.spacing_box.insert(Tk.END, self.family[2])
+        self.spacing_box.pack(side=Tk.LEFT)
+        self.update_family_controls()
+
+        # Calculate the profiles
+        self.profiles = m2sampling.profile_array(lineout_data(options), self.lines,
+                                                 self.width)
+        self.profile = self.profiles[len(self.profiles) // 2]
 
         # Create the matplotlib frame
         self.mframe = m2mframe.GraphFrame(window, bind_keys=True,
                                           show_toolbar=True)
         # Create an x axis, with the units depending on the mode
-        if options.mode == "density_graph":
+        if options.mode in MM_MODES:
             self.xspace = np.linspace(0, len(self.profile)/options.resolution,
                                       len(self.profile))
             self.mframe.ax.set_xlabel("Distance / $mm$")
-            self.mframe.ax.set_ylabel(r"Line-Integrated Electron Density $\int n_e dL$ / $cm^{-2}$")
+            self.mframe.ax.set_ylabel(MM_MODES[options.mode][0])
         else:
             self.xspace = np.linspace(0, len(self.profile), len(self.profile))
             self.mframe.ax.set_xlabel("Distance / $px$")
             self.mframe.ax.set_ylabel("Fringes")
         # Plot the lineout
-        self.mframe.ax.plot(self.xspace, self.profile, color=self.colour)
+        self.plot_profiles()
         # Set the limits so that the entire length of the lineout is shown
         self.mframe.ax.set_xlim([0, np.amax(self.xspace)])
         # Push the current view onto the view history stack
@@ -174,10 +316,68 @@ class Lineout():
         # Give the focus to the graph
         self.mframe.canvas._tkcanvas.focus_set()
 
+    # The scale and offset of the main graph's coordinates (the lines are
+    # kept in pixels)
+    def display_scale(self):
+        if self.options.mode in MM_MODES:
+            return self.options.resolution, np.asarray(self.options.centre)
+        return 1, np.zeros(2)
+
+    # The lines of the family, in pixels, as an (n, 2, 2) array (just the
+    # lineout's own line if it isn't a family)
+    def get_lines(self):
+        kind, count, spacing = self.family
+        if kind == "Parallel lines":
+            return m2sampling.parallel(self.line, count, spacing)
+        if kind == "Fan":
+            return m2sampling.fan(self.line, count, spacing)
+        return self.line[np.newaxis].astype(np.float64)
+
+    # The x and y data of the family's lines other than the lineout's own
+    # line on the main graph, separated by NaNs
+    def family_data(self):
+        if len(self.lines) < 2:
+            return [], []
+        scale, offset = self.display_scale()
+        lines = (self.lines - offset)/scale
+        gaps = np.full((len(lines), 1), np.nan)
+        return (np.hstack((lines[:, :, 1], gaps)).ravel(),
+                np.hstack((lines[:, :, 0], gaps)).ravel())
+
+    # Plot the profiles in the lineout's window, the lineout's own one
+    # (the middle of the family) on top
+    def plot_profiles(self):
+        ax = self.mframe.ax
+        for line in list(ax.lines):
+            line.remove()
+        middle = len(self.profiles) // 2
+        for i, profile in enumerate(self.profiles):
+            if i != middle:
+                ax.plot(self.xspace, profile, color=self.colour,
+                        linewidth=0.8, alpha=0.6)
+        ax.plot(self.xspace, self.profile, color=self.colour)
+
+    # Sample the family again (after its width or lines have changed) and
+    # redraw it in both windows
+    def recalculate(self):
+        self.lines = self.get_lines()
+        self.profiles = m2sampling.profile_array(lineout_data(self.options), self.lines,
+                                                 self.width)
+        self.profile = self.profiles[len(self.profiles) // 2]
+        self.plot_profiles()
+        # Redraw the graph in lineout's window
+        self.mframe.fig.canvas.draw()
+        self.family_plot.set_data(*self.family_data())
+        if self.rect is not None:
+            self.rect.set_xy(self.get_verts())
+        self.main_canvas_draw()
+        # Give the focus to the graph
+        self.mframe.canvas._tkcanvas.focus_set()
+
     # This function calculates the vertices of a rectangle of
     # a given width along the lineout
     def get_verts(self):
-        if self.options.mode == "density_graph":
+        if self.options.mode in MM_MODES:
             scale = self.options.resolution
             offset = self.options.centre
         else:
@@ -197,43 +397,57 @@ class Lineout():
         return verts
 
     # This function can be used to redraw the Lineout. Used in the
-    # set_mode callback
+    # set_mode callback. The line (and the rectangle) are restyled and
+    # moved rather than drawn again
     def update(self):
         # Check if the line will require to be scaled (self.line is in pixels)
-        if self.options.mode == "density_graph":
+        if self.options.mode in MM_MODES:
             scale = self.options.resolution
             offset = self.options.centre
         else:
             scale = 1
             offset = [0, 0]
+        self.line_plot.set_data((self.line[:, 1]-offset[1])/scale,
+                                (self.line[:, 0]-offset[0])/scale)
+        self.family_plot.set_data(*self.family_data())
         # If we are in the mode in which the lineout was created, draw
         # a solid line. Otherwise, draw a dashed one
         if self.options.mode == self.mode:
-            self.line_plot, = self.options.ax.plot((self.line[:, 1]-offset[1])/scale,
-                                                   (self.line[:, 0]-offset[0])/scale,
-                                                   color=self.colour)
+            self.line_plot.set_linestyle("-")
+            self.line_plot.set_alpha(None)
             # Draw the rectangle
-            patch = Polygon(self.get_verts(), color=self.colour,
-                            linewidth=0, alpha=0.3)
-            self.rect = self.options.ax.add_patch(patch)
+            if self.rect is None:
+                patch = Polygon(self.get_verts(), color=self.colour,
+                                linewidth=0, alpha=0.3)
+                self.rect = self.options.ax.add_patch(patch)
+            else:
+                self.rect.set_xy(self.get_verts())
             self.update_vis(draw=False)
-            # Make the width controls active
+            self.family_plot.set_linestyle("-")
+            # Make the width and family controls active
             self.width_box.config(state=Tk.NORMAL)
             self.sb.config(state=Tk.NORMAL)
+            self.family_option.config(state=Tk.NORMAL)
+            self.update_family_controls()
         else:
-            self.line_plot, = self.options.ax.plot((self.line[:, 1]-offset[1])/scale,
-                                                   (self.line[:, 0]-offset[0])/scale, "--",
-                                                   color=self.colour,
-                                                   alpha=0.7)
-            self.rect = None
-            # Disable the width controls
+            self.line_plot.set_linestyle("--")
+            self.line_plot.set_alpha(0.7)
+            if self.rect is not None:
+                self.rect.remove()
+                self.rect = None
+            self.family_plot.set_linestyle("--")
+            # Disable the width and family controls
             self.width_box.config(state=Tk.DISABLED)
             self.sb.config(state=Tk.DISABLED)
+            self.family_option.config(state=Tk.DISABLED)
+            self.count_box.config(state=Tk.DISABLED)
+            self.spacing_box.config(state=Tk.DISABLED)
 
     # Delete the lineout when the associated window is closed
     def remove(self):
-        # Remove the line from the graph
+        # Remove the lines from the graph
         self.line_plot.remove()
+        self.family_plot.remove()
         # Remove the rectangle if exists
         if self.rect is not None:
             self.rect.remove()
@@ -248,6 +462,9 @@ class Lineout():
     # Export the lineout data
     def export(self):
         filename = fd.asksaveasfilename(filetypes=[(".csv file", "*.csv"),
+                                                   (".npy array (float32)", "*.npy"),
+                                                   (".npz archive (float32 and metadata)", "*.npz"),
+                                                   ("Raw float32 and .json description", "*.raw"),
                                                    ("All files", "*")],
                                         defaultextension=".csv",
                                         initialfile=self.options.namecore)
@@ -256,25 +473,35 @@ class Lineout():
         # Give the focus to the graph
         self.mframe.canvas._tkcanvas.focus_set()
         if filename != '':
-            # Add appropriate units to the header
-            if self.mode.split("_")[0] == "density":
-                header = "distance (mm),\tline-integrated electron density (cm^-2)"
+            # Add appropriate units to the metadata
+            if self.mode in MM_MODES:
+                columns = ["distance (mm)", MM_MODES[self.mode][1]]
                 scale = self.options.resolution
                 units = "mm"
             else:
-                header = "distance (px),\tfringes"
+                columns = ["distance (px)", "fringes"]
                 scale = 1
                 units = "px"
-            # Add some metadata to the header
-            header = "start: {}{}\nend: {}{}\nmode: {}\n".format(
-                self.line[0, ::-1]/scale, units,
-                self.line[1, ::-1]/scale, units,
-                self.mode
-            ) + header
+            # A family has a column for every line, in order
+            if len(self.profiles) > 1:
+                columns = [columns[0]] + ["{} (line {})".format(columns[1], i+1)
+                                          for i in range(len(self.profiles))]
+            # Add some metadata about the lineout and the shot. Imported
+            # here, as the callbacks module imports this one
+            import magic2gui.callbacks as m2callbacks
+            metadata = m2callbacks.export_metadata(self.options, self.mode)
+            metadata.update({'columns': columns, 'distance_units': units,
+                             'start': self.line[0, ::-1]/scale,
+                             'end': self.line[1, ::-1]/scale,
+                             'width_px': self.width})
+            if len(self.profiles) > 1:
+                metadata.update({'family': self.family[0], 'family_spacing': self.family[2],
+                                 'starts': self.lines[:, 0, ::-1]/scale,
+                                 'ends': self.lines[:, 1, ::-1]/scale})
             # Save the data under the given filename
-            np.savetxt(filename,
-                       np.vstack((self.xspace, self.profile)).transpose(),
-                       header=header)
+            m2export.save(filename,
+                          np.vstack((self.xspace, self.profiles)).transpose(),
+                          metadata, progress=self.options.progress)
 
     # Redraw and recalculate the lineout in the current mode
     def redo(self):
@@ -299,18 +526,45 @@ class Lineout():
         # Give the focus to the graph
         self.mframe.canvas._tkcanvas.focus_set()
 
-    # Update the Lineout's width
+    # Update the Lineout's width (a whole number of pixels, as the width
+    # is sampled every pixel)
     def update_width(self, *args):
-        self.width = float(self.width_box.get())
-        self.profile = profile_line(np.ma.filled(self.options.imshow.get_array().astype(float), fill_value=np.nan), self.line[0], self.line[1], linewidth=self.width)
-        self.mframe.ax.lines[0].set_data(self.xspace, self.profile)
-        # Redraw the graph in lineout's window
-        self.mframe.fig.canvas.draw()
-        # Change the verices of the rectangle in the main window
-        self.rect.set_xy(self.get_verts())
-        self.main_canvas_draw()
-        # Give the focus to the graph
-        self.mframe.canvas._tkcanvas.focus_set()
+        try:
+            self.width = max(int(round(float(self.width_box.get()))), 1)
+        except ValueError:
+            return
+        self.recalculate()
+
+    # Enable the number and spacing of the lines only for families, and
+    # label the spacing for the kind of family
+    def update_family_controls(self):
+        label = FAMILIES[self.family[0]][0]
+        state = Tk.NORMAL if label is not None else Tk.DISABLED
+        self.count_box.config(state=state)
+        self.spacing_box.config(state=state)
+        self.spacingvar.set(label if label is not None else "")
+
+    # A different kind of family was chosen, which starts with its default
+    # spacing
+    def change_family(self, *args):
+        kind = self.familyvar.get()
+        if kind == self.family[0]:
+            return
+        self.spacing_box.delete(0, Tk.END)
+        self.spacing_box.insert(Tk.END, FAMILIES[kind][1])
+        self.family = (kind, self.family[1], self.family[2])
+        self.update_family_controls()
+        self.update_family()
+
+    # Update the number and spacing of the family's lines
+    def update_family(self, *args):
+        try:
+            count = max(int(self.count_box.get()), 2)
+            spacing = float(self.spacing_box.get())
+        except ValueError:
+            return
+        self.family = (self.familyvar.get(), count, spacing)
+        self.recalculate()
 
     # Show or hide the bounding box
     def update_vis(self, draw=True):
@@ -325,9 +579,11 @@ class Lineout():
     def update_colour(self, *args):
         self.colour = self.colourvar.get()
         self.line_plot.set_color(self.colour)
+        self.family_plot.set_color(self.colour)
         if self.rect is not None:
             self.rect.set_color(self.colour)
-        self.mframe.ax.lines[0].set_color(self.colour)
+        for line in self.mframe.ax.lines:
+            line.set_color(self.colour)
         self.mframe.fig.canvas.draw()
         self.main_canvas_draw()
 
@@ -358,12 +614,16 @@ def lineout_onclick(event, line_plot, options, binds, ani):
         options.lineouts.append(lineout)
 
 
-def lineout_onmove(event, line_plot, ax):
+def lineout_onmove(event, line_plot, options):
     line = line_plot.get_data()
     # If the line has a point on it...
-    if len(line[0]) and event.inaxes == ax:
+    if len(line[0]) and event.inaxes == options.ax:
         # ...add the current mouse position as the second point
         line_plot.set_data([line[0][0], event.xdata], [line[1][0], event.ydata])
+        # and preview the profile along it
+        if options.lineout_preview is not None:
+            options.lineout_preview.request([[line[1][0], line[0][0]],
+                                             [event.ydata, event.xdata]])
 
 
 # Esc key cancels layout creation
@@ -405,12 +665,14 @@ def create_lineout(options):
     binds[0] = options.fig.canvas.mpl_connect('button_press_event',
         lambda event: lineout_onclick(event, line_plot, options, binds, ani))
     binds[1] = options.fig.canvas.mpl_connect('motion_notify_event',
-        lambda event: lineout_onmove(event, line_plot, options.ax))
+        lambda event: lineout_onmove(event, line_plot, options))
     binds[2] = options.fig.canvas.mpl_connect('key_press_event',
         lambda event: lineout_onpress(event, line_plot, options, binds, ani))
     # Save the data about the current lineout creation process. This will
     # be used to stop the process, especially from the set_mode callback
     options.lineout_meta = [binds, ani, line_plot]
+    if options.lineout_preview is not None:
+        options.lineout_preview.start(options)
 
 
 # Stop the process of creating the layout
@@ -427,3 +689,5 @@ def stop_lineout(options):
     options.fig.canvas.draw()
     # Clear the variable
     options.lineout_meta = None
+    if options.lineout_preview is not None:
+        options.lineout_preview.stop()
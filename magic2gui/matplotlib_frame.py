@@ -21,14 +21,187 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import tkinter as Tk
+from contextlib import contextmanager
+import numpy as np
 from matplotlib.backends.backend_tkagg import (
     FigureCanvasTkAgg, NavigationToolbar2Tk)
 from matplotlib.backend_bases import key_press_handler
 from matplotlib.figure import Figure
+from matplotlib.image import AxesImage
+from matplotlib.transforms import Bbox
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from matplotlib import rcParams
 from tkinter.messagebox import askokcancel
 
+import magic2.pipeline as m2pipeline
+
+# Images with more pixels than this are drawn from a pyramid
+PYRAMID_THRESHOLD = 2048 * 2048
+# The keys used for moving around the graph
+NAVIGATION_KEYS = ('x', 'z', 'w', 'a', 's', 'd')
+# While navigation keys are being pressed, the preview is updated at most
+# every KEY_FRAME ms. The graph is properly redrawn once no key has been
+# pressed for KEY_SETTLE ms
+KEY_FRAME = 30
+KEY_SETTLE = 150
+
+
+# The view after a single press of a navigation key: x zooms in, z zooms
+# out and w, a, s, d move the view around
+def key_step(key, xlim, ylim):
+    diffx = xlim[1] - xlim[0]
+    diffy = ylim[1] - ylim[0]
+    if key == 'x':
+        return ([xlim[0]+0.1*diffx, xlim[1]-0.1*diffx],
+                [ylim[0]+0.1*diffy, ylim[1]-0.1*diffy])
+    elif key == 'z':
+        return ([xlim[0]-0.1*diffx, xlim[1]+0.1*diffx],
+                [ylim[0]-0.1*diffy, ylim[1]+0.1*diffy])
+    dx = {'a': -1, 'd': 1}.get(key, 0)
+    dy = {'w': 1, 's': -1}.get(key, 0)
+    return ([xlim[0]+0.3*diffx*dx, xlim[1]+0.3*diffx*dx],
+            [ylim[0]+0.3*diffy*dy, ylim[1]+0.3*diffy*dy])
+
+
+# For every pixel of a picture of the view new (a pair of limits) along one
+# axis, the pixel of a picture of the view old showing the same place.
+# The pixels are counted from the first limit. Returns the indices and
+# whether they fall within the old picture
+def _resample_indices(n, new, old):
+    position = new[0] + (np.arange(n) + 0.5) / n * (new[1] - new[0])
+    index = np.floor((position - old[0]) / (old[1] - old[0]) * n).astype(int)
+    valid = np.logical_and(index >= 0, index < n)
+    return np.clip(index, 0, n-1), valid
+
+
+# Halve the resolution of a (masked) image by averaging 2x2 blocks of
+# pixels, ignoring the masked ones. A block is masked only if all of its
+# pixels are, so that thin features (like the fringes) don't disappear
+def reduce_image(data):
+    values = np.ma.getdata(data)
+    valid = ~np.ma.getmaskarray(data)
+    height, width = values.shape
+    # Odd images get an extra masked row/column
+    if height % 2 or width % 2:
+        padding = ((0, height % 2), (0, width % 2))
+        values = np.pad(values, padding)
+        valid = np.pad(valid, padding)
+        height, width = values.shape
+    total = np.where(valid, values, 0).astype(np.float32).reshape(
+        height//2, 2, width//2, 2).sum(axis=(1, 3))
+    count = valid.reshape(height//2, 2, width//2, 2).sum(axis=(1, 3))
+    return np.ma.masked_array(total / np.maximum(count, 1), mask=count == 0)
+
+
+# PyramidImage needs a few of the private parts of matplotlib's AxesImage:
+# the data (_A) and the extent (_extent) it draws, the resampled picture
+# kept between draws (_imcache), and the _normalize_image_array set_data
+# copies the data with. They are only ever used through the functions
+# below, and an image without them is drawn like a plain AxesImage.
+# Checked with matplotlib 3.11 (_normalize_image_array is there since 3.8;
+# without it, NaN maps are copied like any other data)
+_NORMALIZE = getattr(AxesImage, '_normalize_image_array', None)
+
+
+# Whether the private parts of an image are there
+def _has_internals(image):
+    return all(hasattr(image, name) for name in ('_A', '_extent', '_imcache'))
+
+
+# The data an image draws, as normalised by set_data
+def _image_data(image):
+    return image._A
+
+
+# Make an image draw data with extent (instead of its own) for a moment
+@contextmanager
+def _drawing(image, data, extent):
+    full = image._A, image._extent
+    image._A, image._extent = data, extent
+    image._imcache = None
+    try:
+        yield
+    finally:
+        image._A, image._extent = full
+        image._imcache = None
+
+
+# An image that keeps a mipmap pyramid of its data (every level half the
+# resolution of the previous one) and draws only the part of the image that
+# is visible, at the level that matches the resolution of the screen. This
+# way panning and zooming cost about the same for any size of image.
+# Outside of drawing it behaves like a normal image holding all of its data,
+# so get_array(), set_data() and the colour limits work as usual
+class PyramidImage(AxesImage):
+    def __init__(self, ax, threshold=PYRAMID_THRESHOLD, **kwargs):
+        self.threshold = threshold
+        self.levels = None
+        AxesImage.__init__(self, ax, **kwargs)
+
+    # matplotlib copies the data it is given into a masked array. NaN
+    # arrays (see magic2/pipeline.py) are used without copying them instead,
+    # with only the mask of their NaNs made
+    @staticmethod
+    def _normalize_image_array(A):
+        if m2pipeline.is_nan_array(A) and A.ndim == 2:
+            return np.ma.masked_invalid(A, copy=False)
+        return _NORMALIZE(A)
+
+    def set_data(self, A):
+        AxesImage.set_data(self, A)
+        # The levels are made when they are first needed
+        self.levels = None
+        if _has_internals(self):
+            data = _image_data(self)
+            if data.ndim == 2 and data.size > self.threshold:
+                self.levels = [data]
+
+    def level(self, i):
+        while len(self.levels) <= i:
+            self.levels.append(reduce_image(self.levels[-1]))
+        return self.levels[i]
+
+    # The visible part of the image at the right level, and its extent.
+    # None if nothing is visible
+    def window(self):
+        height, width = self.levels[0].shape
+        left, right, bottom, top = self.get_extent()
+        xlim, ylim = self.axes.get_xlim(), self.axes.get_ylim()
+        # The visible pixels at full resolution (rows are counted from the
+        # top of the extent)
+        columns = sorted((x - left) / (right - left) * width for x in xlim)
+        rows = sorted((y - top) / (bottom - top) * height for y in ylim)
+        c0, c1 = max(int(np.floor(columns[0])), 0), min(int(np.ceil(columns[1])), width)
+        r0, r1 = max(int(np.floor(rows[0])), 0), min(int(np.ceil(rows[1])), height)
+        if c0 >= c1 or r0 >= r1:
+            return None
+        # How many pixels of the image fall on a pixel of the screen
+        step = max((c1-c0) / max(self.axes.bbox.width, 1),
+                   (r1-r0) / max(self.axes.bbox.height, 1))
+        i = int(np.floor(np.log2(step))) if step >= 2 else 0
+        # There's no need to go below a single pixel
+        i = min(i, int(np.ceil(np.log2(max(height, width)))))
+        factor = 2**i
+        data = self.level(i)
+        # The window at this level, with a pixel of margin
+        c0, c1 = max(c0//factor - 1, 0), min(-(-c1//factor) + 1, data.shape[1])
+        r0, r1 = max(r0//factor - 1, 0), min(-(-r1//factor) + 1, data.shape[0])
+        dx = (right - left) / width * factor
+        dy = (bottom - top) / height * factor
+        return data[r0:r1, c0:c1], (left + c0*dx, left + c1*dx,
+                                    top + r1*dy, top + r0*dy)
+
+    def draw(self, renderer, *args, **kwargs):
+        if self.levels is None or not self.get_visible():
+            return AxesImage.draw(self, renderer, *args, **kwargs)
+        window = self.window()
+        if window is None:
+            self.stale = False
+            return
+        # Draw the window instead of the whole image
+        with _drawing(self, *window):
+            AxesImage.draw(self, renderer, *args, **kwargs)
+
 
 class MFToolbar(NavigationToolbar2Tk):
     toolitems = list(NavigationToolbar2Tk.toolitems)
@@ -95,6 +268,13 @@ class GraphFrame(Tk.Frame):
         self.canvas._tkcanvas.pack(side=Tk.BOTTOM, fill=Tk.BOTH, expand=1)
         # Create a placeholder object for an animation
         self.ani = None
+        # The state of the keyboard navigation: the view the keys have led
+        # to so far, the view and picture of the axes from before the keys
+        # were pressed, and the scheduled preview and final redraw
+        self._key_view = None
+        self._key_base = None
+        self._key_frame = None
+        self._key_settle = None
         # Bind keyboard shortcuts
         if bind_keys:
             # Delete default keyboard shortcuts that we will be using elsewhere
@@ -109,52 +289,91 @@ class GraphFrame(Tk.Frame):
                 if event.key == 'g' and self.ani is not None:
                     self.ani._blit_cache.clear()
                 # Keyboard navigation
-                elif event.key == 'x':
-                    # Zoom in
-                    ylim = self.ax.get_ylim()
-                    xlim = self.ax.get_xlim()
-                    diffy = self.ax.get_ylim()[1] - self.ax.get_ylim()[0]
-                    diffx = self.ax.get_xlim()[1] - self.ax.get_xlim()[0]
-                    self.ax.set_ylim([ylim[0]+0.1*diffy, ylim[1]-0.1*diffy])
-                    self.ax.set_xlim([xlim[0]+0.1*diffx, xlim[1]-0.1*diffx])
-                    self.fig.canvas.draw()
-                    self.push_current()
-                elif event.key == 'z':
-                    # Zoom out
-                    ylim = self.ax.get_ylim()
-                    xlim = self.ax.get_xlim()
-                    diffy = self.ax.get_ylim()[1] - self.ax.get_ylim()[0]
-                    diffx = self.ax.get_xlim()[1] - self.ax.get_xlim()[0]
-                    self.ax.set_ylim([ylim[0]-0.1*diffy, ylim[1]+0.1*diffy])
-                    self.ax.set_xlim([xlim[0]-0.1*diffx, xlim[1]+0.1*diffx])
-                    self.fig.canvas.draw()
-                    self.push_current()
-                else:
-                    # Move
-                    dx = 0
-                    dy = 0
-                    if event.key == 'w':
-                        dy = 1
-                    elif event.key == 'a':
-                        dx = -1
-                    elif event.key == 's':
-                        dy = -1
-                    elif event.key == 'd':
-                        dx = 1
-                    if dx != 0 or dy != 0:
-                        ylim = self.ax.get_ylim()
-                        xlim = self.ax.get_xlim()
-                        diffy = self.ax.get_ylim()[1] - self.ax.get_ylim()[0]
-                        diffx = self.ax.get_xlim()[1] - self.ax.get_xlim()[0]
-                        self.ax.set_ylim([ylim[0]+0.3*diffy*dy, ylim[1]+0.3*diffy*dy])
-                        self.ax.set_xlim([xlim[0]+0.3*diffx*dx, xlim[1]+0.3*diffx*dx])
-                        self.fig.canvas.draw()
-                        self.push_current()
+                elif event.key in NAVIGATION_KEYS:
+                    self.navigate(event.key)
             self.canvas.mpl_connect("key_press_event", on_key_press)
         # Set focus back to canvas after clicking it
         self.canvas.mpl_connect('button_press_event',
                                 lambda event: self.canvas._tkcanvas.focus_set())
 
+    # Handle a navigation key. Presses arriving in quick succession (like
+    # when a key is held) are combined: the view they lead to is previewed
+    # by moving and scaling a picture of the axes taken before the first
+    # press, at most once a frame, and the graph is redrawn properly (and
+    # the view pushed onto the history stack) only once the keys settle
+    def navigate(self, key):
+        if self._key_view is None:
+            self._key_base = (self.ax.get_xlim(), self.ax.get_ylim(),
+                              self._grab_axes())
+            self._key_view = self._key_base[:2]
+            # The labelling animation would draw its old background
+            # over the preview
+            if self.ani is not None:
+                self.ani.pause()
+        self._key_view = key_step(key, *self._key_view)
+        if self._key_frame is None:
+            self._key_frame = self.after(KEY_FRAME, self._key_preview)
+        if self._key_settle is not None:
+            self.after_cancel(self._key_settle)
+        self._key_settle = self.after(KEY_SETTLE, self._key_finish)
+
+    # A copy of the pixels of the axes as they are drawn right now, and
+    # where they are in the canvas' buffer (rows counted from the top).
+    # On high DPI screens the buffer has device_pixel_ratio pixels for every
+    # pixel of the window. matplotlib 3.5 and later put the ratio into the
+    # figure's dpi, so the axes' box is already in the buffer's pixels, but
+    # the scale is taken from the buffer's size rather than assumed
+    def _grab_axes(self):
+        buffer = np.asarray(self.canvas.buffer_rgba())
+        scale = buffer.shape[1] / max(self.fig.bbox.width, 1)
+        bbox = self.ax.bbox
+        r0 = max(buffer.shape[0] - int(round(bbox.y1*scale)), 0)
+        r1 = min(buffer.shape[0] - int(round(bbox.y0*scale)), buffer.shape[0])
+        c0 = max(int(round(bbox.x0*scale)), 0)
+        c1 = min(int(round(bbox.x1*scale)), buffer.shape[1])
+        return buffer[r0:r1, c0:c1].copy(), (r0, r1, c0, c1)
+
+    # Show the view the keys have led to so far, made from the picture
+    # taken before the first key press
+    def _key_preview(self):
+        self._key_frame = None
+        if self._key_view is None:
+            return
+        xlim, ylim, (picture, (r0, r1, c0, c1)) = self._key_base
+        new_xlim, new_ylim = self._key_view
+        height, width = picture.shape[:2]
+        if height == 0 or width == 0:
+            return
+        columns, valid_columns = _resample_indices(width, new_xlim, xlim)
+        # The rows go from the top, so from the second y limit
+        rows, valid_rows = _resample_indices(height, new_ylim[::-1], ylim[::-1])
+        preview = picture[rows][:, columns]
+        # The parts that weren't on the screen before are left blank
+        preview[np.logical_not(valid_rows)] = 255
+        preview[:, np.logical_not(valid_columns)] = 255
+        buffer = np.asarray(self.canvas.buffer_rgba())
+        buffer[r0:r1, c0:c1] = preview
+        # Only the part of the buffer the picture was taken from is shown
+        # again (blit takes the box in the buffer's pixels, from the bottom)
+        self.canvas.blit(Bbox.from_extents(c0, buffer.shape[0]-r1,
+                                           c1, buffer.shape[0]-r0))
+
+    # The keys have settled, so set the view and draw it properly
+    def _key_finish(self):
+        self._key_settle = None
+        if self._key_frame is not None:
+            self.after_cancel(self._key_frame)
+            self._key_frame = None
+        xlim, ylim = self._key_view
+        self._key_view = None
+        self._key_base = None
+        self.ax.set_xlim(xlim)
+        self.ax.set_ylim(ylim)
+        self.canvas.draw_idle()
+        self.push_current()
+        if self.ani is not None:
+            self.ani.resume()
+
     # Clear the view history stack...
     def clear_nav_stack(self):
         self.toolbar._nav_stack.clear()
@@ -165,3 +384,19 @@ class GraphFrame(Tk.Frame):
     def push_current(self):
         self.toolbar.push_current()
         self.toolbar.set_history_buttons()
+
+    # Show an image on the graph's axes, like ax.imshow, but using
+    # a PyramidImage, so that very large images stay quick to navigate
+    def imshow(self, data, cmap=None, extent=None):
+        image = PyramidImage(self.ax, cmap=cmap, origin='upper')
+        image.set_data(data)
+        # The colour limits come from all of the data, not from the part
+        # that happens to be drawn first
+        image.autoscale_None()
+        if extent is None:
+            # The same as imshow's default extent
+            extent = (-0.5, data.shape[1]-0.5, data.shape[0]-0.5, -0.5)
+        image.set_extent(extent)
+        self.ax.add_image(image)
+        self.ax.set_aspect('equal')
+        return image
@@ -0,0 +1,286 @@
+# Magic2 (https://github.com/jdranczewski/Magic2)
+# Copyright (C) 2018  Jakub Dranczewski, based on work by George Swadling
+
+# This work was carried out during a UROP with the MAGPIE Group,
+# Department of Physics, Imperial College London and was supported in part
+# by the Engineering and Physical Sciences Research Council (EPSRC) Grant
+# No. EP/N013379/1, by the U.S. Department of Energy (DOE) Awards
+# No. DE-F03-02NA00057 and No. DE-SC- 0001063
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import tkinter as Tk
+import tkinter.ttk as ttk
+import tkinter.filedialog as fd
+from matplotlib.widgets import RectangleSelector, PolygonSelector
+import numpy as np
+import ctypes
+
+import magic2.regions as m2regions
+import magic2.export as m2export
+import magic2gui.lineouts as m2lineouts
+
+# The display modes the region statistics work in, with the processing
+# graph's stage holding their summed-area tables
+TABLES = {
+    "subtracted_graph": "subtracted_table",
+    "density_graph": "density_table"
+}
+
+
+# A window showing the statistics of a rectangle or polygon drawn on the
+# subtracted or plasma density map. The statistics are looked up in the
+# map's summed-area tables (see magic2/regions.py), so they are updated
+# live while the region is being drawn or dragged around
+class RegionStatistics():
+    def __init__(self, options):
+        self.options = options
+        self.selector = None
+        self.motion = None
+        # The current region in pixel coordinates (see magic2/regions.py):
+        # ('rectangle', (top, left, bottom, right)) or ('polygon', vertices)
+        self.region = None
+
+        # Create a window for the statistics
+        window = self.window = Tk.Toplevel()
+        window.wm_title("Region statistics - " + options.namecore)
+        # This is windows specific, but needed for the icon to show up
+        # in the taskbar. try/catch in case this is run on other platforms
+        try:
+            myappid = 'jdranczewski.magic2'
+            ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
+        except:
+            pass
+        try:
+            window.iconbitmap("magic2.ico")
+        except:
+            pass
+        window.geometry("+%d+%d" % (options.root.winfo_rootx()+50,
+                                    options.root.winfo_rooty()+50))
+        window.protocol("WM_DELETE_WINDOW", self.remove)
+
+        # The choice of the region's shape
+        sframe = Tk.Frame(window, padx=5, pady=5)
+        sframe.pack(side=Tk.TOP, fill=Tk.X)
+        ttk.Label(sframe, text="Region:").pack(side=Tk.LEFT)
+        self.shape_var = Tk.StringVar(window, value='rectangle')
+        for name, shape in (("Rectangle (drag)", 'rectangle'),
+                            ("Polygon (click the corners)", 'polygon')):
+            ttk.Radiobutton(sframe, text=name, variable=self.shape_var, value=shape,
+                            command=self.start).pack(side=Tk.LEFT)
+
+        # The statistics, as a name and a value on every row
+        vframe = Tk.Frame(window, padx=5, pady=5)
+        vframe.pack(side=Tk.TOP, fill=Tk.BOTH, expand=1)
+        self.names = {}
+        self.values = {}
+        for row, key in enumerate(('sum', 'mean', 'valid', 'pixels', 'area')):
+            self.names[key] = ttk.Label(vframe)
+            self.names[key].grid(row=row, column=0, sticky=Tk.W)
+            self.values[key] = ttk.Label(vframe, width=24, anchor=Tk.E)
+            self.values[key].grid(row=row, column=1, sticky=Tk.E)
+
+        # Exporting the sums of every row and column of a rectangle
+        oframe = Tk.Frame(window)
+        oframe.pack(side=Tk.BOTTOM, fill=Tk.BOTH)
+        for i in range(2):
+            oframe.grid_columnconfigure(i, weight=1)
+        self.export_buttons = []
+        for column, (name, axis) in enumerate((("Export row integrals", 0),
+                                               ("Export column integrals", 1))):
+            b = ttk.Button(oframe, text=name,
+                           command=lambda axis=axis: self.export(axis))
+            b.grid(row=0, column=column, sticky=("N", "S", "E", "W"))
+            self.export_buttons.append(b)
+
+        self.start()
+
+    # Convert the graph's coordinates into pixel coordinates (the density
+    # map is shown in mm from its centre, the other maps in pixels, with
+    # the pixels' centres at whole numbers)
+    def to_pixels(self, y, x):
+        options = self.options
+        if options.mode in m2lineouts.MM_MODES:
+            return (np.asarray(y)*options.resolution + options.centre[0],
+                    np.asarray(x)*options.resolution + options.centre[1])
+        return np.asarray(y) + 0.5, np.asarray(x) + 0.5
+
+    def from_pixels(self, y, x):
+        options = self.options
+        if options.mode in m2lineouts.MM_MODES:
+            return ((np.asarray(y) - options.centre[0])/options.resolution,
+                    (np.asarray(x) - options.centre[1])/options.resolution)
+        return np.asarray(y) - 0.5, np.asarray(x) - 0.5
+
+    # Create the selector for drawing the chosen shape on the main graph,
+    # showing the current region with it if it has that shape
+    def start(self):
+        self.stop()
+        options = self.options
+        if options.mode not in TABLES:
+            self.show(None)
+            return
+        shape = self.shape_var.get()
+        style = dict(color='tab:orange', alpha=0.3)
+        if shape == 'rectangle':
+            self.selector = RectangleSelector(options.ax, lambda *args: self.refresh(),
+                                              useblit=True, interactive=True,
+                                              button=[1], props=dict(style, fill=True))
+            if self.region is not None and self.region[0] == 'rectangle':
+                top, left, bottom, right = self.region[1]
+                (top, bottom), (left, right) = self.from_pixels((top, bottom), (left, right))
+                self.selector.extents = (left, right, top, bottom)
+        else:
+            self.selector = PolygonSelector(options.ax, lambda *args: self.refresh(),
+                                            useblit=True, props=dict(color='tab:orange'))
+            if self.region is not None and self.region[0] == 'polygon':
+                y, x = self.from_pixels(self.region[1][:, 0], self.region[1][:, 1])
+                self.selector.verts = list(zip(x, y))
+        # Connected after the selector, so that it sees the region after
+        # the selector has moved it
+        self.motion = options.fig.canvas.mpl_connect('motion_notify_event',
+                                                     lambda event: self.refresh())
+        self.export_buttons[0].config(state=Tk.NORMAL if shape == 'rectangle' else Tk.DISABLED)
+        self.export_buttons[1].config(state=Tk.NORMAL if shape == 'rectangle' else Tk.DISABLED)
+        self.refresh()
+
+    # Remove the selector from the main graph
+    def stop(self):
+        if self.motion is not None:
+            self.options.fig.canvas.mpl_disconnect(self.motion)
+            self.motion = None
+        if self.selector is not None:
+            self.selector.set_active(False)
+            self.selector.set_visible(False)
+            self.selector.disconnect_events()
+            self.selector = None
+            self.options.fig.canvas.draw_idle()
+
+    # Read the region from the selector and show its statistics
+    def refresh(self):
+        if self.selector is None:
+            return
+        if isinstance(self.selector, RectangleSelector):
+            left, right, top, bottom = self.selector.extents
+            if right == left or bottom == top:
+                self.show(None)
+                return
+            (top, bottom), (left, right) = self.to_pixels((top, bottom), (left, right))
+            self.region = ('rectangle', (top, left, bottom, right))
+        else:
+            verts = np.array(self.selector.verts, dtype=np.float64)
+            if len(verts) < 3:
+                self.show(None)
+                return
+            y, x = self.to_pixels(verts[:, 1], verts[:, 0])
+            self.region = ('polygon', np.column_stack((y, x)))
+        table = self.options.graph.get(TABLES[self.options.mode])
+        if table is None:
+            self.show(None)
+        elif self.region[0] == 'rectangle':
+            self.show(table.rectangle(*self.region[1]))
+        else:
+            self.show(table.polygon(self.region[1]))
+
+    # Show the statistics of a region, given its sum, count and area as
+    # returned by the summed-area tables (None to clear them)
+    def show(self, region):
+        options = self.options
+        density = options.mode == "density_graph"
+        if density:
+            names = {'sum': "Electrons:",
+                     'mean': "Mean line-integrated density / cm^-2:"}
+        else:
+            names = {'sum': "Sum of the fringe shift / fringes px:",
+                     'mean': "Mean fringe shift / fringes:"}
+        names.update({'valid': "Pixels with data:", 'pixels': "Pixels:",
+                      'area': "Area / mm^2:"})
+        for key, name in names.items():
+            self.names[key].config(text=name)
+        if region is None:
+            for label in self.values.values():
+                label.config(text="-")
+            return
+        statistics = m2regions.statistics(*region, offset=0 if density else options.offset)
+        if density:
+            # The line-integrated density summed over the pixels, times the
+            # area of a pixel (in cm^2), is the number of electrons
+            statistics['sum'] *= (0.1/options.resolution)**2
+        area = (statistics['pixels']/options.resolution**2
+                if options.resolution is not None else np.nan)
+        self.values['sum'].config(text="{:.6g}".format(statistics['sum']))
+        self.values['mean'].config(text="{:.6g}".format(statistics['mean']))
+        self.values['valid'].config(text="{:d}".format(statistics['valid']))
+        self.values['pixels'].config(text="{:d}".format(statistics['pixels']))
+        self.values['area'].config(text="{:.6g}".format(area))
+
+    # Called by set_mode when the display mode changes
+    def update(self):
+        self.start()
+
+    # Export the sums and means of every row (axis 0) or column (axis 1)
+    # of the rectangle
+    def export(self, axis):
+        options = self.options
+        if (options.mode not in TABLES or self.region is None
+                or self.region[0] != 'rectangle'):
+            return
+        table = options.graph.get(TABLES[options.mode])
+        if table is None:
+            return
+        filename = fd.asksaveasfilename(filetypes=[(".csv file", "*.csv"),
+                                                   (".npy array (float32)", "*.npy"),
+                                                   (".npz archive (float32 and metadata)", "*.npz"),
+                                                   ("All files", "*")],
+                                        defaultextension=".csv",
+                                        initialfile=options.namecore)
+        self.window.focus_set()
+        if filename == '':
+            return
+        sums, counts, first = table.profile(*self.region[1], axis=axis)
+        density = options.mode == "density_graph"
+        if not density:
+            sums = sums - options.offset*counts
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = np.where(counts > 0, sums/counts, np.nan)
+        # The positions of the rows' (or columns') centres
+        position = np.arange(first, first+len(sums)) + 0.5
+        if options.mode in m2lineouts.MM_MODES:
+            position = (position - options.centre[axis])/options.resolution
+            units = "mm"
+        else:
+            position = position - 0.5
+            units = "px"
+        if density:
+            # The number of electrons in every row (or column)
+            sums = sums * (0.1/options.resolution)**2
+            columns = ["position ({})".format(units), "electrons",
+                       "mean line-integrated electron density (cm^-2)", "pixels with data"]
+        else:
+            columns = ["position ({})".format(units), "sum of the fringe shift (fringes px)",
+                       "mean fringe shift (fringes)", "pixels with data"]
+        # Imported here, as the callbacks module imports this one
+        import magic2gui.callbacks as m2callbacks
+        metadata = m2callbacks.export_metadata(options)
+        metadata.update({'columns': columns, 'axis': ("rows", "columns")[axis],
+                         'rectangle_px': list(self.region[1])})
+        m2export.save(filename, np.column_stack((position, sums, means, counts)),
+                      metadata, progress=options.progress)
+
+    # Close the window, removing the region from the main graph
+    def remove(self):
+        self.stop()
+        self.options.regions = None
+        self.options.root.focus_set()
+        self.window.destroy()
@@ -0,0 +1,219 @@
+# Magic2 (https://github.com/jdranczewski/Magic2)
+# Copyright (C) 2018  Jakub Dranczewski, based on work by George Swadling
+
+# This work was carried out during a UROP with the MAGPIE Group,
+# Department of Physics, Imperial College London and was supported in part
+# by the Engineering and Physical Sciences Research Council (EPSRC) Grant
+# No. EP/N013379/1, by the U.S. Department of Energy (DOE) Awards
+# No. DE-F03-02NA00057 and No. DE-SC- 0001063
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# This file computes the stages the user is most likely to ask for next
+# while the application is idle: the fast interpolation once the fringes
+# have stopped being labelled, the subtraction (and the registration before
+# it) once both maps exist, and the plasma density once the shot details are
+# set. This way switching to those display modes is instant.
+#
+# The work is done in a background thread, one stage at a time, and only
+# after the user hasn't done anything for a while. The stage is computed
+# from a snapshot of the processing graph, and if anything it depends on
+# changes in the meantime, the result is simply thrown away. A stage that
+# fails is reported on the status bar (and in the terminal), unless its
+# inputs changed while it ran - then the failure is most likely down to the
+# change, and is thrown away like an out of date result.
+import copy
+import sys
+import threading
+import time
+import traceback
+import tkinter as Tk
+
+import magic2.pipeline as m2pipeline
+import magic2.progress as m2progress
+
+
+class Speculator():
+    def __init__(self, options, delay=1.0, interval=200):
+        self.options = options
+        # How long (in seconds) the user and the labelling have to be
+        # idle for before anything is started
+        self.delay = delay
+        # How often (in ms) the scheduler checks what could be done
+        self.interval = interval
+        # Can be switched off from the menu
+        self.enabled = Tk.BooleanVar(options.root, value=True)
+        self.last_activity = time.perf_counter()
+        # The current job: (stage name, snapshot versions, thread, result)
+        self.job = None
+        # The canvas versions seen last, and when they were first seen,
+        # for telling when the labelling has stopped
+        self.canvas_seen = {}
+        # Snapshot versions of stages that failed, so they are not retried
+        # until something changes
+        self.failed = {}
+        for sequence in ('<Any-KeyPress>', '<Any-ButtonPress>', '<Motion>', '<MouseWheel>'):
+            options.root.bind_all(sequence, self.activity, add='+')
+        options.root.after(self.interval, self.tick)
+
+    def activity(self, event=None):
+        self.last_activity = time.perf_counter()
+
+    # Called regularly through tkinter's after()
+    def tick(self):
+        try:
+            # The graph must not be changed while one of its stages is
+            # being computed (the progress bar keeps the events going then)
+            if self.options.graph.computing == 0:
+                if self.job is not None:
+                    self.collect()
+                elif (self.enabled.get()
+                      and time.perf_counter() - self.last_activity > self.delay):
+                    self.start()
+        finally:
+            self.options.root.after(self.interval, self.tick)
+
+    # Check whether the canvas of an environment has been left alone
+    # for long enough
+    def settled(self, env):
+        version = self.options.graph.nodes[env + '_canvas'].version
+        now = time.perf_counter()
+        seen = self.canvas_seen.get(env)
+        if seen is None or seen[0] != version:
+            self.canvas_seen[env] = (version, now)
+            return False
+        return now - seen[1] > self.delay
+
+    # The next stage worth computing, with the function computing it from
+    # the snapshot's values, and the snapshot's values to replace (by their
+    # position). None if there is nothing to do
+    def next_stage(self):
+        options = self.options
+        graph = options.graph
+        for env in ('background', 'plasma'):
+            canvas = options.objects[env]['canvas']
+            fringes = options.objects[env]['fringes']
+            if (canvas is None or graph.is_valid(env + '_map')
+                    or env in options.progressive or not self.settled(env)
+                    or graph.nodes[env + '_method'].value not in (None, 'fast')
+                    or not any(fringe.phase != -2048 for fringe in fringes.list)):
+                continue
+            # The user hasn't chosen a method yet, so the fast one is used.
+            # The method is only passed to the job, the graph is told
+            # about it when the result is accepted (see collect)
+            return env + '_map', interpolate, {1: 'fast'}
+        if (options.objects['background']['canvas'] is not None
+                and options.objects['plasma']['canvas'] is not None
+                and graph.is_valid('background_map') and graph.is_valid('plasma_map')
+                and not graph.is_valid('subtracted')):
+            # The background is lined up first, without reporting the
+            # progress (the status bar belongs to the main thread)
+            if not graph.is_valid('registration_estimate'):
+                return 'registration_estimate', register, {}
+            if not graph.is_valid('transform'):
+                return 'transform', graph.nodes['transform'].function, {}
+            if not graph.is_valid('aligned_background'):
+                return 'aligned_background', align, {}
+            return 'subtracted', graph.nodes['subtracted'].function, {}
+        if (graph.is_valid('subtracted') and not graph.is_valid('density')
+                and options.depth is not None
+                and options.wavelength is not None and options.double is not None):
+            return 'density', graph.nodes['density'].function, {}
+        return None
+
+    def start(self):
+        stage = self.next_stage()
+        if stage is None:
+            return
+        name, function, overrides = stage
+        snapshot = self.options.graph.snapshot(name)
+        if snapshot is None or self.failed.get(name) == snapshot[1]:
+            return
+        args, versions = snapshot
+        for position, value in overrides.items():
+            args[position] = value
+        result = {}
+
+        def run():
+            try:
+                result['value'] = function(*args)
+            except Exception:
+                # Reported by collect, from the main thread
+                result['error'] = traceback.format_exc()
+
+        # A daemon thread, so that closing the window doesn't wait for it
+        thread = threading.Thread(target=run, daemon=True)
+        self.job = (name, versions, thread, result)
+        thread.start()
+
+    # Store the result of a finished job in the graph, if it's still
+    # up to date
+    def collect(self):
+        name, versions, thread, result = self.job
+        if thread.is_alive():
+            return
+        self.job = None
+        graph = self.options.graph
+        if 'error' in result:
+            snapshot = graph.snapshot(name)
+            if snapshot is None or snapshot[1] != versions:
+                # The inputs were changed while the stage ran (a canvas
+                # relabelled in place, say), so it will be tried again
+                return
+            self.failed[name] = versions
+            print("Computing {} in the background failed:\n{}".format(
+                name, result['error']), file=sys.stderr)
+            self.options.status.set("A background calculation ({}) failed, see the terminal"
+                                    .format(name.replace("_", " ")), 100)
+            return
+        value = result.get('value')
+        if value is None:
+            self.failed[name] = versions
+            return
+        if name.endswith('_map'):
+            env = name.split("_")[0]
+            canvas = graph.nodes[env + '_canvas'].value
+            if graph.offer(name, value, versions):
+                # The interpolation was done on a copy of the canvas,
+                # so that nothing shown on the screen changed under the
+                # user's hands
+                canvas.interpolated = value
+                canvas.interpolation_done = True
+                if graph.nodes[env + '_method'].value is None:
+                    # The map was made with the fast method, which the
+                    # graph has to know about to keep it (setting the
+                    # method makes the map out of date, so it is set again)
+                    graph.set(env + '_method', 'fast')
+                    graph.set(name, value)
+        else:
+            graph.offer(name, value, versions)
+
+
+# Interpolate a shallow copy of the canvas, so that its interpolated map is
+# only replaced once the result is known to be up to date. The progress
+# is not reported, as the status bar can't be used from another thread
+def interpolate(canvas, method, nan=False):
+    return m2pipeline.interpolate(copy.copy(canvas), method, m2progress.Progress(),
+                                  nan=nan)
+
+
+# The same for lining up the background. A Progress with nothing attached
+# reports nowhere (without one, the progress would be printed)
+def register(background, plasma, mode):
+    return m2pipeline.register(background, plasma, mode, m2progress.Progress())
+
+
+def align(background, plasma, transform):
+    return m2pipeline.align(background, plasma, transform,
+                            progress=m2progress.Progress())
@@ -58,6 +58,12 @@ class StatusBar(Tk.Frame):
         self.update_idletasks()
         self.master.update()
 
+    # A callback for magic2.progress.Progress, showing the name of the stage
+    # and the overall percentage. The Progress object limits how often this
+    # is called, as every call forces the window to redraw
+    def progress(self, event):
+        self.set(event.stage, event.percent)
+
     # Update the name label
     def set_name_label(self, text):
         self.name_label['text'] = text
@@ -23,8 +23,13 @@
 import tkinter as Tk
 import tkinter.ttk as ttk
 import magic2.graphics as m2graphics
+import magic2.pipeline as m2pipeline
+import magic2.progress as m2progress
 import magic2gui.callbacks as m2callbacks
 import magic2gui.matplotlib_frame as m2mframe
+import magic2gui.speculation as m2speculation
+import magic2gui.display_cache as m2display_cache
+import magic2gui.lineouts as m2lineouts
 import magic2gui.status_bar as m2status_bar
 from matplotlib.pyplot import imread
 import pickle
@@ -38,6 +43,9 @@ import ctypes
 # to settings, matplotlib objects and tkinter variables.
 class Options:
     def __init__(self):
+        # The processing graph stores the derived maps and the settings they
+        # depend on, recomputing only what's affected by a change
+        self.graph = m2pipeline.shot_graph()
         self.objects = {
             "background": {
                 "canvas": None,
@@ -71,8 +79,21 @@ class Options:
         self.lineout_meta = None
         # A list of currently active lineouts
         self.lineouts = []
-        # The status bar
+        # The data the lineouts are sampled from (see magic2gui/lineouts.py)
+        self.lineout_data = None
+        # The side panel showing the profile of a lineout while it's drawn
+        self.lineout_preview = None
+        # The region statistics window (see magic2gui/regions.py), if open
+        self.regions = None
+        # The progressive interpolations currently running, by environment
+        self.progressive = {}
+        # Computes the likely next stages while the application is idle
+        self.speculator = None
+        # The arrays shown in the display modes, kept for switching back
+        self.display_cache = m2display_cache.DisplayCache()
+        # The status bar, and a magic2.progress.Progress object feeding it
         self.status = None
+        self.progress = None
         # The tkinter variable associated with radio buttons that decide
         # which graph to show. It updates automatically when the radios are
         # clicked, and the radios update when the variable is set
@@ -82,21 +103,111 @@ class Options:
         self.mode = None
         # Colormap setting for matplotlib
         self.cmap = m2graphics.cmap
-        # An image of the two interpolations subtracted
-        self.subtracted = None
-        # The offset variable allows setting a fringe shift of 0 at any point
-        self.offset = 0
-        # The centre of the plasma density map
-        self.centre = [0, 0]
-        # An image of the plasma density
-        self.density = None
         # The colorbar
         self.cbar = None
-        # Shot properties
-        self.resolution = None
-        self.depth = 10.0
-        self.wavelength = None
-        self.double = None
+
+    # An image of the two interpolations subtracted. None if it needs to
+    # be (re)calculated
+    @property
+    def subtracted(self):
+        return self.graph.cached('subtracted')
+
+    @subtracted.setter
+    def subtracted(self, value):
+        if value is None:
+            self.graph.invalidate('subtracted')
+        else:
+            self.graph.set('subtracted', value)
+
+    # An image of the plasma density. None if it needs to be (re)calculated
+    @property
+    def density(self):
+        return self.graph.cached('density')
+
+    @density.setter
+    def density(self, value):
+        if value is None:
+            self.graph.invalidate('density')
+        else:
+            self.graph.set('density', value)
+
+    # The Abel-inverted (radial) electron density. None if it needs to be
+    # (re)calculated
+    @property
+    def abel(self):
+        return self.graph.cached('abel')
+
+    # The centre of the plasma density map, [row, column] in pixels. The
+    # column is the axis of symmetry used by the Abel inversion
+    @property
+    def centre(self):
+        return self.graph.nodes['centre'].value
+
+    @centre.setter
+    def centre(self, value):
+        self.graph.set('centre', value)
+
+    # The Abel inversion method (see magic2/abel.py)
+    @property
+    def abel_method(self):
+        return self.graph.nodes['abel_method'].value
+
+    @abel_method.setter
+    def abel_method(self, value):
+        self.graph.set('abel_method', value)
+
+    # How the background is lined up with the plasma image before the
+    # subtraction (see magic2/registration.py), None for not at all
+    @property
+    def registration(self):
+        return self.graph.nodes['registration'].value
+
+    @registration.setter
+    def registration(self, value):
+        self.graph.set('registration', value)
+
+    # Shot properties. They live in the processing graph, as the plasma
+    # density and its Abel inversion depend on them
+    @property
+    def resolution(self):
+        return self.graph.nodes['resolution'].value
+
+    @resolution.setter
+    def resolution(self, value):
+        self.graph.set('resolution', value)
+
+    # The offset variable allows setting a fringe shift of 0 at any point
+    @property
+    def offset(self):
+        return self.graph.nodes['offset'].value
+
+    @offset.setter
+    def offset(self, value):
+        self.graph.set('offset', value)
+
+    @property
+    def depth(self):
+        return self.graph.nodes['depth'].value
+
+    @depth.setter
+    def depth(self, value):
+        self.graph.set('depth', value)
+
+    @property
+    def wavelength(self):
+        return self.graph.nodes['wavelength'].value
+
+    @wavelength.setter
+    def wavelength(self, value):
+        self.graph.set('wavelength', value)
+
+    @property
+    def double(self):
+        return self.graph.nodes['double'].value
+
+    @double.setter
+    def double(self, value):
+        self.graph.set('double', value)
 
 
 def main():
@@ -105,6 +216,9 @@ def main():
     # Create a root tkinter object and set its title
     options.root = root = Tk.Tk()
     root.wm_title("Magic2")
+    # Start computing the next stages in the background whenever the user
+    # leaves the application idle
+    options.speculator = m2speculation.Speculator(options)
     # This is windows specific, but needed for the icon to show up
     # in the taskbar. try/catch in case this is run on other platforms
     try:
@@ -160,6 +274,9 @@ def main():
     filemenu.add_command(label="Save the graph as an image",
                          command=lambda:
                          m2callbacks.export_image(options))
+    filemenu.add_command(label="Save the current view's data as a .png",
+                         command=lambda:
+                         m2callbacks.export_data_image(options))
 
     # Create the process submenu
     processmenu = Tk.Menu(menu)
@@ -170,6 +287,9 @@ def main():
     processmenu.add_command(label="Fast interpolation",
                             command=lambda:
                             m2callbacks.interpolate_fast(options))
+    processmenu.add_command(label="Progressive interpolation (preview first)",
+                            command=lambda:
+                            m2callbacks.interpolate_progressive(options))
     processmenu.add_command(label="Exact interpolation (debug mode)",
                             command=lambda:
                             m2callbacks.interpolate_debug(options))
@@ -177,6 +297,17 @@ def main():
     processmenu.add_command(label="Subtract",
                             command=lambda:
                             m2callbacks.subtract(options))
+    # A submenu for lining up the background with the plasma image
+    registrationmenu = Tk.Menu(processmenu)
+    processmenu.add_cascade(label="Background registration", menu=registrationmenu)
+    registration_var = Tk.StringVar(root, value="none")
+    for name, mode in (("None (images already lined up)", "none"),
+                       ("Shift by whole pixels", "translation"),
+                       ("Sub-pixel shift", "subpixel"),
+                       ("Sub-pixel shift and small rotation", "rotation")):
+        registrationmenu.add_radiobutton(label=name, variable=registration_var, value=mode,
+                                         command=lambda:
+                                         m2callbacks.set_registration(options, registration_var.get()))
     processmenu.add_command(label="Set zero shift point",
                             command=lambda:
                             m2callbacks.set_zero(options))
@@ -194,6 +325,17 @@ def main():
     processmenu.add_command(label="Set centre of the density map",
                             command=lambda:
                             m2callbacks.set_centre(options))
+    processmenu.add_command(label="Abel inversion",
+                            command=lambda:
+                            m2callbacks.abel_invert(options))
+    # A submenu for choosing the Abel inversion method
+    abelmenu = Tk.Menu(processmenu)
+    processmenu.add_cascade(label="Abel inversion method", menu=abelmenu)
+    abel_var = Tk.StringVar(root, value=options.abel_method)
+    for name, method in (("Three-point", "three_point"), ("Onion peeling", "onion")):
+        abelmenu.add_radiobutton(label=name, variable=abel_var, value=method,
+                                 command=lambda:
+                                 m2callbacks.set_abel_method(options, abel_var.get()))
     processmenu.add_separator()
     processmenu.add_command(label="Cosine",
                             command=lambda:
@@ -202,6 +344,9 @@ def main():
     processmenu.add_command(label="Take lineout",
                             command=lambda:
                             m2callbacks.lineout(options))
+    processmenu.add_command(label="Region statistics",
+                            command=lambda:
+                            m2callbacks.region_statistics(options))
 
     # Create the other submenu
     othermenu = Tk.Menu(menu)
@@ -209,6 +354,16 @@ def main():
     othermenu.add_command(label="Set colormap",
                             command=lambda:
                             m2callbacks.set_colormap(options))
+    othermenu.add_command(label="Memory usage",
+                            command=lambda:
+                            m2callbacks.memory_report(options))
+    othermenu.add_checkbutton(label="Precompute in the background",
+                              variable=options.speculator.enabled)
+    nan_maps = Tk.BooleanVar(root, value=False)
+    othermenu.add_checkbutton(label="Keep the maps as float32 (less memory)",
+                              variable=nan_maps,
+                              command=lambda:
+                              m2callbacks.set_nan_maps(options, nan_maps.get()))
     othermenu.add_separator()
     def make_pickle():
         print("Making pickle")
@@ -259,7 +414,8 @@ def main():
         ("Plasma fringes", "plasma_fringes"),
         ("Plasma map", "plasma_map"),
         ("Subtracted map", "subtracted_graph"),
-        ("Plasma density", "density_graph")
+        ("Plasma density", "density_graph"),
+        ("Radial density (Abel)", "abel_graph")
     ]
     options.show_var = Tk.StringVar()
     for name, key in display_modes:
@@ -314,9 +470,15 @@ def main():
     b = ttk.Button(side_frame, text="Take lineout",
                    command=lambda: m2callbacks.lineout(options))
     b.pack(fill=Tk.BOTH)
+    # and a panel previewing the lineout while it's being drawn
+    # (only shown then)
+    options.lineout_preview = m2lineouts.LineoutPreview(side_frame)
 
     # Create a status bar and place it at the bottom of the window.
     options.status = m2status_bar.StatusBar(root)
+    # The processing functions report their progress to the status bar
+    options.progress = m2progress.Progress(options.status.progress)
+    options.graph.progress = options.progress
     options.status.grid(row=1, columnspan=2, sticky=("W", "E"))
     # status.set("waiting",-1)
 